@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark: Listener registry of the event dispatcher.
+
+Registers attach and detach listeners for a large number of components (one
+by one and in bulk), dispatches both events once, removes half of the
+listeners in random order at runtime and dispatches again. Priorities are
+mixed such that listeners are not registered in priority order.
+
+Usage::
+
+    python benchmarks/bench_eventdispatcher.py [--listeners N] [--priorities N] [--repeat N]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gc
+import random
+import timeit
+
+from spreadflow_core.eventdispatcher import EventDispatcher
+from spreadflow_core.scheduler import AttachEvent, DetachEvent
+
+
+def noop(event):
+    """
+    A listener doing nothing.
+    """
+    pass
+
+
+def run(listeners, priorities, bulk):
+    """
+    Returns a tuple of seconds spent registering, dispatching, removing and
+    dispatching again.
+    """
+    rand = random.Random(42)
+    tokens = [(event_type, rand.randrange(priorities), noop)
+              for _ in range(listeners // 2)
+              for event_type in (AttachEvent, DetachEvent)]
+    dispatcher = EventDispatcher()
+
+    # Like timeit, keep the garbage collector from skewing the results.
+    gc.collect()
+    gc.disable()
+    try:
+        return _measure(dispatcher, tokens, bulk, rand)
+    finally:
+        gc.enable()
+
+
+def _measure(dispatcher, tokens, bulk, rand):
+    """
+    Runs the timed part of the benchmark.
+    """
+    attach = AttachEvent(scheduler=None, reactor=None)
+    detach = DetachEvent(scheduler=None)
+
+    start = timeit.default_timer()
+    if bulk:
+        keys = dispatcher.add_listeners(tokens)
+    else:
+        keys = [dispatcher.add_listener(event_type, priority, callback)
+                for event_type, priority, callback in tokens]
+    registered = timeit.default_timer()
+
+    dispatcher.dispatch(attach)
+    dispatcher.dispatch(detach)
+    dispatched = timeit.default_timer()
+
+    removals = rand.sample(list(zip(tokens, keys)), len(keys) // 2)
+    for (event_type, _, _), key in removals:
+        dispatcher.remove_listener(event_type, key)
+    removed = timeit.default_timer()
+
+    dispatcher.dispatch(attach)
+    dispatcher.dispatch(detach)
+    redispatched = timeit.default_timer()
+
+    return (registered - start, dispatched - registered,
+            removed - dispatched, redispatched - removed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--listeners', type=int, default=100000)
+    parser.add_argument('--priorities', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for bulk in (False, True):
+        timings = [run(args.listeners, args.priorities, bulk) for _ in range(args.repeat)]
+        register, dispatch, remove, redispatch = (min(column) for column in zip(*timings))
+        print('{:s} listeners={:d} priorities={:d}: register {:.3f}s, dispatch {:.3f}s, '
+              'remove half {:.3f}s, dispatch {:.3f}s'.format(
+                  'bulk  ' if bulk else 'single', args.listeners, args.priorities,
+                  register, dispatch, remove, redispatch))
+
+
+if __name__ == '__main__':
+    main()
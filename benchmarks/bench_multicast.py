@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark: Fan-out with Duplicator versus native multicast.
+
+Sends metadata-like dicts to two sinks, either through a Duplicator (which
+deep-copies every item for its secondary output) or through a multicast
+output port connected to both sinks (which delivers the same object).
+
+Usage::
+
+    python benchmarks/bench_multicast.py [--items N] [--keys N] [--repeat N]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import timeit
+
+from twisted.internet import task
+
+from spreadflow_core.eventdispatcher import EventDispatcher
+from spreadflow_core.proc import Duplicator, Tee
+from spreadflow_core.scheduler import Scheduler
+
+
+class Sink(object):
+    """
+    A processor which drops every item.
+    """
+
+    def __call__(self, item, send):
+        pass
+
+
+def make_item(index, keys):
+    """
+    Returns a nested dict resembling the metadata of a media file.
+    """
+    return {
+        'path': '/srv/media/{:d}.jpg'.format(index),
+        'meta': {'tag{:d}'.format(key): 'value {:d}'.format(key) for key in range(keys)},
+        'sizes': [(width, width * 3 // 4) for width in (160, 320, 640, 1280)],
+    }
+
+
+def run(items, multicast):
+    """
+    Returns the number of seconds it took to deliver the given items to two
+    sinks.
+    """
+    source = object()
+    sinks = (Sink(), Sink())
+
+    if multicast:
+        junction = Tee()
+        flowmap = {source: junction, junction: sinks}
+    else:
+        junction = Duplicator()
+        flowmap = {source: junction, junction: sinks[0], junction.out_duplicate: sinks[1]}
+
+    pending = []
+    cooperator = task.Cooperator(
+        terminationPredicateFactory=lambda: lambda: False,
+        scheduler=pending.append,
+        started=True
+    )
+
+    scheduler = Scheduler(flowmap, EventDispatcher(), cooperator.cooperate)
+    scheduler.run(task.Clock())
+
+    start = timeit.default_timer()
+    for item in items:
+        scheduler.send(item, source)
+    while pending:
+        pending.pop(0)()
+    elapsed = timeit.default_timer() - start
+
+    assert len(list(scheduler.pending)) == 0
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--keys', type=int, default=200,
+                        help='Number of metadata entries per item')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    items = [make_item(index, args.keys) for index in range(args.items)]
+
+    for multicast in (False, True):
+        elapsed = min(run(items, multicast) for _ in range(args.repeat))
+        print('{:s} items={:d} keys={:d}: {:.0f} items/s'.format(
+            'multicast ' if multicast else 'duplicator', args.items, args.keys,
+            args.items / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark: Throughput of the pickle message parser.
+
+Encodes a stream of messages with a payload of the given sizes, splits it
+into reads of a fixed size (as delivered by a pipe or socket) and measures
+how long it takes to push all the reads to the parser and decode the
+messages.
+
+Usage::
+
+    python benchmarks/bench_pickle_parser.py [--sizes N,N,...] [--read N] [--total N] [--repeat N]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gc
+import timeit
+
+from spreadflow_core.format import PickleMessageBuilder, PickleMessageParser
+
+
+def make_reads(size, count, read):
+    """
+    Returns a list of chunks of the encoded message stream.
+    """
+    builder = PickleMessageBuilder()
+    message = builder.message({'path': '/srv/media/1.jpg', 'data': b'x' * size})
+    stream = message * count
+    return [stream[pos:pos + read] for pos in range(0, len(stream), read)]
+
+
+def run(reads, count, buffer_max_len):
+    """
+    Returns the number of seconds it took to parse the given chunks.
+    """
+    parser = PickleMessageParser(buffer_max_len)
+    decoded = 0
+
+    # Like timeit, keep the garbage collector from skewing the results.
+    gc.collect()
+    gc.disable()
+    try:
+        start = timeit.default_timer()
+        for chunk in reads:
+            parser.push(chunk)
+            for _ in parser.messages():
+                decoded += 1
+        elapsed = timeit.default_timer() - start
+    finally:
+        gc.enable()
+
+    assert decoded == count
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='1024,65536,8388608',
+                        help='Comma separated payload sizes in bytes')
+    parser.add_argument('--read', type=int, default=4096,
+                        help='Number of bytes per read')
+    parser.add_argument('--total', type=int, default=2**25,
+                        help='Approximate number of payload bytes per run')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for size in (int(size) for size in args.sizes.split(',')):
+        count = max(1, args.total // size)
+        reads = make_reads(size, count, args.read)
+        buffer_max_len = 2 * size + 2**16
+        elapsed = min(run(reads, count, buffer_max_len) for _ in range(args.repeat))
+        print('size={:d} read={:d} messages={:d}: {:.1f} MB/s, {:.0f} messages/s'.format(
+            size, args.read, count, count * size / elapsed / 2**20, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
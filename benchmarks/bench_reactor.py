@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark: Scheduler driven by the real reactor.
+
+Runs the scheduler with its dedicated cooperator on the global reactor, i.e.,
+including the delays between two timeslices. Reports the time it takes to
+pass items through a chain of synchronous processors (throughput) and through
+a chain of processors which complete on the next reactor iteration
+(latency).
+
+Usage::
+
+    python benchmarks/bench_reactor.py [--items N] [--hops N] [--async-items N] [--async-hops N] [--tick-interval SECONDS]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import timeit
+
+from twisted.internet import defer, task
+
+from spreadflow_core.eventdispatcher import EventDispatcher
+from spreadflow_core.scheduler import Scheduler
+
+
+class Forward(object):
+    """
+    A processor which forwards every item unchanged.
+    """
+
+    def __call__(self, item, send):
+        send(item, self)
+
+
+class DeferredForward(object):
+    """
+    A processor which forwards every item on the next reactor iteration.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def __call__(self, item, send):
+        return task.deferLater(self.reactor, 0, send, item, self)
+
+
+class Sink(object):
+    """
+    A processor counting items, fires a deferred once all of them arrived.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.done = defer.Deferred()
+
+    def __call__(self, item, send):
+        self.count -= 1
+        if not self.count:
+            self.done.callback(None)
+
+
+@defer.inlineCallbacks
+def run(reactor, chain, items, tick_interval):
+    """
+    Returns the number of seconds it took to pass the given number of items
+    through the chain.
+    """
+    source = object()
+    sink = Sink(items)
+
+    flowmap = {}
+    upstream = source
+    for port in chain + [sink]:
+        flowmap[upstream] = port
+        upstream = port
+
+    kwds = {} if tick_interval is None else {'tick_interval': tick_interval}
+    scheduler = Scheduler(flowmap, EventDispatcher(), **kwds)
+    scheduler.run(reactor)
+
+    start = timeit.default_timer()
+    for item in range(items):
+        scheduler.send(item, source)
+    yield sink.done
+    elapsed = timeit.default_timer() - start
+
+    # Let the last job complete before stopping the scheduler.
+    yield task.deferLater(reactor, 0, lambda: None)
+
+    scheduler.stop(None)
+    yield scheduler.join(reactor)
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def bench(reactor, args):
+    sync_elapsed = yield run(reactor, [Forward() for _ in range(args.hops)],
+                             args.items, args.tick_interval)
+    async_elapsed = yield run(reactor, [DeferredForward(reactor) for _ in range(args.async_hops)],
+                              args.async_items, args.tick_interval)
+
+    print('tick_interval={!s} sync items={:d} hops={:d}: {:.3f}s ({:.0f} items/s), '
+          'async items={:d} hops={:d}: {:.3f}s'.format(
+              'default' if args.tick_interval is None else args.tick_interval,
+              args.items, args.hops, sync_elapsed, args.items / sync_elapsed,
+              args.async_items, args.async_hops, async_elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--hops', type=int, default=5)
+    parser.add_argument('--async-items', type=int, default=200)
+    parser.add_argument('--async-hops', type=int, default=3)
+    parser.add_argument('--tick-interval', type=float, default=None,
+                        help='Seconds between two timeslices, defaults to the scheduler default')
+    args = parser.parse_args()
+
+    task.react(bench, (args,))
+
+
+if __name__ == '__main__':
+    main()
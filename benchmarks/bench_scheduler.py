@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark: Throughput of the scheduler.
+
+Sends items through a chain of trivial synchronous processors and reports the
+number of items (and hops) per second. The scheduler is driven by a
+cooperator which is iterated manually, hence no reactor is involved.
+
+Usage::
+
+    python benchmarks/bench_scheduler.py [--items N] [--hops N] [--listener] [--inline N] [--fuse] [--metrics] [--journal PATH] [--record PATH] [--trace PATH]
+
+With --trace, the items recorded in the given trace file (see
+:mod:`spreadflow_core.trace`) are sent instead of integers.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import timeit
+
+from twisted.internet import task
+
+from spreadflow_core.eventdispatcher import EventDispatcher
+from spreadflow_core.jobqueue import JobQueue
+from spreadflow_core.journal import Journal
+from spreadflow_core.metrics import MetricsRegistry
+from spreadflow_core.proc import Fused
+from spreadflow_core.scheduler import Scheduler, JobEvent
+from spreadflow_core.trace import TraceReader, TraceRecorder
+
+
+class Forward(object):
+    """
+    A processor which forwards every item unchanged.
+    """
+
+    def __call__(self, item, send):
+        send(item, self)
+
+
+def read_trace(path):
+    """
+    Returns a list of all items recorded in a trace file.
+    """
+    reader = TraceReader(path)
+    reader.open()
+    try:
+        return [record.item for record in reader.records()]
+    finally:
+        reader.close()
+
+
+def run(items, hops, listener=False, inline=0, fuse=False, metrics=False,
+        journal=None, record=None):
+    """
+    Returns the number of seconds it took to pass the given items (or the
+    given number of integers) through a chain of the given length.
+    """
+    if isinstance(items, int):
+        items = range(items)
+
+    source = object()
+    chain = [Forward() for _ in range(hops)]
+
+    flowmap = {}
+    if fuse:
+        flowmap[source] = Fused(chain)
+    else:
+        upstream = source
+        for port in chain:
+            flowmap[upstream] = port
+            upstream = port
+
+    dispatcher = EventDispatcher()
+    if listener:
+        dispatcher.add_listener(JobEvent, 0, lambda event: None)
+
+    pending = []
+    cooperator = task.Cooperator(
+        terminationPredicateFactory=lambda: lambda: False,
+        scheduler=pending.append,
+        started=True
+    )
+
+    clock = task.Clock()
+    if journal:
+        journal = Journal(journal, list(flowmap.values()))
+    if record:
+        record = TraceRecorder(record, [source])
+    scheduler = Scheduler(flowmap, dispatcher, cooperator.cooperate,
+                          queue=JobQueue(inline_depth=inline),
+                          metrics=MetricsRegistry() if metrics else None,
+                          journal=journal, recorder=record)
+    scheduler.run(clock)
+
+    start = timeit.default_timer()
+    for item in items:
+        scheduler.send(item, source)
+    while pending:
+        pending.pop(0)()
+    if journal:
+        journal.close()
+    if record:
+        record.close()
+    elapsed = timeit.default_timer() - start
+
+    assert len(list(scheduler.pending)) == 0
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--hops', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--listener', action='store_true',
+                        help='Register a JobEvent listener')
+    parser.add_argument('--inline', type=int, default=0,
+                        help='Maximum number of jobs run inline')
+    parser.add_argument('--fuse', action='store_true',
+                        help='Fuse the chain into one processor')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Record per-port metrics')
+    parser.add_argument('--journal', metavar='PATH',
+                        help='Journal jobs to the given file')
+    parser.add_argument('--record', metavar='PATH',
+                        help='Record items sent by the source to the given trace file')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='Send the items recorded in the given trace file')
+    args = parser.parse_args()
+
+    items = read_trace(args.trace) if args.trace else args.items
+    count = len(items) if args.trace else args.items
+
+    elapsed = min(run(items, args.hops, args.listener, args.inline, args.fuse,
+                      args.metrics, args.journal, args.record)
+                  for _ in range(args.repeat))
+
+    print('items={:d} hops={:d} listener={!s} inline={:d} fuse={!s} metrics={!s} journal={!s} record={!s} trace={!s}: {:.0f} items/s, {:.0f} hops/s'.format(
+        count, args.hops, args.listener, args.inline, args.fuse, args.metrics,
+        bool(args.journal), bool(args.record), bool(args.trace),
+        count / elapsed, count * args.hops / elapsed))
+
+
+if __name__ == '__main__':
+    main()
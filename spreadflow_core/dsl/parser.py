@@ -9,10 +9,11 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import itertools
-from collections import Counter, namedtuple
+from collections import Counter, OrderedDict, namedtuple
 from toposort import toposort_flatten
 
 from spreadflow_core import scheduler, graph
+from spreadflow_core.proc import Fused
 from spreadflow_core.dsl.stream import \
     AddTokenOp, \
     SetDefaultTokenOp, \
@@ -21,17 +22,24 @@ from spreadflow_core.dsl.stream import \
     token_map
 from spreadflow_core.dsl.tokens import \
     AliasToken, \
+    CoalesceToken, \
     ComponentToken, \
+    ConcurrencyToken, \
     ConnectionToken, \
     DefaultInputToken, \
     DefaultOutputToken, \
     DescriptionToken, \
     EventHandlerToken, \
+    ExecutorToken, \
+    ExpiryToken, \
+    FusableToken, \
     LabelToken, \
     ParentElementToken, \
     PartitionBoundsToken, \
     PartitionSelectToken, \
-    PartitionToken
+    PartitionToken, \
+    PriorityToken, \
+    RetryToken
 from spreadflow_core.subprocess import SubprocessWorker, SubprocessController
 
 try:
@@ -56,6 +64,20 @@ class AliasParser(StreamBranch):
         """
         return token_attr_map(self.selected, 'alias', 'element')
 
+class CoalesceParser(StreamBranch):
+    """
+    Builds map of coalescing policies from a stream of operations.
+    """
+
+    def predicate(self, operation):
+        return isinstance(operation.token, CoalesceToken)
+
+    def get_coalescemap(self):
+        """
+        Returns a map element -> coalesce token
+        """
+        return token_map(self.selected, lambda op: op.token.element)
+
 class ComponentParser(StreamBranch):
     """
     Extracts exactly one component from a stream of operations.
@@ -75,6 +97,20 @@ class ComponentParser(StreamBranch):
 
         return components[0]
 
+class ConcurrencyParser(StreamBranch):
+    """
+    Builds map of concurrency settings from a stream of operations.
+    """
+
+    def predicate(self, operation):
+        return isinstance(operation.token, ConcurrencyToken)
+
+    def get_concurrencymap(self):
+        """
+        Returns a map element -> concurrency token
+        """
+        return token_map(self.selected, lambda op: op.token.element)
+
 class ConnectionParser(StreamBranch):
     """
     Extracts information about connected ports from a stream of operations.
@@ -85,15 +121,24 @@ class ConnectionParser(StreamBranch):
 
     def get_portmap(self):
         """
-        Returns a map output -> input
+        Returns a map output -> input. Outputs connected to more than one
+        input (multicast) map to a tuple of inputs.
         """
-        return token_attr_map(self.selected, 'port_out', 'port_in')
+        portmap = OrderedDict()
+        for port_out, port_in in self.get_links():
+            if port_out not in portmap:
+                portmap[port_out] = port_in
+            elif isinstance(portmap[port_out], tuple):
+                portmap[port_out] += (port_in,)
+            else:
+                portmap[port_out] = (portmap[port_out], port_in)
+        return portmap
 
     def get_links(self):
         """
-        Returns an iterator over output, input pairs
+        Returns a list of output, input pairs
         """
-        return self.get_portmap().items()
+        return [(token.port_out, token.port_in) for token in token_map(self.selected)]
 
     def get_portset(self):
         """
@@ -158,6 +203,48 @@ class EventHandlerParser(StreamBranch):
         """
         return token_map(self.selected).values()
 
+class ExecutorParser(StreamBranch):
+    """
+    Builds map of executors from a stream of operations.
+    """
+
+    def predicate(self, operation):
+        return isinstance(operation.token, ExecutorToken)
+
+    def get_executormap(self):
+        """
+        Returns a map element -> executor token
+        """
+        return token_map(self.selected, lambda op: op.token.element)
+
+class ExpiryParser(StreamBranch):
+    """
+    Builds map of expiry settings from a stream of operations.
+    """
+
+    def predicate(self, operation):
+        return isinstance(operation.token, ExpiryToken)
+
+    def get_expirymap(self):
+        """
+        Returns a map element -> expiry token
+        """
+        return token_map(self.selected, lambda op: op.token.element)
+
+class FusableParser(StreamBranch):
+    """
+    Builds map of fusable elements from a stream of operations.
+    """
+
+    def predicate(self, operation):
+        return isinstance(operation.token, FusableToken)
+
+    def get_fusablemap(self):
+        """
+        Returns a map element -> fusable token
+        """
+        return token_map(self.selected, lambda op: op.token.element)
+
 class LabelParser(StreamBranch):
     """
     Builds map of labels from a stream of operations.
@@ -253,6 +340,34 @@ class PartitionSelectParser(StreamBranch):
 
         return partition_select_tokens[0]
 
+class PriorityParser(StreamBranch):
+    """
+    Builds map of priority settings from a stream of operations.
+    """
+
+    def predicate(self, operation):
+        return isinstance(operation.token, PriorityToken)
+
+    def get_prioritymap(self):
+        """
+        Returns a map element -> priority token
+        """
+        return token_map(self.selected, lambda op: op.token.element)
+
+class RetryParser(StreamBranch):
+    """
+    Builds map of retry policies from a stream of operations.
+    """
+
+    def predicate(self, operation):
+        return isinstance(operation.token, RetryToken)
+
+    def get_retrymap(self):
+        """
+        Returns a map element -> retry token
+        """
+        return token_map(self.selected, lambda op: op.token.element)
+
 class AliasResolverPass(object):
     alias_parser = AliasParser()
     connection_parser = ConnectionParser()
@@ -311,12 +426,6 @@ class PortsValidatorPass(object):
                 raise ParserError(non_callable_ins, 'Input ports must be '
                                        'callable')
 
-            out_counts = Counter(outs).items()
-            multi_outs = [port for port, count in out_counts if count > 1]
-            if len(multi_outs):
-                raise ParserError(multi_outs, 'Output ports must not have '
-                                       'more than one connection')
-
         return stream
 
 class PartitionExpanderPass(object):
@@ -350,6 +459,120 @@ class PartitionExpanderPass(object):
         for element, partition in partition_map.items():
             yield AddTokenOp(PartitionToken(element, partition))
 
+class ElementTokenExpanderPass(object):
+    """
+    Abstract base class for passes propagating tokens assigned to components
+    to its children.
+
+    Subclasses must provide a token_parser and implement get_tokenmap. Tokens
+    must have an element attribute.
+    """
+
+    parent_parser = ParentParser()
+    token_parser = None
+
+    def __call__(self, stream):
+        # Capture tokens, read components, yield all the rest
+        stream = self.parent_parser.extract(stream)
+        stream = self.token_parser.divert(stream)
+        for op in stream: yield op
+
+        token_map = self.get_tokenmap()
+
+        # Inherit tokens by walking down the component tree in topological
+        # order.
+        for element, parent in self.parent_parser.get_parentmap_toposort():
+            try:
+                parent_token = token_map[parent]
+            except KeyError:
+                continue
+
+            if element not in token_map:
+                token_map[element] = parent_token._replace(element=element)
+
+        # Produce updated tokens.
+        for token in token_map.values():
+            yield AddTokenOp(token)
+
+    def get_tokenmap(self):
+        """
+        Abstract method. Must be implemented in subclass.
+
+        Returns:
+            A map element -> token
+        """
+        raise NotImplementedError()
+
+class ConcurrencyExpanderPass(ElementTokenExpanderPass):
+    """
+    Propagate the concurrency settings of components to their ports.
+    """
+
+    token_parser = ConcurrencyParser()
+
+    def get_tokenmap(self):
+        return self.token_parser.get_concurrencymap()
+
+class CoalesceExpanderPass(ElementTokenExpanderPass):
+    """
+    Propagate the coalescing policies of components to their ports.
+    """
+
+    token_parser = CoalesceParser()
+
+    def get_tokenmap(self):
+        return self.token_parser.get_coalescemap()
+
+class PriorityExpanderPass(ElementTokenExpanderPass):
+    """
+    Propagate the priority settings of components to their ports.
+    """
+
+    token_parser = PriorityParser()
+
+    def get_tokenmap(self):
+        return self.token_parser.get_prioritymap()
+
+class RetryExpanderPass(ElementTokenExpanderPass):
+    """
+    Propagate the retry policies of components to their ports.
+    """
+
+    token_parser = RetryParser()
+
+    def get_tokenmap(self):
+        return self.token_parser.get_retrymap()
+
+class ExecutorExpanderPass(ElementTokenExpanderPass):
+    """
+    Propagate the executor settings of components to their ports.
+    """
+
+    token_parser = ExecutorParser()
+
+    def get_tokenmap(self):
+        return self.token_parser.get_executormap()
+
+class ExpiryExpanderPass(ElementTokenExpanderPass):
+    """
+    Propagate the expiry settings of components to their ports.
+    """
+
+    token_parser = ExpiryParser()
+
+    def get_tokenmap(self):
+        return self.token_parser.get_expirymap()
+
+class FusableExpanderPass(ElementTokenExpanderPass):
+    """
+    Propagate the fusable flag of components to their ports.
+    """
+
+    token_parser = FusableParser()
+
+    def get_tokenmap(self):
+        return self.token_parser.get_fusablemap()
+
 PartitionBounds = namedtuple('PartitionBounds', ['outs', 'ins'])
 
 class PartitionBoundsPass(object):
@@ -372,7 +595,10 @@ class PartitionBoundsPass(object):
             partition_in = partition_map.get(port_in, None)
             if partition_out != partition_in:
                 if partition_out:
-                    partition_bounds[partition_out].outs.append(port_out)
+                    # Multicast outputs are only sent across once.
+                    bounds_outs = partition_bounds[partition_out].outs
+                    if port_out not in bounds_outs:
+                        bounds_outs.append(port_out)
                 if partition_in:
                     bounds_ins = partition_bounds[partition_in].ins
                     if port_in not in bounds_ins:
@@ -419,7 +645,12 @@ class PartitionWorkerPass(object):
             if port_out in partition_elements and port_in in partition_elements:
                 yield AddTokenOp(ConnectionToken(port_out, port_in))
             elif port_out in partition_elements:
-                yield AddTokenOp(ConnectionToken(port_out, outmap[port_out]))
+                # Multicast outputs connected to more than one port outside of
+                # the partition share a single input port of the worker.
+                token = ConnectionToken(port_out, outmap[port_out])
+                if token not in emitted_tokens:
+                    emitted_tokens.add(token)
+                    yield AddTokenOp(token)
             elif port_in in partition_elements:
                 # A workers output port potentially replaces multiple outputs
                 # outside the partition. Hence it is necessary to guard against
@@ -490,6 +721,116 @@ class ComponentsPurgePass(object):
                 connected_elements.add(parent)
                 yield AddTokenOp(ParentElementToken(element, parent))
 
+class FusionPass(object):
+    """
+    Replaces linear runs of fusable processors with one fused processor.
+
+    Two processors are fused if the first one is connected to the second one
+    by its default output port (i.e., the processor itself), both are marked
+    as fusable, both reside in the same partition and the second one has no
+    other upstream connection. The fused processor takes over the incoming
+    connections as well as the concurrency, priority, coalescing and expiry
+    settings of the first processor in the run. Processors running on an
+    executor or having a retry policy are never fused. Processors with a
+    coalescing policy or expiry settings are only fused if they come first in
+    the run.
+    """
+
+    coalesce_parser = CoalesceParser()
+    concurrency_parser = ConcurrencyParser()
+    connection_parser = ConnectionParser()
+    executor_parser = ExecutorParser()
+    expiry_parser = ExpiryParser()
+    fusable_parser = FusableParser()
+    label_parser = LabelParser()
+    parent_parser = ParentParser()
+    partition_parser = PartitionParser()
+    priority_parser = PriorityParser()
+    retry_parser = RetryParser()
+
+    def __call__(self, stream):
+        # Capture connections, read everything else, yield the rest.
+        stream = self.coalesce_parser.extract(stream)
+        stream = self.concurrency_parser.extract(stream)
+        stream = self.connection_parser.divert(stream)
+        stream = self.executor_parser.extract(stream)
+        stream = self.expiry_parser.extract(stream)
+        stream = self.fusable_parser.extract(stream)
+        stream = self.label_parser.extract(stream)
+        stream = self.parent_parser.extract(stream)
+        stream = self.partition_parser.extract(stream)
+        stream = self.priority_parser.extract(stream)
+        stream = self.retry_parser.extract(stream)
+        for op in stream: yield op
+
+        links = list(self.connection_parser.get_links())
+        fusable = set(element for element, token
+                      in self.fusable_parser.get_fusablemap().items()
+                      if token.fusable)
+        fusable.difference_update(self.executor_parser.get_executormap())
+        fusable.difference_update(self.retry_parser.get_retrymap())
+        partition_map = self.partition_parser.get_partitionmap()
+        coalesce_map = self.coalesce_parser.get_coalescemap()
+        expiry_map = self.expiry_parser.get_expirymap()
+
+        in_counts = Counter(port_in for _, port_in in links)
+        out_counts = Counter(port_out for port_out, _ in links)
+
+        # Collect fusable edges. Every processor has at most one successor
+        # (multicast outputs are not fused) and at most one predecessor (see
+        # in_counts).
+        successors = {}
+        for port_out, port_in in links:
+            if (port_out in fusable and port_in in fusable
+                    and port_out in in_counts and port_out is not port_in
+                    and in_counts[port_in] == 1 and out_counts[port_out] == 1
+                    and port_in not in coalesce_map and port_in not in expiry_map
+                    and partition_map.get(port_out) == partition_map.get(port_in)):
+                successors[port_out] = port_in
+
+        # Follow the edges starting at the processors without a fusable
+        # predecessor. Cycles are left alone.
+        predecessors = set(successors.values())
+        fused_map = {}
+        for head in successors:
+            if head in predecessors:
+                continue
+
+            elements = [head]
+            while elements[-1] in successors:
+                elements.append(successors[elements[-1]])
+
+            fused_map[head] = Fused(elements)
+
+        # Rewire connections.
+        interior = set(itertools.chain.from_iterable(
+            fused.elements[:-1] for fused in fused_map.values()))
+        for port_out, port_in in links:
+            if port_out not in interior:
+                yield AddTokenOp(ConnectionToken(port_out, fused_map.get(port_in, port_in)))
+
+        # Make sure that fused elements are still attached and detached.
+        concurrency_map = self.concurrency_parser.get_concurrencymap()
+        label_map = self.label_parser.get_labelmap()
+        parent_map = self.parent_parser.get_parentmap()
+        priority_map = self.priority_parser.get_prioritymap()
+        for head, fused in fused_map.items():
+            for element in fused.elements:
+                if element not in parent_map:
+                    yield AddTokenOp(ParentElementToken(element, fused))
+
+            labels = [label_map.get(element, str(element)) for element in fused.elements]
+            yield SetDefaultTokenOp(LabelToken(fused, 'Fused: {:s}'.format(', '.join(labels))))
+
+            if head in concurrency_map:
+                yield AddTokenOp(concurrency_map[head]._replace(element=fused))
+            if head in priority_map:
+                yield AddTokenOp(priority_map[head]._replace(element=fused))
+            if head in coalesce_map:
+                yield AddTokenOp(coalesce_map[head]._replace(element=fused))
+            if head in expiry_map:
+                yield AddTokenOp(expiry_map[head]._replace(element=fused))
+
 class EventHandlersPass(object):
     connection_parser = ConnectionParser()
     parent_parser = ParentParser()
@@ -500,8 +841,10 @@ class EventHandlersPass(object):
         stream = self.parent_parser.extract(stream)
         for op in stream: yield op
 
-        portset = self.connection_parser.get_portset()
-        nodeset = self.parent_parser.get_nodeset()
+        links = self.connection_parser.get_links()
+        parent_map = self.parent_parser.get_parentmap()
+        portset = set(itertools.chain(*zip(*links)))
+        nodeset = set(itertools.chain(parent_map.keys(), parent_map.values()))
         comps = portset.union(nodeset)
 
         # Build attach event handlers.
@@ -509,14 +852,58 @@ class EventHandlersPass(object):
                 hasattr(comp, 'attach') and callable(comp.attach)
         attachable_comps = (comp for comp in comps if is_attachable(comp))
         for comp in attachable_comps:
-            callback = lambda event, comp=comp: \
-                    comp.attach(event.scheduler, event.reactor)
+            callback = ComponentHandler(comp, _attach)
             yield AddTokenOp(EventHandlerToken(scheduler.AttachEvent, 0, callback))
 
-        # Build detach event handlers.
+        # Components receiving items from upstream (including their parents)
+        # are not sources.
+        downstream = set()
+        for _, comp in links:
+            while comp is not None and comp not in downstream:
+                downstream.add(comp)
+                comp = parent_map.get(comp)
+
+        # Build detach event handlers. Sources are detached early if the
+        # scheduler is drained, make sure they are detached only once.
         is_detachable = lambda comp: \
                 hasattr(comp, 'detach') and callable(comp.detach)
         detachable_comps = (comp for comp in comps if is_detachable(comp))
         for comp in detachable_comps:
-            callback = lambda event, comp=comp: comp.detach()
+            if comp in downstream:
+                callback = ComponentHandler(comp, _detach)
+            else:
+                callback = ComponentHandler(comp, _detach, once=True)
+                yield AddTokenOp(EventHandlerToken(scheduler.DrainEvent, 0, callback))
             yield AddTokenOp(EventHandlerToken(scheduler.DetachEvent, 0, callback))
+
+class ComponentHandler(object):
+    """
+    Event handler calling a lifecycle method of a component. Represented by
+    the component in logs and timing reports.
+
+    Args:
+        component: The component.
+        func (callable): A function called with the component and the event.
+        once (bool): If True, only the first invocation is passed on.
+    """
+
+    def __init__(self, component, func, once=False):
+        self.component = component
+        self.func = func
+        self.once = once
+        self.called = False
+
+    def __call__(self, event):
+        if self.once and self.called:
+            return
+        self.called = True
+        return self.func(self.component, event)
+
+    def __repr__(self):
+        return repr(self.component)
+
+def _attach(comp, event):
+    return comp.attach(event.scheduler, event.reactor)
+
+def _detach(comp, event): # pylint: disable=unused-argument
+    return comp.detach()
@@ -11,14 +11,21 @@ from __future__ import unicode_literals
 from collections import namedtuple
 
 AliasToken = namedtuple('AliasToken', ['element', 'alias'])
+CoalesceToken = namedtuple('CoalesceToken', ['element', 'key', 'merge'])
 ComponentToken = namedtuple('ComponentToken', ['component'])
+ConcurrencyToken = namedtuple('ConcurrencyToken', ['element', 'concurrency', 'ordered'])
 ConnectionToken = namedtuple('ConnectionToken', ['port_out', 'port_in'])
 DefaultInputToken = namedtuple('DefaultInputToken', ['element', 'port'])
 DefaultOutputToken = namedtuple('DefaultOutputToken', ['element', 'port'])
 DescriptionToken = namedtuple('DescriptionToken', ['element', 'description'])
 EventHandlerToken = namedtuple('EventHandlerToken', ['event_type', 'priority', 'callback'])
+ExecutorToken = namedtuple('ExecutorToken', ['element', 'executor'])
+ExpiryToken = namedtuple('ExpiryToken', ['element', 'ttl', 'deadline', 'port'])
+FusableToken = namedtuple('FusableToken', ['element', 'fusable'])
 LabelToken = namedtuple('LabelToken', ['element', 'label'])
 ParentElementToken = namedtuple('ParentElementToken', ['element', 'parent'])
 PartitionBoundsToken = namedtuple('PartitionBoundsToken', ['partition', 'bounds'])
 PartitionSelectToken = namedtuple('PartitionSelectToken', ['partition'])
 PartitionToken = namedtuple('PartitionToken', ['element', 'partition'])
+PriorityToken = namedtuple('PriorityToken', ['element', 'priority', 'weight'])
+RetryToken = namedtuple('RetryToken', ['element', 'policy', 'port'])
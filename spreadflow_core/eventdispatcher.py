@@ -8,9 +8,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+import bisect
 import collections
+import functools
+import heapq
 import itertools
-import bisect
 
 from twisted.internet import defer
 from twisted.logger import Logger
@@ -19,6 +21,7 @@ from twisted.python.failure import Failure
 Key = collections.namedtuple('Key', ['priority', 'serial'])
 Handler = collections.namedtuple('Handler', ['callback', 'args', 'kwds'])
 Entry = collections.namedtuple('Entry', ['key', 'handler'])
+HandlerTiming = collections.namedtuple('HandlerTiming', ['handler', 'seconds', 'success'])
 
 class FailMode(object): # pylint: disable=too-few-public-methods
     """Failure modes enumeration
@@ -103,13 +106,33 @@ class EventDispatcher(object):
             event = GreetEvent()
             deferred = dispatcher.dispatch(event)
             deferred.addCallback(dispatcher.log_failures, event)
+
+        Listeners registered for a class also receive events of its
+        subclasses. Handlers of all the classes in the method resolution order
+        of an event are merged by priority and registration order. E.g., a
+        listener for a common base class (or ``object``) observes every event
+        deriving from it.
+
+        For every event type, the handlers grouped by priority are compiled
+        into a dispatch plan which is cached until the listeners of the type
+        or any of its base classes change. Adding or removing a listener is
+        cheap, but the next dispatch of an affected event type rebuilds its
+        plan in O(n) over all the listeners of the type and its base classes.
+        As long as every handler returns synchronously, dispatch returns an
+        already fired deferred without the overhead of waiting on the
+        results.
     """
 
     log = Logger()
 
     def __init__(self):
         self._counter = itertools.count()
+        # Map event type -> priority -> serial -> handler. Serials increase
+        # monotonically, hence insertion order is registration order.
         self._listeners = {}
+        # Map event type -> sorted list of the priorities in use.
+        self._priorities = {}
+        self._plans = {}
 
     def add_listener(self, event_type, priority, callback, *args, **kwds):
         """
@@ -130,38 +153,70 @@ class EventDispatcher(object):
             registered listener. This can be used to subsequently remove it
             again.
         """
-        listeners = self._listeners.setdefault(event_type, [])
         key = Key(priority, next(self._counter))
-        bisect.insort(listeners, Entry(key, Handler(callback, args, kwds)))
+        self._group(event_type, priority)[key.serial] = Handler(callback, args, kwds)
+        self._invalidate(event_type)
         return key
 
+    def add_listeners(self, listeners):
+        """
+        Register many callback functions at once.
+
+        Args:
+            listeners: An iterable over tuples (event_type, priority,
+                callback), e.g. event handler tokens.
+
+        Returns:
+            list: The keys of the registered listeners in the given order.
+        """
+        keys = []
+        groups = {}
+        for event_type, priority, callback in listeners:
+            key = Key(priority, next(self._counter))
+            group = groups.get((event_type, priority))
+            if group is None:
+                group = groups[(event_type, priority)] = self._group(event_type, priority)
+            group[key.serial] = Handler(callback, (), {})
+            keys.append(key)
+
+        for event_type in set(event_type for event_type, _ in groups):
+            self._invalidate(event_type)
+
+        return keys
+
     def remove_listener(self, event_type, key):
         """
         Removes an event handler from the list of listeners for the given type.
 
+        The cached dispatch plans of the type and of its subclasses are
+        discarded and rebuilt in O(n) on their next dispatch.
+
         Args:
             event_type: Type of the event. Pass the class in here for events
                 based on classes.
-            key: A key as returned by add_listeners.
+            key: A key as returned by add_listener.
 
         Returns:
             :class:`spreadflow_core.eventdispatcher.Handler`: A reference to
             the removed callback, positional parameters and keyword arguments.
         """
-        result = None
-
-        listeners = self._listeners[event_type]
-        idx = bisect.bisect(listeners, (key,), hi=len(listeners)-1)
-
-        if listeners[idx].key == key:
-            result = listeners.pop(idx)
-        else:
+        try:
+            groups = self._listeners[event_type]
+            group = groups[key.priority]
+            handler = group.pop(key.serial)
+        except KeyError:
             raise KeyError(key)
 
-        if len(listeners) == 0:
-            del self._listeners[event_type]
+        if not group:
+            del groups[key.priority]
+            priorities = self._priorities[event_type]
+            del priorities[bisect.bisect_left(priorities, key.priority)]
+            if not groups:
+                del self._listeners[event_type]
+                del self._priorities[event_type]
 
-        return result.handler
+        self._invalidate(event_type)
+        return handler
 
     def get_listeners(self, event_type):
         """
@@ -172,9 +227,14 @@ class EventDispatcher(object):
             based on classes.
 
         Returns:
-            An iterator over the listeners for the given event type.
+            An iterator over the listeners registered for exactly the given
+            event type ordered by priority and registration. Listeners of base
+            classes are not included, use :meth:`get_plan` for that.
         """
-        return iter(self._listeners.get(event_type, []))
+        groups = self._listeners.get(event_type, {})
+        for priority in self._priorities.get(event_type, ()):
+            for serial, handler in groups[priority].items():
+                yield Entry(Key(priority, serial), handler)
 
     def get_listeners_grouped(self, event_type):
         """
@@ -191,15 +251,72 @@ class EventDispatcher(object):
         keyfunc = lambda entry: entry.key.priority
         return itertools.groupby(listeners, keyfunc)
 
+    def _group(self, event_type, priority):
+        """
+        Returns the map serial -> handler for the given type and priority.
+        """
+        groups = self._listeners.setdefault(event_type, {})
+        group = groups.get(priority)
+        if group is None:
+            group = groups[priority] = collections.OrderedDict()
+            bisect.insort(self._priorities.setdefault(event_type, []), priority)
+        return group
+
+    def _invalidate(self, event_type):
+        """
+        Discards the cached dispatch plans of the given type and of all its
+        subclasses.
+        """
+        for cached in [cached for cached in self._plans
+                       if event_type in getattr(cached, '__mro__', (cached,))]:
+            del self._plans[cached]
 
-    @defer.inlineCallbacks
-    def dispatch(self, event, fail_mode=FailMode.RAISE):
+    def get_plan(self, event_type):
+        """
+        Returns the dispatch plan for the given event type.
+
+        The plan includes the listeners registered for any class in the method
+        resolution order of the given type.
+
+        Args:
+            event_type: Type of the event. Pass the class in here for events
+            based on classes.
+
+        Returns:
+            A tuple of pairs (priority, tuple-of-handlers) ordered by
+            priority.
+        """
+        plan = self._plans.get(event_type)
+        if plan is None:
+            # The listeners of every class are already ordered by key and keys
+            # are unique, hence merging the streams preserves the order.
+            entries = heapq.merge(*[self.get_listeners(cls) for cls in
+                                    getattr(event_type, '__mro__', (event_type,))])
+
+            grouped = itertools.groupby(entries, lambda entry: entry.key.priority)
+            plan = tuple((priority, tuple(entry.handler for entry in group))
+                         for priority, group in grouped)
+            self._plans[event_type] = plan
+        return plan
+
+    def dispatch(self, event, fail_mode=FailMode.RAISE, concurrency=None,
+                 timeout=None, reactor=None, timings=None):
         """
         Dispatch an event, calling all the registered listeners in turn.
 
         Args:
             event: An event instance.
             fail_mode: One of FailMode.RAISE (default) and FailMode.RESULT.
+            concurrency (int): If given, the maximum number of handlers with
+                the same priority waiting on a deferred at the same time.
+                Remaining handlers are called as soon as others completed.
+            timeout (float): If given, the number of seconds after which a
+                deferred returned by a handler is cancelled. The handler then
+                fails with :class:`twisted.internet.defer.TimeoutError`.
+            reactor: The reactor used for timeouts and timings. Defaults to
+                the global reactor.
+            timings (list): If given, a :class:`HandlerTiming` is appended for
+                every handler once it completed.
 
         Returns:
             A list of tuples (priority, list-of-results) where each entry in
@@ -212,19 +329,51 @@ class EventDispatcher(object):
         """
         results = []
 
-        fire_on_fail = (fail_mode == FailMode.RAISE)
+        plan = self.get_plan(type(event))
+        if concurrency is not None or timeout is not None or timings is not None:
+            if reactor is None:
+                from twisted.internet import reactor
+            call = functools.partial(_call_supervised, timeout=timeout,
+                                     reactor=reactor, timings=timings)
+            return self._dispatch_deferred(event, fail_mode, plan, 0, None, results,
+                                           call, concurrency)
 
-        for priority, group in self.get_listeners_grouped(type(event)):
+        for index, (priority, handlers) in enumerate(plan):
             self.log.debug('Calling handlers with priority {priority} for {event}', event=event, priority=priority) # pylint: disable=line-too-long
 
-            handlers = [handler for _, handler in group]
-            batch = []
-            for handler in handlers:
-                deferred = defer.maybeDeferred(handler.callback, event,
-                                               *handler.args, **handler.kwds)
-                deferred.addErrback(lambda failure, handler=handler:
-                                    Failure(HandlerError(handler, failure)))
-                batch.append(deferred)
+            batch = [_call_handler(handler, event) for handler in handlers]
+            if any(isinstance(result, defer.Deferred) for result in batch):
+                # Some handler returned a deferred or failed, wait for the
+                # results from here on.
+                return self._dispatch_deferred(event, fail_mode, plan, index, batch, results)
+
+            results.append((priority, [(True, result) for result in batch]))
+
+            self.log.debug('Called {n} handlers with priority {priority} for {event}', n=len(batch), event=event, priority=priority) # pylint: disable=line-too-long
+
+        return defer.succeed(results)
+
+    @defer.inlineCallbacks
+    def _dispatch_deferred(self, event, fail_mode, plan, index, batch, results,
+                           call=None, concurrency=None):
+        """
+        Continue dispatching an event starting with the given batch of handler
+        results, waiting for every priority group to complete.
+        """
+        fire_on_fail = (fail_mode == FailMode.RAISE)
+        call = call or _call_handler
+
+        for priority, handlers in plan[index:]:
+            if batch is None:
+                self.log.debug('Calling handlers with priority {priority} for {event}', event=event, priority=priority) # pylint: disable=line-too-long
+                if concurrency is None:
+                    batch = [call(handler, event) for handler in handlers]
+                else:
+                    semaphore = defer.DeferredSemaphore(concurrency)
+                    batch = [semaphore.run(call, handler, event) for handler in handlers]
+
+            batch = [result if isinstance(result, defer.Deferred) else defer.succeed(result)
+                     for result in batch]
 
             if len(batch):
                 deferred = defer.DeferredList(batch, consumeErrors=True,
@@ -235,7 +384,7 @@ class EventDispatcher(object):
                 results.append((priority, group_results))
 
             self.log.debug('Called {n} handlers with priority {priority} for {event}', n=len(batch), event=event, priority=priority) # pylint: disable=line-too-long
-
+            batch = None
 
         defer.returnValue(results)
 
@@ -262,6 +411,49 @@ class EventDispatcher(object):
 
         return result
 
+def _call_handler(handler, event, timeout=None, reactor=None):
+    """
+    Calls a handler. Returns its result unless the handler returned a
+    deferred or failed. In that case, returns a deferred failing with a
+    :class:`HandlerError`.
+    """
+    try:
+        result = handler.callback(event, *handler.args, **handler.kwds)
+    except: # pylint: disable=bare-except
+        return defer.fail(HandlerError(handler, Failure()))
+
+    if isinstance(result, defer.Deferred):
+        if timeout is not None:
+            result.addTimeout(timeout, reactor)
+        return result.addErrback(lambda failure: Failure(HandlerError(handler, failure)))
+    elif isinstance(result, Failure):
+        return defer.fail(HandlerError(handler, result))
+
+    return result
+
+def _call_supervised(handler, event, timeout, reactor, timings):
+    """
+    Calls a handler with a timeout and records how long it took.
+    """
+    start = reactor.seconds()
+    result = _call_handler(handler, event, timeout, reactor)
+
+    if timings is not None:
+        if isinstance(result, defer.Deferred):
+            result.addBoth(_record_timing, timings, handler, start, reactor)
+        else:
+            _record_timing(result, timings, handler, start, reactor)
+
+    return result
+
+def _record_timing(result, timings, handler, start, reactor):
+    """
+    Appends the timing of a completed handler to the list.
+    """
+    success = not isinstance(result, Failure)
+    timings.append(HandlerTiming(handler, reactor.seconds() - start, success))
+    return result
+
 def _trap_first_error(failure, handlers):
     """Traps defer.FirstError and turns it into a HandlerError"""
     failure.trap(defer.FirstError)
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+
+"""
+Executors running jobs of selected processors outside the cooperative queue.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import itertools
+import multiprocessing
+import os
+import pickle
+import sys
+import timeit
+from collections import deque, namedtuple
+
+from twisted.internet import defer, protocol, task, threads
+from twisted.logger import Logger
+from twisted.python.threadpool import ThreadPool
+
+from spreadflow_core.format import PickleMessageBuilder, PickleMessageParser
+
+ExecutorStats = namedtuple('ExecutorStats', ['size', 'queued', 'running', 'busy'])
+PoolJob = namedtuple('PoolJob', ['deferred', 'func', 'item', 'send'])
+
+class ExecutorError(Exception):
+    """
+    Raised when a job failed on a remote executor.
+    """
+
+class WorkerCrashedError(ExecutorError):
+    """
+    Raised when a worker process died while running a job.
+    """
+
+class Executor(object):
+    """
+    Abstract base class for executors.
+
+    Subclasses must implement :meth:`execute` and :meth:`stats`.
+
+    Args:
+        size (int): The maximum number of jobs running at the same time.
+        name (str): A name for the executor, used in log messages.
+        report_interval (float): If given, log statistics every given number
+            of seconds.
+    """
+
+    log = Logger()
+
+    def __init__(self, size, name, report_interval=None):
+        assert size >= 1, 'Pool size must be a positive integer'
+        self.size = size
+        self.name = name
+        self.report_interval = report_interval
+        self._reactor = None
+        self._report_call = None
+        self._busy_reported = 0
+
+    def attach(self, scheduler, reactor):
+        self._reactor = reactor
+
+        if self.report_interval:
+            self._report_call = task.LoopingCall(self.report)
+            self._report_call.clock = reactor
+            self._report_call.start(self.report_interval, now=False)
+
+    def detach(self):
+        if self._report_call is not None:
+            self._report_call.stop()
+            self._report_call = None
+
+    def execute(self, func, item, send):
+        """
+        Run a processor.
+
+        Args:
+            func (callable): The processor.
+            item: The item passed to the processor.
+            send (callable): The send function passed to the processor. It is
+                always invoked on the reactor thread.
+
+        Returns:
+            :class:`twisted.internet.defer.Deferred`: A deferred firing on the
+            reactor thread when the processor returned.
+        """
+        raise NotImplementedError()
+
+    def stats(self):
+        """
+        Returns an :class:`ExecutorStats` tuple recording the pool size, the
+        number of jobs waiting for a worker, the number of jobs running and
+        the total number of seconds workers spent running jobs.
+        """
+        raise NotImplementedError()
+
+    def report(self):
+        """
+        Log the queue depth and the utilization since the last report.
+        """
+        stats = self.stats()
+        busy = stats.busy - self._busy_reported
+        self._busy_reported = stats.busy
+
+        utilization = None
+        if self.report_interval:
+            utilization = busy / (self.report_interval * self.size)
+
+        self.log.info('Executor {name}: {stats.queued} queued, {stats.running} running, utilization {utilization}',
+                      name=self.name, stats=stats, utilization=utilization)
+
+class ThreadPoolExecutor(Executor):
+    """
+    Runs jobs of blocking processors on a dedicated, size-limited thread pool.
+
+    The processor is called on a worker thread. Items sent by the processor
+    are delivered to the scheduler on the reactor thread before the job
+    completes. Hence the ordering guarantees of the input port are unaffected.
+
+    Processors running on a thread pool must not return a deferred and must
+    not touch any reactor APIs.
+
+    Args:
+        size (int): The maximum number of threads. Defaults to 4.
+        name (str): A name for the pool, used in log messages.
+        report_interval (float): If given, log statistics every given number
+            of seconds.
+    """
+
+    def __init__(self, size=4, name=None, report_interval=None):
+        super(ThreadPoolExecutor, self).__init__(
+            size, name or 'spreadflow-threadpool', report_interval)
+        self._pool = None
+        self._pending = 0
+        self._busy = 0
+
+    def attach(self, scheduler, reactor):
+        super(ThreadPoolExecutor, self).attach(scheduler, reactor)
+        self._pool = ThreadPool(minthreads=0, maxthreads=self.size, name=self.name)
+        self._pool.start()
+
+    def detach(self):
+        super(ThreadPoolExecutor, self).detach()
+
+        if self._pool is not None:
+            pool = self._pool
+            self._pool = None
+            pool.stop()
+
+    def execute(self, func, item, send):
+        assert self._pool is not None, 'Must call attach() before'
+
+        reactor = self._reactor
+
+        def _send_from_thread(item, port_out):
+            reactor.callFromThread(self._deliver, send, item, port_out)
+
+        self._pending += 1
+        completed = threads.deferToThreadPool(reactor, self._pool, self._run,
+                                              func, item, _send_from_thread)
+        completed.addBoth(self._job_done)
+        return completed
+
+    def stats(self):
+        running = min(self._pending, self.size)
+        return ExecutorStats(self.size, self._pending - running, running, self._busy)
+
+    def _run(self, func, item, send):
+        """
+        Called on a worker thread.
+        """
+        start = timeit.default_timer()
+        try:
+            result = func(item, send)
+        finally:
+            self._reactor.callFromThread(self._add_busy, timeit.default_timer() - start)
+
+        assert not isinstance(result, defer.Deferred), \
+            'Processor {!s} running on a thread pool must not return a deferred'.format(func)
+
+        return result
+
+    def _deliver(self, send, item, port_out):
+        # Drop items sent by jobs still running after the pool was detached.
+        if self._pool is not None:
+            send(item, port_out)
+
+    def _add_busy(self, seconds):
+        self._busy += seconds
+
+    def _job_done(self, result):
+        self._pending -= 1
+        return result
+
+class PoolWorkerProtocol(protocol.ProcessProtocol):
+    """
+    Process protocol talking to one worker of a process pool.
+
+    Attributes:
+        job: The id of the job currently running on the worker or None.
+        tasks (int): The number of jobs completed by the worker.
+        retired (bool): True if the worker was asked to exit.
+        ended (:class:`twisted.internet.defer.Deferred`): Fires when the
+            worker process terminated.
+    """
+
+    # pylint: disable=invalid-name
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.builder = PickleMessageBuilder()
+        self.parser = PickleMessageParser(2**23)
+        self.keys = set()
+        self.job = None
+        self.started = None
+        self.tasks = 0
+        self.retired = False
+        self.ended = defer.Deferred()
+
+    def send_job(self, job_id, key, func, item):
+        """
+        Send a job to the worker. The processor is pickled only once per
+        worker.
+        """
+        msg = {'job': job_id, 'key': key, 'item': item}
+        if key not in self.keys:
+            msg['func'] = pickle.dumps(func, protocol=self.builder.protocol)
+
+        self.transport.write(self.builder.message(msg))
+        self.keys.add(key)
+        self.job = job_id
+
+    def retire(self):
+        """
+        Ask the worker to exit after completing the current job.
+        """
+        if not self.retired:
+            self.retired = True
+            self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self.parser.push(data)
+        for msg in self.parser.messages():
+            self.executor.job_done(self, msg)
+
+    def processEnded(self, reason):
+        self.executor.worker_ended(self, reason)
+        self.ended.callback(self)
+
+class ProcessPoolExecutor(Executor):
+    """
+    Runs jobs of CPU-bound processors on a pool of worker processes.
+
+    Workers are started when the executor is attached. Each worker runs one
+    job at a time. The processor and the item are pickled and sent to the
+    worker, items sent by the processor are collected and delivered to the
+    scheduler before the job completes.
+
+    Processors running on a process pool must be picklable and must complete
+    synchronously. They may only send items to themselves or to output ports
+    stored in one of their attributes.
+
+    If a worker dies, only the job it was running fails (with a
+    :class:`WorkerCrashedError`) and a new worker is started. Workers exiting
+    before completing any job are replaced as well, unless this happens more
+    often in a row than the pool has workers (e.g., if the worker cannot be
+    started at all). Once no worker is left, new jobs fail right away.
+
+    Args:
+        size (int): The number of worker processes. Defaults to the number of
+            CPUs.
+        max_tasks_per_child (int): Replace workers after they completed the
+            given number of jobs. Defaults to None (never replace workers).
+        name (str): A name for the pool, used in log messages.
+        report_interval (float): If given, log statistics every given number
+            of seconds.
+        worker_args (list): The command line used to start a worker. Defaults
+            to running :mod:`spreadflow_core.scripts.spreadflow_poolworker`
+            with the current interpreter.
+    """
+
+    def __init__(self, size=None, max_tasks_per_child=None, name=None,
+                 report_interval=None, worker_args=None):
+        super(ProcessPoolExecutor, self).__init__(
+            size or multiprocessing.cpu_count(), name or 'spreadflow-processpool',
+            report_interval)
+        self.max_tasks_per_child = max_tasks_per_child
+        self.worker_args = worker_args or [
+            sys.executable, '-m', 'spreadflow_core.scripts.spreadflow_poolworker']
+        self._attached = False
+        self._workers = []
+        self._idle = deque()
+        self._backlog = deque()
+        self._jobs = {}
+        self._ids = itertools.count()
+        self._keys = {}
+        self._busy = 0
+        # Number of workers in a row which exited before completing a job.
+        self._premature = 0
+
+    def attach(self, scheduler, reactor):
+        super(ProcessPoolExecutor, self).attach(scheduler, reactor)
+        self._attached = True
+        for _ in range(self.size):
+            self._spawn()
+
+    def detach(self):
+        super(ProcessPoolExecutor, self).detach()
+        self._attached = False
+
+        workers = list(self._workers)
+        for worker in workers:
+            worker.retire()
+
+        return defer.DeferredList([worker.ended for worker in workers])
+
+    def execute(self, func, item, send):
+        assert self._attached, 'Must call attach() before'
+
+        if not self._workers:
+            return defer.fail(WorkerCrashedError('No worker left in {:s}'.format(self.name)))
+
+        job_id = next(self._ids)
+        completed = defer.Deferred(lambda dfr: self._job_cancel(job_id))
+        self._jobs[job_id] = PoolJob(completed, func, item, send)
+        self._backlog.append(job_id)
+        self._dispatch()
+
+        return completed
+
+    def stats(self):
+        running = sum(1 for worker in self._workers if worker.job in self._jobs)
+        return ExecutorStats(self.size, len(self._jobs) - running, running, self._busy)
+
+    def job_done(self, worker, msg):
+        """
+        Called by the worker protocol when a job completed.
+        """
+        self._busy += self._reactor.seconds() - worker.started
+        worker.job = None
+        worker.tasks += 1
+        self._premature = 0
+
+        if self.max_tasks_per_child and worker.tasks >= self.max_tasks_per_child:
+            worker.retire()
+            if self._attached:
+                self._spawn()
+        elif not worker.retired:
+            self._idle.append(worker)
+
+        # The job is gone if it was cancelled in the meantime.
+        job = self._jobs.pop(msg['job'], None)
+        if job is not None:
+            if 'error' in msg:
+                job.deferred.errback(ExecutorError(msg['error']))
+            else:
+                for item, ref in msg['sends']:
+                    if self._attached:
+                        port_out = job.func if ref is None else getattr(job.func, ref)
+                        job.send(item, port_out)
+                job.deferred.callback(None)
+
+        self._dispatch()
+
+    def worker_ended(self, worker, reason):
+        """
+        Called by the worker protocol when the worker process terminated.
+        """
+        self._workers.remove(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+
+        job_id = worker.job
+        worker.job = None
+
+        # Replace workers which died unexpectedly. Give up if workers keep
+        # exiting without doing any work (e.g., if they cannot be started).
+        if self._attached and not worker.retired:
+            if worker.tasks or job_id is not None:
+                self._spawn()
+            else:
+                self._premature += 1
+                if self._premature <= self.size:
+                    self.log.warn('Worker of {name} exited prematurely, replacing it: {reason}',
+                                  name=self.name, reason=reason.value)
+                    self._spawn()
+                else:
+                    self.log.error('Worker of {name} exited prematurely: {reason}',
+                                   name=self.name, reason=reason.value)
+
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            self.log.error('Worker of {name} died while running {func}: {reason}',
+                           name=self.name, func=job.func, reason=reason.value)
+            job.deferred.errback(WorkerCrashedError(str(reason.value)))
+
+        self._dispatch()
+
+    def _spawn(self):
+        worker = PoolWorkerProtocol(self)
+        self._reactor.spawnProcess(worker, self.worker_args[0], self.worker_args,
+                                   env=os.environ.copy(), childFDs={0: 'w', 1: 'r', 2: 2})
+        self._workers.append(worker)
+        self._idle.append(worker)
+
+    def _dispatch(self):
+        while self._idle and self._backlog:
+            job_id = self._backlog.popleft()
+            job = self._jobs.get(job_id)
+            if job is None:
+                # Cancelled while waiting.
+                continue
+
+            worker = self._idle.popleft()
+            key = self._keys.setdefault(job.func, len(self._keys))
+            try:
+                worker.send_job(job_id, key, job.func, job.item)
+            except Exception: # pylint: disable=broad-except
+                self._idle.appendleft(worker)
+                del self._jobs[job_id]
+                job.deferred.errback()
+            else:
+                worker.started = self._reactor.seconds()
+
+    def _job_cancel(self, job_id):
+        # Results of cancelled jobs are discarded when they arrive.
+        self._jobs.pop(job_id, None)
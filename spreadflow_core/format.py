@@ -10,10 +10,34 @@ import pickle
 import pickletools
 import json
 
+try:
+    _buffer = buffer # pylint: disable=undefined-variable
+except NameError:
+    _buffer = None
+
+if _buffer is not None:
+    def _loads(data, start, end):
+        """
+        Unpickles a slice of a bytearray without copying it.
+        """
+        return pickle.loads(_buffer(data, start, end - start))
+else:
+    def _loads(data, start, end):
+        """
+        Unpickles a slice of a bytearray without copying it.
+        """
+        with memoryview(data) as view, view[start:end] as frame:
+            return pickle.loads(frame)
+
 class PickleMessageParser(object):
     """
     Message parser for the pickle stream format.
 
+    Incoming data is appended to a growable buffer and messages are decoded
+    straight from it. Consumed frames are discarded lazily on the next push,
+    and the header of an incomplete frame is only parsed once. Hence, a large
+    message arriving in many small chunks is copied only once.
+
     Args:
         buffer_max_len (int): The maximum number of bytes buffered while
             parsing a stream of incoming messages. Defaults to 32768.
@@ -24,7 +48,12 @@ class PickleMessageParser(object):
 
     def __init__(self, buffer_max_len=MAX_LENGTH):
         self._buffer_max_len = buffer_max_len
-        self._buffer = b''
+        self._buffer = bytearray()
+        # Start of the first frame which was not decoded yet.
+        self._offset = 0
+        # Header and total length of that frame, once its header is known.
+        self._header_len = 0
+        self._frame_len = 0
 
     def push(self, data):
         """
@@ -37,9 +66,13 @@ class PickleMessageParser(object):
         Raises:
             RuntimeError: If the buffer is full.
         """
-        if len(self._buffer) + len(data) > self._buffer_max_len:
+        if len(self._buffer) - self._offset + len(data) > self._buffer_max_len:
             raise RuntimeError('Buffer length exceeded')
 
+        if self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+
         self._buffer += data
 
     def messages(self):
@@ -49,28 +82,34 @@ class PickleMessageParser(object):
         Yields:
             object: The next decoded message.
         """
-        frame_start = 0
+        while True:
+            frame_start = self._offset
 
-        while self._buffer.find(b'.', frame_start, frame_start + self.HEADER_MAX_LEN) > -1:
-            header = self._buffer[frame_start:frame_start + self.HEADER_MAX_LEN]
-            header_len = list(pickletools.genops(header))[-1][2]+1
+            if not self._frame_len:
+                if self._buffer.find(b'.', frame_start, frame_start + self.HEADER_MAX_LEN) < 0:
+                    break
 
-            doc_len = pickle.loads(header[:header_len])
+                header = bytes(self._buffer[frame_start:frame_start + self.HEADER_MAX_LEN])
+                header_len = list(pickletools.genops(header))[-1][2]+1
 
-            if not isinstance(doc_len, int) or doc_len < 0:
-                raise ValueError('Document length must be a positive integer')
+                doc_len = pickle.loads(header[:header_len])
 
-            doc_start = frame_start + header_len
-            doc_end = doc_start + doc_len
+                if not isinstance(doc_len, int) or doc_len < 0:
+                    raise ValueError('Document length must be a positive integer')
 
-            if doc_end > len(self._buffer):
+                self._header_len = header_len
+                self._frame_len = header_len + doc_len
+
+            frame_end = frame_start + self._frame_len
+            if frame_end > len(self._buffer):
                 break
 
-            yield pickle.loads(self._buffer[doc_start:doc_end])
+            message = _loads(self._buffer, frame_start + self._header_len, frame_end)
 
-            frame_start += header_len + doc_len
+            self._offset = frame_end
+            self._frame_len = 0
 
-        self._buffer = self._buffer[frame_start:]
+            yield message
 
 
 class PickleMessageBuilder(object):
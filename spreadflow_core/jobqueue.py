@@ -9,15 +9,78 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+import bisect
 import collections
+import time
 
 from twisted.internet import defer
 
 class QueueNoneReady(Exception):
     pass
 
+class JobExpiredError(Exception):
+    """
+    Raised when a job was dropped from the backlog because it waited beyond
+    its time to live or its deadline.
+    """
+
+ALL_CHANNELS = object()
+
 Job = collections.namedtuple("Job", ["channel", "func", "args", "kwds"])
 Entry = collections.namedtuple("Entry", ["deferred", "job"])
+ChannelSettings = collections.namedtuple("ChannelSettings", ["concurrency", "priority", "weight", "ttl"])
+WaitStats = collections.namedtuple("WaitStats", ["count", "total", "maximum"])
+
+DEFAULT_SETTINGS = ChannelSettings(concurrency=1, priority=0, weight=1, ttl=None)
+
+class ChannelState(object):
+    """
+    Bookkeeping for a single channel.
+
+    Attributes:
+        backlog (collections.deque): Entries waiting for execution in FIFO
+            order. May contain entries which were cancelled already.
+        size (int): The number of entries in the backlog which are still
+            waiting for execution.
+        running (int): The number of jobs currently executing.
+        ready (bool): Whether or not the channel is in the ready queue of its
+            lane.
+        deficit (int): Number of jobs the channel may start before the next
+            channel in its lane gets its turn (deficit round robin).
+        concurrency (int): The maximum number of jobs executing at the same
+            time.
+        priority (int): The lane this channel is served from.
+        weight (int): The number of jobs the channel may start per round.
+        ttl (float): The maximum number of seconds a job may wait in the
+            backlog or None.
+    """
+
+    def __init__(self, settings=DEFAULT_SETTINGS):
+        self.backlog = collections.deque()
+        self.size = 0
+        self.running = 0
+        self.ready = False
+        self.deficit = 0
+        self.concurrency, self.priority, self.weight, self.ttl = settings
+
+class LaneStats(object):
+    """
+    Wait time statistics for a priority lane.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, wait):
+        """
+        Record the time a job waited in the backlog.
+        """
+        self.count += 1
+        self.total += wait
+        if wait > self.maximum:
+            self.maximum = wait
 
 class JobQueue(collections.Iterator):
     """Cooperative job queue.
@@ -28,7 +91,8 @@ class JobQueue(collections.Iterator):
     A job is any callable together with positional and keyword arguments.
     Results returned by a job are passed back to the caller by a deferred. If
     the job itself returns a deferred, any queued jobs on the same channel are
-    blocked until a result becomes available.
+    blocked until a result becomes available. Use :meth:`set_concurrency` in
+    order to allow more than one job in flight on a channel.
 
     Example:
 
@@ -79,14 +143,75 @@ class JobQueue(collections.Iterator):
             what?
             world!
 
+    Channels are grouped into priority lanes. Channels in the lane with the
+    lowest priority value are always served first. Within a lane, channels are
+    served using deficit round robin: Every time a channel gets its turn, it
+    may start as many jobs as its weight (see :meth:`set_priority`). The time
+    jobs spend waiting in the backlog is recorded for every lane (see
+    :meth:`lane_stats`).
+
+    Jobs may expire. A job which waited in the backlog for longer than the
+    time to live of its channel (see :meth:`set_ttl`) or beyond its deadline
+    (see :meth:`set_deadline`) is not run. Instead its deferred fails with a
+    :class:`JobExpiredError`. Expiry is checked when a job is about to be
+    started, hence dropping a job takes constant time and the backlog is
+    never searched for expired jobs.
+
+    The backlog may optionally be bounded. The limits are not enforced by
+    :meth:`put`, jobs are never rejected. Instead the queue is marked as
+    congested when a limit is reached and callers are expected to slow down
+    until the backlog drained below the low-water mark (see :meth:`writable`
+    and :meth:`wait_writable`).
+
+    Args:
+        limit (int): The maximum number of jobs in the backlog (all channels).
+            Defaults to None (unlimited).
+        channel_limit (int): The maximum number of jobs in the backlog of a
+            single channel. Defaults to None (unlimited).
+        lowat (float): Fraction of the limits below which the backlog must
+            drain before a congested queue or channel becomes writable again.
+            Defaults to 0.5.
+        batch_size (int): The maximum number of jobs started by one iteration.
+            Defaults to 1.
+        batch_duration (float): Stop starting jobs within one iteration after
+            the given number of seconds. Defaults to None (no time budget).
+        inline_depth (int): The maximum number of jobs :meth:`execute` may
+            run nested inside each other. Defaults to 0 (never run jobs
+            inline).
+        seconds (callable): A function returning the current time. Defaults
+            to :func:`time.time`.
     """
 
-    def __init__(self):
-        self._backlog = []
+    def __init__(self, limit=None, channel_limit=None, lowat=0.5,
+                 batch_size=1, batch_duration=None, inline_depth=0,
+                 seconds=time.time):
+        self._channels = {}
+        self._settings = {}
+        self._lanes = {}
+        self._lane_stats = {}
+        self._priorities = []
+        self._queued = {}
         self._jobs = {}
+        self._deadlines = {}
         self._wakeup = None
         self._stopempty = False
 
+        assert batch_size >= 1, 'Batch size must be a positive integer'
+        self._batch_size = batch_size
+        self._batch_duration = batch_duration
+        self._deadline = None
+        self._seconds = seconds
+
+        self._inline_depth = inline_depth
+        self._depth = 0
+
+        self._limit = limit
+        self._lowat = None if limit is None else int(limit * lowat)
+        self._channel_limit = channel_limit
+        self._channel_lowat = None if channel_limit is None else int(channel_limit * lowat)
+        self._congested = set()
+        self._writable_waiters = []
+
     def put(self, channel, func, *args, **kwds):
         """
         Queue up a job for later execution on a specified channel.
@@ -106,36 +231,321 @@ class JobQueue(collections.Iterator):
         """
         job = Job(channel, func, args, kwds)
         completed = defer.Deferred(lambda dfr: self._job_cancel(Entry(dfr, job)))
+        entry = Entry(completed, job)
+
+        try:
+            state = self._channels[channel]
+        except KeyError:
+            state = self._channels[channel] = ChannelState(
+                self._settings.get(channel, DEFAULT_SETTINGS))
+
+        state.backlog.append(entry)
+        state.size += 1
+        self._queued[completed] = self._seconds()
+
+        if self._channel_limit is not None and state.size >= self._channel_limit:
+            self._congested.add(channel)
+        if self._limit is not None and len(self._queued) >= self._limit:
+            self._congested.add(ALL_CHANNELS)
+
+        if not state.ready and state.running < state.concurrency:
+            self._schedule(channel, state)
 
-        self._backlog.append(Entry(completed, job))
         self._wake()
 
         return completed
 
+    def execute(self, channel, func, *args, **kwds):
+        """
+        Run a job immediately if possible, queue it up otherwise.
+
+        The job is run inline (i.e., before this method returns) if all of
+        the following conditions are met:
+
+        * This method is called from within a running job.
+        * The channel is idle, i.e., there are no jobs waiting in its backlog
+          and its concurrency limit is not reached.
+        * Less than `inline_depth` jobs are running nested inside each other.
+        * The time budget of the current iteration is not used up (see
+          `batch_duration`).
+
+        Jobs run inline are not accounted for in the lane statistics.
+
+        Args:
+            See :meth:`put`.
+
+        Returns:
+            :class:`twisted.internet.defer.Deferred`: A deferred firing when the
+            job completed. If the job was run inline and finished
+            synchronously, the deferred has already fired.
+        """
+        if not 0 < self._depth <= self._inline_depth:
+            return self.put(channel, func, *args, **kwds)
+
+        if self._deadline is not None and self._seconds() >= self._deadline:
+            return self.put(channel, func, *args, **kwds)
+
+        state = self._channels.get(channel)
+        if state is None:
+            state = self._channels[channel] = ChannelState(
+                self._settings.get(channel, DEFAULT_SETTINGS))
+        elif state.size or state.running >= state.concurrency:
+            return self.put(channel, func, *args, **kwds)
+
+        job = Job(channel, func, args, kwds)
+        completed = defer.Deferred(lambda dfr: self._job_cancel(Entry(dfr, job)))
+        state.running += 1
+        self._run(completed, job)
+
+        return completed
+
+    def set_concurrency(self, channel, concurrency):
+        """
+        Set the maximum number of jobs in flight on a channel.
+
+        Args:
+            channel: The channel.
+            concurrency (int): The maximum number of jobs executing at the same
+                time. Defaults to 1 for channels which are not configured
+                explicitly. Jobs are still started in FIFO order, but they
+                may complete in any order if concurrency is greater than one.
+        """
+        assert concurrency >= 1, 'Concurrency must be a positive integer'
+
+        settings = self._settings.get(channel, DEFAULT_SETTINGS)
+        self._settings[channel] = settings._replace(concurrency=concurrency)
+
+        state = self._channels.get(channel)
+        if state is not None:
+            state.concurrency = concurrency
+            if state.size and not state.ready and state.running < concurrency:
+                self._schedule(channel, state)
+                self._wake()
+
+    def set_priority(self, channel, priority=0, weight=1):
+        """
+        Set the lane and the weight of a channel.
+
+        Args:
+            channel: The channel.
+            priority (int): Channels with a lower priority value are served
+                first. Defaults to 0.
+            weight (int): The number of jobs the channel may start before the
+                next channel in the same lane gets its turn. Defaults to 1.
+        """
+        assert weight >= 1, 'Weight must be a positive integer'
+
+        settings = self._settings.get(channel, DEFAULT_SETTINGS)
+        self._settings[channel] = settings._replace(priority=priority, weight=weight)
+
+        # A channel waiting in a lane is moved the next time it gets ready.
+        state = self._channels.get(channel)
+        if state is not None:
+            state.priority = priority
+            state.weight = weight
+
+    def set_ttl(self, channel, ttl):
+        """
+        Set the time to live of jobs waiting in the backlog of a channel.
+
+        Args:
+            channel: The channel.
+            ttl (float): The maximum number of seconds a job may wait in the
+                backlog before it expires. Pass None in order to keep jobs
+                forever (the default).
+        """
+        assert ttl is None or ttl >= 0, 'TTL must not be negative'
+
+        settings = self._settings.get(channel, DEFAULT_SETTINGS)
+        self._settings[channel] = settings._replace(ttl=ttl)
+
+        state = self._channels.get(channel)
+        if state is not None:
+            state.ttl = ttl
+
+    def set_deadline(self, deferred, deadline):
+        """
+        Set the deadline of a job waiting in the backlog.
+
+        Args:
+            deferred: The deferred returned by :meth:`put` or :meth:`execute`.
+            deadline (float): The job expires if it did not start before the
+                given point in time (as returned by the `seconds` function of
+                the queue).
+        """
+        if deferred in self._queued:
+            self._deadlines[deferred] = deadline
+
+    def lane_stats(self, reset=False):
+        """
+        Returns wait time statistics for every lane.
+
+        Args:
+            reset (bool): Reset the statistics after reading them.
+
+        Returns:
+            dict: A map priority -> :class:`WaitStats` recording the number of
+            jobs started, the total and the maximum number of seconds they
+            waited in the backlog.
+        """
+        result = {}
+        for priority, stats in self._lane_stats.items():
+            result[priority] = WaitStats(stats.count, stats.total, stats.maximum)
+            if reset:
+                self._lane_stats[priority] = LaneStats()
+        return result
+
     def get(self):
         """
         Removes and returns the first item in the queue where the channel is
         ready.
 
+        Picking the next job takes constant time regardless of the number of
+        queued jobs (and linear time in the number of distinct priorities).
+        Expired jobs encountered on the way are dropped and their deferreds
+        fail with a :class:`JobExpiredError`.
+
         Returns
-            tuple: A 5-tuple containing the channel, func, args, kwds, deferred
+            tuple: A 2-tuple containing the deferred and the job.
 
         Raises:
             spreadflow_core.jobqueue.QueueNoneReady: Raised if there is either
                 no item ready or no channel.
         """
-        active_channels = set([job.channel for _, job in self._jobs.values()])
-        for idx, (_, job) in enumerate(self._backlog):
-            if job.channel not in active_channels:
-                return self._backlog.pop(idx)
+        expired = []
+        try:
+            return self._get(expired)
+        finally:
+            for entry in expired:
+                entry.deferred.errback(JobExpiredError(
+                    'Job expired on channel {!s}'.format(entry.job.channel)))
+
+    def _get(self, expired):
+        """
+        Implements :meth:`get`. Expired entries are appended to the given list.
+        """
+        for priority in self._priorities:
+            lane = self._lanes[priority]
+            while lane:
+                channel = lane[0]
+                state = self._channels[channel]
+
+                # Skip over entries which were cancelled while waiting in the
+                # backlog and drop expired ones.
+                queued = None
+                while state.backlog:
+                    entry = state.backlog.popleft()
+                    queued = self._queued.pop(entry.deferred, None)
+                    if queued is None:
+                        continue
+                    if (state.ttl is not None or self._deadlines) and self._expired(entry, queued, state):
+                        expired.append(entry)
+                        state.size -= 1
+                        queued = None
+                        continue
+                    break
+
+                if queued is None:
+                    lane.popleft()
+                    state.ready = False
+                    state.deficit = 0
+                    if not state.running:
+                        del self._channels[channel]
+                    if expired and self._congested:
+                        self._relieve(channel, state)
+                    continue
+
+                self._lane_stats[priority].add(self._seconds() - queued)
+
+                if state.deficit < 1:
+                    state.deficit += state.weight
+                state.deficit -= 1
+                state.size -= 1
+                state.running += 1
+
+                if not state.size or state.running >= state.concurrency:
+                    # Channel is exhausted or busy, keep the deficit if there
+                    # are jobs left.
+                    lane.popleft()
+                    state.ready = False
+                    if not state.size:
+                        state.deficit = 0
+                elif state.deficit < 1 or state.priority != priority:
+                    # Turn is over, move channel to the end of its lane.
+                    lane.popleft()
+                    self._schedule(channel, state)
+
+                if self._congested:
+                    self._relieve(channel, state)
+
+                return entry
 
         raise QueueNoneReady()
 
+    def _expired(self, entry, queued, state):
+        """
+        Returns True if the given entry expired.
+        """
+        deadline = self._deadlines.pop(entry.deferred, None)
+        if state.ttl is not None and (deadline is None or queued + state.ttl < deadline):
+            deadline = queued + state.ttl
+        return deadline is not None and self._seconds() >= deadline
+
     def clear(self):
         """
         Clears the backlog.
         """
-        self._backlog = []
+        for channel, state in list(self._channels.items()):
+            state.backlog.clear()
+            state.size = 0
+            state.ready = False
+            state.deficit = 0
+            if not state.running:
+                del self._channels[channel]
+
+        for lane in self._lanes.values():
+            lane.clear()
+        self._queued.clear()
+        self._deadlines.clear()
+
+        if self._congested:
+            self._congested.clear()
+            self._notify_writable()
+
+    def writable(self, channel=None):
+        """
+        Returns True if the queue is willing to accept more jobs.
+
+        Args:
+            channel: If given, only the backlog limit of this channel and the
+                global limit are taken into account. Otherwise returns False
+                if any channel is congested.
+
+        Returns:
+            bool: True unless the backlog is congested.
+        """
+        if channel is None:
+            return not self._congested
+        else:
+            return ALL_CHANNELS not in self._congested and channel not in self._congested
+
+    def wait_writable(self, channel=None):
+        """
+        Returns a deferred which fires as soon as the queue is writable.
+
+        Args:
+            channel: See :meth:`writable`.
+
+        Returns:
+            :class:`twisted.internet.defer.Deferred`: A deferred firing once
+            the backlog drained below the low-water mark.
+        """
+        if self.writable(channel):
+            return defer.succeed(None)
+
+        waiting = defer.Deferred()
+        self._writable_waiters.append((channel, waiting))
+        return waiting
 
     @property
     def stopempty(self):
@@ -154,22 +564,27 @@ class JobQueue(collections.Iterator):
         """
         Implements :meth:`iterator.__next__` (Python >= 3)
         """
-        if self.stopempty and len(self._backlog) == 0 and len(self._jobs) == 0:
+        if self.stopempty and len(self._queued) == 0 and len(self._jobs) == 0:
             raise StopIteration()
 
-        try:
-            completed, job = self.get()
-        except QueueNoneReady:
-            if not self._wakeup:
-                self._wakeup = defer.Deferred()
-        else:
-            defered = defer.maybeDeferred(job.func, *job.args, **job.kwds)
+        deadline = None
+        if self._batch_duration is not None:
+            deadline = self._deadline = self._seconds() + self._batch_duration
+
+        started = 0
+        while started < self._batch_size:
+            try:
+                completed, job = self.get()
+            except QueueNoneReady:
+                if not started and not self._wakeup:
+                    self._wakeup = defer.Deferred()
+                break
+
+            self._run(completed, job)
+            started += 1
 
-            defered.pause()
-            self._jobs[completed] = Entry(defered, job)
-            defered.addBoth(self._job_callback, completed)
-            defered.chainDeferred(completed)
-            defered.unpause()
+            if deadline is not None and self._seconds() >= deadline:
+                break
 
         return self._wakeup
 
@@ -179,6 +594,40 @@ class JobQueue(collections.Iterator):
         """
         return self.__next__()
 
+    def _run(self, completed, job):
+        """
+        Execute a job and arrange for the channel to be freed up afterwards.
+        """
+        self._depth += 1
+        try:
+            defered = defer.maybeDeferred(job.func, *job.args, **job.kwds)
+        finally:
+            self._depth -= 1
+
+        defered.pause()
+        self._jobs[completed] = Entry(defered, job)
+        defered.addBoth(self._job_callback, completed)
+        defered.chainDeferred(completed)
+        defered.unpause()
+
+    def _schedule(self, channel, state):
+        """
+        Add a channel to the ready queue of its lane. A channel which did not
+        use up its turn is put in front.
+        """
+        try:
+            lane = self._lanes[state.priority]
+        except KeyError:
+            lane = self._lanes[state.priority] = collections.deque()
+            self._lane_stats[state.priority] = LaneStats()
+            bisect.insort(self._priorities, state.priority)
+
+        state.ready = True
+        if state.deficit >= 1:
+            lane.appendleft(channel)
+        else:
+            lane.append(channel)
+
     def _wake(self):
         """
         Run the wakeup callback in order to signal that there are jobs waiting
@@ -188,11 +637,50 @@ class JobQueue(collections.Iterator):
             self._wakeup.callback(self)
             self._wakeup = None
 
+    def _relieve(self, channel, state):
+        """
+        Remove congestion marks if the backlog drained below the low-water
+        mark.
+        """
+        relieved = False
+
+        if channel in self._congested and state.size <= self._channel_lowat:
+            self._congested.discard(channel)
+            relieved = True
+
+        if ALL_CHANNELS in self._congested and len(self._queued) <= self._lowat:
+            self._congested.discard(ALL_CHANNELS)
+            relieved = True
+
+        if relieved:
+            self._notify_writable()
+
+    def _notify_writable(self):
+        """
+        Fire deferreds waiting for the queue to become writable.
+        """
+        waiters = self._writable_waiters
+        self._writable_waiters = []
+
+        for channel, waiting in waiters:
+            if self.writable(channel):
+                waiting.callback(None)
+            else:
+                self._writable_waiters.append((channel, waiting))
+
     def _job_callback(self, result, completed):
         """
         Free up the channel after a job has completed.
         """
-        self._jobs.pop(completed)
+        _, job = self._jobs.pop(completed)
+
+        state = self._channels[job.channel]
+        state.running -= 1
+        if state.size and not state.ready:
+            self._schedule(job.channel, state)
+        elif not state.running and not state.ready:
+            del self._channels[job.channel]
+
         self._wake()
         return result
 
@@ -205,11 +693,17 @@ class JobQueue(collections.Iterator):
             subtask.cancel()
             return
 
-        try:
-            self._backlog.remove(entry)
-        except ValueError:
-            pass
-        else:
+        if self._queued.pop(entry.deferred, None) is not None:
+            self._deadlines.pop(entry.deferred, None)
+            # Leave the entry in the channel backlog (and the channel in the
+            # ready queue), it is skipped over when the channel is served next
+            # time.
+            state = self._channels[entry.job.channel]
+            state.size -= 1
+            if not state.size:
+                state.backlog.clear()
+            if self._congested:
+                self._relieve(entry.job.channel, state)
             return
 
         assert 0, "Failed to cancel a job which is neither in backlog nor in jobs"
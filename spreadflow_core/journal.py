@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+Write-ahead journal for the scheduler backlog.
+
+Records every job enqueued and completed in an append-only file such that
+items which never completed can be replayed after a restart.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+from collections import OrderedDict
+
+from twisted.logger import Logger
+
+from spreadflow_core.format import PickleMessageBuilder, PickleMessageParser
+
+class Journal(object):
+    """
+    Append-only on-disk journal of enqueued and completed jobs.
+
+    Records are buffered and written in batches (group commit). A batch is
+    written and synced to disk at most `commit_interval` seconds after the
+    first record was buffered or as soon as it exceeds `commit_size` bytes.
+    Jobs enqueued and completed within the same batch never hit the disk.
+
+    The file is compacted whenever the fraction of records describing jobs
+    which are still pending drops below `compact_ratio`.
+
+    Ports are identified by their position in the list given to the
+    constructor. Hence the journal can only be replayed if the flow is built
+    from the same configuration.
+
+    Args:
+        path (str): Path to the journal file.
+        ports (list): The input ports, in a stable order.
+        commit_interval (float): Maximum number of seconds records are
+            buffered. Defaults to 0.1.
+        commit_size (int): Maximum number of bytes buffered. Defaults to
+            1 MiB.
+        compact_ratio (float): Compact the file if less than this fraction
+            of records is alive. Defaults to 0.25.
+        compact_min (int): Never compact files with less records. Defaults to
+            10000.
+        fsync (bool): Sync the file to disk after every batch. Defaults to
+            True.
+    """
+
+    log = Logger()
+
+    def __init__(self, path, ports, commit_interval=0.1, commit_size=2**20,
+                 compact_ratio=0.25, compact_min=10000, fsync=True):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.fsync = fsync
+
+        self._ports = list(ports)
+        self._port_ids = {port: idx for idx, port in enumerate(self._ports)}
+        self._builder = PickleMessageBuilder()
+
+        self._file = None
+        self._reactor = None
+        self._commit_call = None
+        self._seq = 0
+
+        # Records written to the file: seq -> encoded put record of jobs
+        # still pending.
+        self._live = {}
+        self._records = 0
+
+        # Records waiting for the next commit.
+        self._pending_puts = OrderedDict()
+        self._pending_dones = []
+        self._pending_size = 0
+
+    def open(self, reactor):
+        """
+        Open the journal and read back items of jobs which never completed.
+
+        The records of these jobs are kept in the journal. Call :meth:`done`
+        with the sequence number once a replayed job completed.
+
+        Returns:
+            list: A list of (seq, port, item) tuples in the order the items
+            were originally enqueued.
+        """
+        self._reactor = reactor
+
+        records = OrderedDict()
+        if os.path.exists(self.path):
+            for record in self._read():
+                if isinstance(record, tuple):
+                    seq = record[0]
+                    records[seq] = record
+                else:
+                    seq = record
+                    records.pop(seq, None)
+                self._seq = max(self._seq, seq)
+
+        replay = []
+        self._live = {}
+        for seq, (_, port_id, item) in records.items():
+            if port_id < len(self._ports):
+                replay.append((seq, self._ports[port_id], item))
+                self._live[seq] = self._builder.message(records[seq])
+            else:
+                self.log.warn('Dropping journaled item for unknown port {port_id}', port_id=port_id)
+
+        # Start over with a compacted file.
+        self._rewrite()
+
+        return replay
+
+    def put(self, port, item):
+        """
+        Record a job enqueued on the given port.
+
+        Returns:
+            int: The sequence number of the record or None if the port is not
+            journaled.
+        """
+        try:
+            port_id = self._port_ids[port]
+        except KeyError:
+            return None
+
+        self._seq += 1
+        seq = self._seq
+        data = self._builder.message((seq, port_id, item))
+        self._pending_puts[seq] = data
+        self._pending_size += len(data)
+        self._schedule_commit()
+
+        return seq
+
+    def done(self, seq):
+        """
+        Record a completed job.
+        """
+        data = self._pending_puts.pop(seq, None)
+        if data is not None:
+            # Never written, forget about it.
+            self._pending_size -= len(data)
+        elif seq in self._live:
+            self._pending_dones.append(seq)
+            self._pending_size += 8
+            self._schedule_commit()
+
+    def commit(self):
+        """
+        Write buffered records to disk.
+        """
+        if self._commit_call is not None:
+            if self._commit_call.active():
+                self._commit_call.cancel()
+            self._commit_call = None
+
+        if not self._pending_puts and not self._pending_dones:
+            return
+
+        chunks = []
+        for seq, data in self._pending_puts.items():
+            chunks.append(data)
+            self._live[seq] = data
+        for seq in self._pending_dones:
+            chunks.append(self._builder.message(seq))
+            self._live.pop(seq, None)
+
+        self._records += len(self._pending_puts) + len(self._pending_dones)
+        self._pending_puts = OrderedDict()
+        self._pending_dones = []
+        self._pending_size = 0
+
+        self._file.write(b''.join(chunks))
+        self._sync(self._file)
+
+        if self._records >= self.compact_min and len(self._live) < self._records * self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal file such that it only contains pending jobs.
+        """
+        self.log.debug('Compacting journal {path}: {live} of {records} records alive',
+                       path=self.path, live=len(self._live), records=self._records)
+        self._rewrite()
+
+    def close(self):
+        """
+        Commit buffered records and close the file.
+        """
+        if self._file is not None:
+            self.commit()
+            self._file.close()
+            self._file = None
+
+    def _schedule_commit(self):
+        if self._pending_size >= self.commit_size:
+            self.commit()
+        elif self._commit_call is None:
+            self._commit_call = self._reactor.callLater(self.commit_interval, self.commit)
+
+    def _rewrite(self):
+        if self._file is not None:
+            self._file.close()
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as temp:
+            temp.write(b''.join(self._live[seq] for seq in sorted(self._live)))
+            self._sync(temp)
+        os.rename(temp_path, self.path)
+
+        self._records = len(self._live)
+        self._file = open(self.path, 'ab')
+
+    def _read(self):
+        with open(self.path, 'rb') as journal:
+            data = journal.read()
+
+        parser = PickleMessageParser(len(data))
+        parser.push(data)
+        try:
+            for record in parser.messages():
+                yield record
+        except Exception: # pylint: disable=broad-except
+            self.log.failure('Journal {path} is corrupt, ignoring the remainder', path=self.path)
+
+    def _sync(self, fileobj):
+        fileobj.flush()
+        if self.fsync:
+            os.fsync(fileobj.fileno())
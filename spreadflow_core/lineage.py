@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sampled lineage tracing.
+
+A fraction of the items entering a flow is sampled. Sampled items carry a
+:class:`TraceContext` which is handed down to every item sent while
+processing them, also across process boundaries. For every hop, the time the
+item was enqueued on an input port, the time the job started and the time it
+completed are recorded. Finished traces can be exported in the Chrome
+trace-event format and inspected as a timeline, e.g. with chrome://tracing or
+Perfetto.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import itertools
+import json
+import os
+import random
+import time
+from collections import OrderedDict, namedtuple
+
+TraceContext = namedtuple('TraceContext', ['trace_id', 'hop'])
+TraceSpan = namedtuple('TraceSpan', ['trace_id', 'hop', 'port', 'enter', 'start', 'exit', 'pid'])
+
+class TraceHop(object):
+    """
+    A hop of a sampled item in progress.
+
+    Attributes:
+        context (TraceContext): The trace context of the item.
+        port: The input port.
+        enter (float): The time the item was enqueued.
+        start (float): The time the job started or None.
+    """
+
+    __slots__ = ('context', 'port', 'enter', 'start')
+
+    def __init__(self, context, port, enter):
+        self.context = context
+        self.port = port
+        self.enter = enter
+        self.start = None
+
+class LineageTracer(object):
+    """
+    Samples items and collects the hops of sampled items.
+
+    A trace is finished as soon as no hop of it is in progress anymore. Only
+    the most recent `max_traces` finished traces are kept.
+
+    Args:
+        sample_rate (float): The fraction of items entering the flow which is
+            sampled. A tracer with a sample rate of 0 only follows traces
+            started elsewhere, e.g. in the controlling process.
+        labels (dict): A map port -> label used to name hops.
+        max_traces (int): The maximum number of finished traces kept.
+            Defaults to 1000.
+        seconds (callable): A function returning the current time. Defaults
+            to :func:`time.time` such that spans recorded by different
+            processes line up.
+        random (callable): A function returning a random float in [0, 1).
+
+    Attributes:
+        current (TraceContext): The context of the job currently running on
+            the reactor thread, None if the job was not sampled.
+        forward (callable): If set, finished traces are passed to this
+            function as a list of spans instead of being kept. Used by worker
+            processes in order to ship spans to the controller.
+    """
+
+    def __init__(self, sample_rate, labels=None, max_traces=1000,
+                 seconds=time.time, random=random.random): # pylint: disable=redefined-outer-name
+        self.sample_rate = sample_rate
+        self.labels = labels or {}
+        self.max_traces = max_traces
+        self.seconds = seconds
+        self.random = random
+        self.pid = os.getpid()
+        self.current = None
+        self.forward = None
+
+        self._ids = itertools.count(1)
+        self._active = {}
+        self._spans = {}
+        self._finished = OrderedDict()
+
+    def sample(self):
+        """
+        Returns a new trace context or None if the item is not sampled.
+        """
+        if self.sample_rate and self.random() < self.sample_rate:
+            return TraceContext(next(self._ids), 0)
+
+    def enter(self, parent, port):
+        """
+        Record an item sent on behalf of a sampled item arriving at an input
+        port.
+
+        Args:
+            parent (TraceContext): The context of the sender or a new context
+                returned by :meth:`sample`.
+            port: The input port.
+
+        Returns:
+            TraceHop: The hop in progress.
+        """
+        trace_id = parent.trace_id
+        self._active[trace_id] = self._active.get(trace_id, 0) + 1
+        if trace_id not in self._spans:
+            self._spans[trace_id] = self._finished.pop(trace_id, [])
+        return TraceHop(TraceContext(trace_id, parent.hop + 1), port, self.seconds())
+
+    def start(self, hop):
+        """
+        Record the start of the job.
+        """
+        hop.start = self.seconds()
+
+    def exit(self, hop):
+        """
+        Record the completion of the job.
+        """
+        context = hop.context
+        trace_id = context.trace_id
+        label = self.labels.get(hop.port, str(hop.port))
+        self._spans[trace_id].append(TraceSpan(trace_id, context.hop, label, hop.enter,
+                                               hop.start, self.seconds(), self.pid))
+
+        self._active[trace_id] -= 1
+        if not self._active[trace_id]:
+            del self._active[trace_id]
+            self._finish(trace_id, self._spans.pop(trace_id))
+
+    def add_spans(self, spans):
+        """
+        Merge spans recorded by another process.
+        """
+        for span in spans:
+            span = TraceSpan(*span)
+            trace_id = span.trace_id
+            if trace_id in self._spans:
+                self._spans[trace_id].append(span)
+            else:
+                self._finish(trace_id, self._finished.pop(trace_id, []) + [span])
+
+    def traces(self):
+        """
+        Returns a map trace id -> list of spans of all finished traces.
+        """
+        return OrderedDict((trace_id, list(spans)) for trace_id, spans in self._finished.items())
+
+    def chrome_events(self):
+        """
+        Returns the spans of all finished traces as a list of Chrome
+        trace-events.
+
+        Every trace is shown as a separate thread. Every hop is represented by
+        a slice for the time the item was queued and one for the time the job
+        was running.
+        """
+        events = []
+        for trace_id, spans in self._finished.items():
+            for span in sorted(spans, key=lambda span: span.enter):
+                args = {'trace': trace_id, 'hop': span.hop}
+                start = span.start if span.start is not None else span.exit
+                if start > span.enter:
+                    events.append(self._chrome_event('queued: ' + span.port, 'queue',
+                                                     span.enter, start, span, args))
+                if span.start is not None:
+                    events.append(self._chrome_event(span.port, 'run', span.start,
+                                                     span.exit, span, args))
+        return events
+
+    def export_chrome(self, fileobj):
+        """
+        Write finished traces in the Chrome trace-event JSON format.
+        """
+        fileobj.write(json.dumps({
+            'traceEvents': self.chrome_events(),
+            'displayTimeUnit': 'ms'
+        }))
+
+    def _chrome_event(self, name, category, begin, end, span, args):
+        return {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': begin * 1e6,
+            'dur': (end - begin) * 1e6,
+            'pid': span.pid,
+            'tid': span.trace_id,
+            'args': args
+        }
+
+    def _finish(self, trace_id, spans):
+        if self.forward is not None:
+            self.forward(spans)
+        else:
+            self._finished[trace_id] = spans
+            while len(self._finished) > self.max_traces:
+                self._finished.popitem(last=False)
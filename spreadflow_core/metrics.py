@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight runtime metrics.
+
+Counters and fixed-bucket latency histograms cheap enough to be recorded for
+every job.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import bisect
+import timeit
+from collections import namedtuple
+
+DEFAULT_BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+class HistogramSnapshot(namedtuple('HistogramSnapshot', ['bounds', 'counts', 'count', 'total', 'maximum'])):
+    """
+    An immutable copy of a histogram.
+
+    Attributes:
+        bounds (tuple): Upper bounds of the buckets. The last bucket (counts
+            has one more entry than bounds) records values exceeding the last
+            bound.
+        counts (tuple): The number of values recorded in every bucket.
+        count (int): The number of values recorded.
+        total (float): The sum of all values.
+        maximum (float): The largest value recorded.
+    """
+
+    __slots__ = ()
+
+    def mean(self):
+        """
+        Returns the arithmetic mean of all values or None if empty.
+        """
+        return self.total / self.count if self.count else None
+
+    def quantile(self, fraction):
+        """
+        Returns an upper bound for the given quantile, e.g. 0.99 for the
+        99th percentile, or None if empty.
+        """
+        if not self.count:
+            return None
+
+        threshold = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= threshold:
+                return min(bound, self.maximum)
+
+        return self.maximum
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets.
+
+    Args:
+        bounds (tuple): Sorted upper bounds of the buckets.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'maximum')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, value):
+        """
+        Record a value.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def snapshot(self):
+        """
+        Returns a :class:`HistogramSnapshot`.
+        """
+        return HistogramSnapshot(self.bounds, tuple(self.counts), self.count,
+                                 self.total, self.maximum)
+
+    def reset(self):
+        """
+        Discard all values recorded so far.
+        """
+        self.counts[:] = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+PortMetricsSnapshot = namedtuple('PortMetricsSnapshot', ['received', 'sent', 'failed', 'coalesced', 'expired', 'retried', 'dead_lettered', 'wait', 'execution'])
+
+class PortMetrics(object):
+    """
+    Metrics recorded for a single port.
+
+    Attributes:
+        received (int): The number of items delivered to an input port.
+        sent (int): The number of items sent through an output port.
+        failed (int): The number of failed jobs on an input port.
+        coalesced (int): The number of items merged into an item still
+            queued on an input port (see
+            :meth:`spreadflow_core.scheduler.Scheduler.set_coalesce`).
+        expired (int): The number of items dropped from the backlog of an
+            input port because they waited too long (see
+            :meth:`spreadflow_core.scheduler.Scheduler.set_expiry`).
+        retried (int): The number of retries scheduled for failed jobs on an
+            input port (see
+            :meth:`spreadflow_core.scheduler.Scheduler.set_retry`).
+        dead_lettered (int): The number of items sent to the dead-letter port
+            of an input port.
+        wait (Histogram): Seconds between sending an item and the start of
+            the job.
+        execution (Histogram): Seconds between the start and the completion
+            of a job.
+    """
+
+    __slots__ = ('received', 'sent', 'failed', 'coalesced', 'expired', 'retried',
+                 'dead_lettered', 'wait', 'execution')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.wait = Histogram(bounds)
+        self.execution = Histogram(bounds)
+        self.reset()
+
+    def reset(self):
+        """
+        Reset all counters and histograms.
+        """
+        self.received = 0
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.wait.reset()
+        self.execution.reset()
+
+    def empty(self):
+        """
+        Returns True if nothing was recorded since the last reset.
+        """
+        return not (self.received or self.sent or self.failed or
+                    self.coalesced or self.expired or self.retried or
+                    self.dead_lettered or self.wait.count or
+                    self.execution.count)
+
+    def snapshot(self):
+        """
+        Returns a :class:`PortMetricsSnapshot`.
+        """
+        return PortMetricsSnapshot(self.received, self.sent, self.failed,
+                                   self.coalesced, self.expired, self.retried,
+                                   self.dead_lettered,
+                                   self.wait.snapshot(), self.execution.snapshot())
+
+class MetricsRegistry(object):
+    """
+    Keeps metrics for every port.
+
+    Args:
+        bounds (tuple): Upper bounds of the histogram buckets in seconds.
+        seconds (callable): A function returning the current time. Defaults
+            to :func:`timeit.default_timer`.
+    """
+
+    def __init__(self, bounds=DEFAULT_BOUNDS, seconds=timeit.default_timer):
+        self.bounds = tuple(bounds)
+        self.seconds = seconds
+        self._ports = {}
+
+    def port(self, port):
+        """
+        Returns the :class:`PortMetrics` of a port, creating them if
+        necessary.
+        """
+        try:
+            return self._ports[port]
+        except KeyError:
+            metrics = self._ports[port] = PortMetrics(self.bounds)
+            return metrics
+
+    def snapshot(self, reset=False):
+        """
+        Returns a map port -> :class:`PortMetricsSnapshot`. Ports without any
+        metrics recorded since the last reset are omitted.
+
+        The metrics are reset in place, such that jobs still running keep
+        recording into the current :class:`PortMetrics` and show up in the
+        next snapshot.
+
+        Args:
+            reset (bool): Reset all metrics after reading them.
+        """
+        result = {}
+        for port, metrics in self._ports.items():
+            if not metrics.empty():
+                result[port] = metrics.snapshot()
+                if reset:
+                    metrics.reset()
+        return result
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+import collections
 import copy
 
 from twisted.internet import defer, task
@@ -9,15 +10,71 @@ from twisted.logger import Logger, LogLevel
 
 
 class SyntheticSource(object):
+    """
+    A source emitting the given items after the specified delays.
+
+    The source registers itself as a producer with the scheduler. Items due
+    while the scheduler is congested are held back until it resumes the
+    source. The scheduler is marked busy until the last item was sent, hence
+    oneshot runs wait for delayed items.
+
+    Args:
+        items: A sequence of (delay, item) pairs.
+    """
+
     def __init__(self, items):
         self.items = items
+        self._scheduler = None
+        self._calls = []
+        self._held = collections.deque()
+        self._paused = False
+        self._remaining = 0
 
     def attach(self, scheduler, reactor):
-        for delay, item in self.items:
-            reactor.callLater(delay, scheduler.send, item, self)
+        self._scheduler = scheduler
+        self._calls = [reactor.callLater(delay, self._emit, item)
+                       for delay, item in self.items]
+        self._remaining = len(self._calls)
+        scheduler.register_producer(self)
+        if self._remaining:
+            scheduler.set_busy(self)
 
     def detach(self):
-        pass
+        for call in self._calls:
+            if call.active():
+                call.cancel()
+        self._calls = []
+        self._held.clear()
+        self._remaining = 0
+
+        if self._scheduler:
+            self._scheduler.unregister_producer(self)
+            self._scheduler.set_busy(self, False)
+            self._scheduler = None
+
+    def pauseProducing(self): # pylint: disable=invalid-name
+        self._paused = True
+
+    def resumeProducing(self): # pylint: disable=invalid-name
+        self._paused = False
+        while self._held and not self._paused:
+            self._scheduler.send(self._held.popleft(), self)
+        self._check_done()
+
+    def stopProducing(self): # pylint: disable=invalid-name
+        self.detach()
+
+    def _emit(self, item):
+        self._remaining -= 1
+        if self._paused or self._held:
+            self._held.append(item)
+        else:
+            self._scheduler.send(item, self)
+        self._check_done()
+
+    def _check_done(self):
+        if not self._remaining and not self._held and self._scheduler:
+            self._scheduler.set_busy(self, False)
 
     def __call__(self, item, send):
         send(item, self)
@@ -52,6 +109,67 @@ class Duplicator(object):
         send(item, self)
 
 
+class Tee(object):
+    """
+    A processor forwarding items unchanged.
+
+    Serves as a junction for multicast connections: Its output port is
+    connected to more than one input port and the scheduler delivers the
+    very same item to all of them. Downstream processors must not modify
+    items in place.
+    """
+
+    def __call__(self, item, send):
+        send(item, self)
+
+
+class Fused(object):
+    """
+    A processor running a linear chain of synchronous processors in one go.
+
+    Items sent by an element to its default output port (i.e., the element
+    itself) are passed on to the next element directly. Items sent by the last
+    element or to any other port are forwarded to the scheduler.
+
+    Args:
+        elements (list): The processors in chain order. All of them must
+            complete synchronously.
+    """
+
+    log = Logger()
+
+    def __init__(self, elements):
+        self.elements = list(elements)
+        self._successors = dict(zip(self.elements[:-1], self.elements[1:]))
+
+    def __call__(self, item, send):
+        successors = self._successors
+        pending = collections.deque([(self.elements[0], item)])
+
+        def _send(item, port_out):
+            try:
+                element = successors[port_out]
+            except KeyError:
+                send(item, port_out)
+            else:
+                pending.append((element, item))
+
+        while pending:
+            element, item = pending.popleft()
+            try:
+                result = element(item, _send)
+            except Exception:
+                self.log.error('Element {element} failed in {fused} while processing {item}',
+                               element=element, fused=self, item=item)
+                raise
+
+            assert not isinstance(result, defer.Deferred), \
+                'Fused element {!s} must not return a deferred'.format(element)
+
+    def __repr__(self):
+        return 'Fused({!r})'.format(self.elements)
+
+
 class Sleep(object):
     """
     A processor which delays every incomming message by the specified amount.
@@ -13,6 +13,8 @@ from twisted.internet import interfaces
 from twisted.internet.endpoints import clientFromString, serverFromString
 from zope.interface import implementer
 
+from spreadflow_core.lineage import TraceContext
+
 
 class MessageHandler(object):
     """
@@ -26,17 +28,46 @@ class MessageHandler(object):
         self.scheduler = scheduler
         self.portmap = portmap
 
-    def dispatch(self, port, item):
-        self.scheduler.send(item, self.portmap[port])
+    def dispatch(self, port, item, trace=None):
+        if trace:
+            trace = TraceContext(*trace)
+        self.scheduler.send(item, self.portmap[port], trace=trace)
+
+    def collect(self, spans):
+        """
+        Merge trace spans recorded by the peer.
+        """
+        tracer = self.scheduler.tracer
+        if tracer is not None:
+            tracer.add_spans(spans)
+
+    def quiescent(self, quiescent):
+        """
+        Called whenever the peer reported that it became idle.
+
+        Args:
+            quiescent (bool): True if the peer was idle and there were no
+                messages in flight between the peer and this side when the
+                report was sent (and nothing was sent to the peer since).
+        """
 
 
 class SchedulerProtocol(protocol.Protocol):
     """A client protocol suitable to control a remote scheduler.
 
+    Both sides count the items they send and receive. A side reporting that
+    it became idle passes its counters along (see :meth:`sendIdle`). Since
+    the transport delivers messages in order, the receiving side can tell
+    whether any items were in flight when the report was made: This is the
+    case unless the peer received exactly as many items as were sent to it
+    and vice versa.
+
     Attributes:
         builder: A message builder for outgoing messages.
         handler: A message handler for incoming messages.
         handler: A message parser for incoming messages.
+        sent (int): The number of items sent to the peer.
+        received (int): The number of items received from the peer.
     """
 
     # pylint: disable=invalid-name
@@ -44,7 +75,10 @@ class SchedulerProtocol(protocol.Protocol):
     builder = None
     handler = None
     parser = None
+    sent = 0
+    received = 0
     _stopped = None
+    _lost = False
 
     def loseConnection(self):
         """
@@ -53,21 +87,50 @@ class SchedulerProtocol(protocol.Protocol):
         Returns
             defer.Deferred: Fires when the connection has been closed.
         """
+        if self._lost:
+            return defer.succeed(self)
+
         if not self._stopped:
             self._stopped = defer.Deferred()
             self.transport.loseConnection()
 
         return self._stopped
 
-    def sendMessage(self, port, item):
+    def sendMessage(self, port, item, trace=None):
         """
         Send an outgoing message to the specified input port on the remote
         scheduler.
+
+        The trace context (or False if the item was not sampled) is passed
+        along if given.
         """
         assert self.builder is not None, \
             'Protocol factory must set a builder for outgoing messages'
 
         msg = {'port': port, 'item': item}
+        if trace is not None:
+            msg['trace'] = tuple(trace) if trace else False
+        self.sent += 1
+        self.transport.write(self.builder.message(msg))
+
+    def sendSpans(self, spans):
+        """
+        Send trace spans of finished traces to the remote scheduler.
+        """
+        assert self.builder is not None, \
+            'Protocol factory must set a builder for outgoing messages'
+
+        msg = {'spans': [tuple(span) for span in spans]}
+        self.transport.write(self.builder.message(msg))
+
+    def sendIdle(self):
+        """
+        Report to the remote scheduler that the local one became idle.
+        """
+        assert self.builder is not None, \
+            'Protocol factory must set a builder for outgoing messages'
+
+        msg = {'idle': (self.received, self.sent)}
         self.transport.write(self.builder.message(msg))
 
     def dataReceived(self, data):
@@ -78,9 +141,20 @@ class SchedulerProtocol(protocol.Protocol):
 
         self.parser.push(data)
         for msg in self.parser.messages():
-            self.handler.dispatch(msg['port'], msg['item'])
+            if 'spans' in msg:
+                self.handler.collect(msg['spans'])
+            elif 'idle' in msg:
+                received, sent = msg['idle']
+                self.handler.quiescent(received == self.sent and sent == self.received)
+            elif 'trace' in msg:
+                self.received += 1
+                self.handler.dispatch(msg['port'], msg['item'], msg['trace'])
+            else:
+                self.received += 1
+                self.handler.dispatch(msg['port'], msg['item'])
 
     def connectionLost(self, reason=protocol.connectionDone):
+        self._lost = True
         if self._stopped:
             self._stopped.callback(self)
             self._stopped = None
@@ -95,7 +169,9 @@ class SchedulerServerProtocol(SchedulerProtocol):
         self.scheduler.stop(self)
 
     def writeConnectionLost(self):
-        pass
+        # The stdio transport neither reports connectionLost nor does anything
+        # on loseConnection once both halves are closed.
+        self._lost = True
 
 class SchedulerClientFactory(protocol.ClientFactory):
     """
@@ -146,9 +222,13 @@ class ClientEndpointMixin(object):
         peer (IProtocol): The protocol instance when connected to the endpoint
             (managed by this mixin). Use it from a subclass to send messages to
             the peer.
+        scheduler (Scheduler): The scheduler this component is attached to.
+            The transport of the peer is registered as a producer with it, such
+            that reading is paused while the backlog is congested.
     """
 
     peer = None
+    scheduler = None
     strport = None
 
     def get_client_protocol_factory(self, scheduler, reactor):
@@ -164,12 +244,16 @@ class ClientEndpointMixin(object):
         factory = self.get_client_protocol_factory(scheduler, reactor)
         endpoint = clientFromString(reactor, self.strport)
         self.peer = yield endpoint.connect(factory)
+        self.scheduler = scheduler
+        scheduler.register_producer(self.peer.transport)
 
     @defer.inlineCallbacks
     def detach(self):
         if self.peer:
+            self.scheduler.unregister_producer(self.peer.transport)
             yield self.peer.loseConnection()
         self.peer = None
+        self.scheduler = None
 
 class ServerEndpointMixin(object):
     """
@@ -181,9 +265,13 @@ class ServerEndpointMixin(object):
         peer (IProtocol): The protocol instance when connected to the endpoint
             (managed by this mixin). Use it from a subclass to send messages to
             the peer.
+        scheduler (Scheduler): The scheduler this component is attached to.
+            The transport of the peer is registered as a producer with it, such
+            that reading is paused while the backlog is congested.
     """
 
     peer = None
+    scheduler = None
     strport = None
 
     def get_server_protocol_factory(self, scheduler, reactor):
@@ -200,12 +288,16 @@ class ServerEndpointMixin(object):
         endpoint = serverFromString(reactor, self.strport)
         endpoint.listen(factory)
         self.peer = yield factory.connected
+        self.scheduler = scheduler
+        scheduler.register_producer(self.peer.transport)
 
     @defer.inlineCallbacks
     def detach(self):
         if self.peer:
+            self.scheduler.unregister_producer(self.peer.transport)
             yield self.peer.loseConnection()
         self.peer = None
+        self.scheduler = None
 
 class StrportGeneratorMixin(object):
     """
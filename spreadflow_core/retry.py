@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+Retrying failed jobs.
+
+A port with a :class:`RetryPolicy` does not stop the scheduler when a job
+fails. Instead, the item is put into the backlog of the port again after a
+delay which grows exponentially with every attempt. Items which still fail
+after the last attempt (or fail with an exception which is not retried) are
+passed on to a dead-letter port.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import heapq
+import itertools
+import random
+
+from twisted.logger import Logger
+
+class RetryPolicy(object):
+    """
+    Retry policy of an input port.
+
+    Args:
+        attempts (int): The maximum number of attempts, including the first
+            one. Defaults to 3.
+        backoff (float): The number of seconds to wait before the first
+            retry. Defaults to 1.
+        factor (float): The delay is multiplied by this factor for every
+            subsequent retry. Defaults to 2.
+        max_delay (float): The maximum number of seconds to wait before a
+            retry. Defaults to 300.
+        jitter (float): The fraction of the delay which is randomized, 0
+            (fixed delays) to 1 (anything between 0 and the full delay).
+            Spreads retries of items which failed at the same time. Defaults
+            to 0.5.
+        exceptions (tuple): The exception types which are retried. Defaults to
+            any exception.
+        random (callable): A function returning a random float in [0, 1).
+    """
+
+    def __init__(self, attempts=3, backoff=1, factor=2, max_delay=300,
+                 jitter=0.5, exceptions=(Exception,),
+                 random=random.random): # pylint: disable=redefined-outer-name
+        assert attempts >= 1, 'Number of attempts must be positive'
+        assert 0 <= jitter <= 1, 'Jitter must be between 0 and 1'
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.exceptions = tuple(exceptions)
+        self.random = random
+
+    def retry(self, reason, retries):
+        """
+        Returns True if a job which failed with the given reason should be
+        retried.
+
+        Args:
+            reason (twisted.python.failure.Failure): The failure.
+            retries (int): The number of retries made so far.
+        """
+        return retries + 1 < self.attempts and reason.check(*self.exceptions) is not None
+
+    def delay(self, retry):
+        """
+        Returns the number of seconds to wait before a retry.
+
+        Args:
+            retry (int): The number of the retry, starting at 1.
+        """
+        delay = min(self.backoff * self.factor ** (retry - 1), self.max_delay)
+        return delay - delay * self.jitter * self.random()
+
+class Timer(object):
+    """
+    A function call scheduled on a :class:`TimerHeap`.
+    """
+
+    __slots__ = ('heap', 'due', 'func', 'args')
+
+    def __init__(self, heap, due, func, args):
+        self.heap = heap
+        self.due = due
+        self.func = func
+        self.args = args
+
+    @property
+    def active(self):
+        """
+        bool: True if the call neither ran nor was cancelled.
+        """
+        return self.func is not None
+
+    def cancel(self):
+        """
+        Cancel the call unless it ran already.
+        """
+        self.heap.cancel(self)
+
+class TimerHeap(object):
+    """
+    Calls functions at given points in time.
+
+    Timers are kept in a binary heap ordered by due time and only the
+    earliest one is scheduled on the reactor. Adding and cancelling a timer
+    costs O(log n) regardless of how many timers are pending, cancelled
+    timers are discarded lazily once they reach the top of the heap.
+
+    A call which raises is logged and does not prevent the remaining timers
+    from running.
+
+    Args:
+        reactor: The reactor.
+    """
+
+    log = Logger()
+
+    def __init__(self, reactor):
+        self._reactor = reactor
+        self._heap = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._call = None
+
+    def __len__(self):
+        return self._active
+
+    def call_later(self, delay, func, *args):
+        """
+        Call a function after the given number of seconds.
+
+        Returns:
+            Timer: The scheduled call.
+        """
+        timer = Timer(self, self._reactor.seconds() + delay, func, args)
+        heapq.heappush(self._heap, (timer.due, next(self._seq), timer))
+        self._active += 1
+
+        if self._call is None:
+            self._call = self._reactor.callLater(delay, self._run)
+        elif timer.due < self._call.getTime():
+            self._call.reset(delay)
+
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a scheduled call.
+        """
+        if timer.active:
+            timer.func = None
+            timer.args = None
+            self._active -= 1
+            if not self._active:
+                del self._heap[:]
+                if self._call is not None:
+                    self._call.cancel()
+                    self._call = None
+
+    def _run(self):
+        self._call = None
+        heap = self._heap
+        now = self._reactor.seconds()
+
+        while heap and heap[0][0] <= now:
+            _, _, timer = heapq.heappop(heap)
+            if timer.active:
+                func, args = timer.func, timer.args
+                timer.func = None
+                timer.args = None
+                self._active -= 1
+                try:
+                    func(*args)
+                except Exception: # pylint: disable=broad-except
+                    self.log.failure('Timer call {func!r} failed', func=func)
+
+        while heap and not heap[0][2].active:
+            heapq.heappop(heap)
+
+        if heap and self._call is None:
+            self._call = self._reactor.callLater(heap[0][0] - now, self._run)
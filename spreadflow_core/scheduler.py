@@ -2,21 +2,28 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
-from collections import namedtuple
+import functools
+import pickle
+from collections import Counter, deque, namedtuple
 
-from twisted.internet import defer
-from twisted.logger import Logger
+from twisted.internet import defer, task
+from twisted.logger import Logger, LogLevel
+from twisted.python.failure import Failure
 
-from spreadflow_core.jobqueue import JobQueue
+from spreadflow_core.jobqueue import JobExpiredError, JobQueue
 from spreadflow_core.eventdispatcher import FailMode
+from spreadflow_core.retry import TimerHeap
 
 class Job(object):
-    def __init__(self, port, item, send, origin=None, handler=None):
+    def __init__(self, port, item, send, origin=None, handler=None, trace=None):
         self.port = port
         self.item = item
         self.send = send
         self.origin = origin
         self.handler = handler or port
+        self.trace = trace
+        self.seq = None
+        self.retries = 0
 
     def __eq__(self, other):
         return (isinstance(other, self.__class__)
@@ -31,33 +38,338 @@ class Job(object):
             str(self.origin), str(self.handler))
 
 Entry = namedtuple('Entry', ['deferred', 'job'])
+Expiry = namedtuple('Expiry', ['ttl', 'deadline', 'port'])
+Retry = namedtuple('Retry', ['policy', 'port'])
 
-JobEvent = namedtuple('JobEvent', ['scheduler', 'job', 'completed'])
-AttachEvent = namedtuple('AttachEvent', ['scheduler', 'reactor'])
-DetachEvent = namedtuple('DetachEvent', ['scheduler'])
+class Coalescer(object):
+    """
+    Coalescing policy of an input port.
+
+    Keeps an index key -> job of the jobs which are still waiting in the
+    backlog of the port.
+    """
+
+    __slots__ = ('key', 'merge', 'queued')
+
+    def __init__(self, key, merge=None):
+        self.key = key
+        self.merge = merge
+        self.queued = {}
+
+class PendingRetry(object):
+    """
+    A failed job waiting for its next attempt.
+
+    Attributes:
+        job (Job): The job.
+        deferred (defer.Deferred): Fires with the result of the final
+            attempt.
+        timer (Timer): The scheduled retry while waiting.
+        attempt (defer.Deferred): The completion deferred of the attempt in
+            progress.
+    """
+
+    __slots__ = ('job', 'deferred', 'timer', 'attempt')
+
+    def __init__(self, job):
+        self.job = job
+        self.deferred = defer.Deferred(self.cancel)
+        self.timer = None
+        self.attempt = None
+
+    def cancel(self, deferred):
+        """
+        Canceller: Cancel the scheduled retry or the attempt in progress.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+        elif self.attempt is not None:
+            self.attempt.cancel()
+
+class Sequencer(object):
+    """
+    Delivers items sent by concurrently running jobs in arrival order.
+
+    Every job is assigned a slot which acts as its send function. Items sent
+    by the oldest job are passed on immediately, items sent by younger jobs
+    are held back until all older jobs completed.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._slots = deque()
+
+    def slot(self, send=None):
+        """
+        Returns a new slot. Call :meth:`SequencerSlot.release` once the job
+        completed.
+
+        Args:
+            send (callable): The function items are forwarded to. Defaults to
+                the send function of the sequencer.
+        """
+        slot = SequencerSlot(self, send or self._send)
+        if self._slots:
+            slot.held = []
+        self._slots.append(slot)
+        return slot
+
+    def send(self, item, port_out):
+        """
+        Forwards an item to the scheduler.
+        """
+        return self._send(item, port_out)
+
+    def discard(self):
+        """
+        Drops all slots along with the items they hold back. Called when the
+        pending jobs are cancelled, items held back by slots must not be
+        forwarded afterwards.
+        """
+        self._slots.clear()
+
+    def flush(self):
+        """
+        Forwards items held back by slots which became the oldest one.
+        """
+        slots = self._slots
+        while slots:
+            head = slots[0]
+            if head.held is not None:
+                held = head.held
+                head.held = None
+                for item, port_out in held:
+                    head.send(item, port_out)
+            if head.done:
+                slots.popleft()
+            else:
+                break
+
+class SequencerSlot(object):
+    """
+    Send function handed to a job running on an ordered port.
+    """
+
+    def __init__(self, sequencer, send):
+        self.sequencer = sequencer
+        self.send = send
+        self.held = None
+        self.done = False
+
+    def __call__(self, item, port_out):
+        if self.held is None:
+            return self.send(item, port_out)
+        else:
+            self.held.append((item, port_out))
+
+    def release(self):
+        """
+        Marks the slot as completed.
+        """
+        self.done = True
+        self.sequencer.flush()
+
+class SchedulerEvent(object):
+    """
+    Base class of all the events dispatched by the scheduler. Listeners for
+    this class observe every scheduler event.
+    """
+    __slots__ = ()
+
+class LifecycleEvent(SchedulerEvent):
+    """
+    Base class of the events attaching, draining and detaching components.
+    """
+    __slots__ = ()
+
+class JobEvent(namedtuple('JobEvent', ['scheduler', 'job', 'completed']), SchedulerEvent):
+    """
+    Dispatched for every job before it is run.
+    """
+    __slots__ = ()
+
+class AttachEvent(namedtuple('AttachEvent', ['scheduler', 'reactor']), LifecycleEvent):
+    """
+    Dispatched when the scheduler starts.
+    """
+    __slots__ = ()
+
+class DetachEvent(namedtuple('DetachEvent', ['scheduler']), LifecycleEvent):
+    """
+    Dispatched when the scheduler stops.
+    """
+    __slots__ = ()
+
+class DrainEvent(namedtuple('DrainEvent', ['scheduler']), LifecycleEvent):
+    """
+    Dispatched when the scheduler stops accepting new items from sources.
+    """
+    __slots__ = ()
+
+class IdleEvent(namedtuple('IdleEvent', ['scheduler']), SchedulerEvent):
+    """
+    Dispatched when no job is pending anymore.
+    """
+    __slots__ = ()
 
 class Scheduler(object):
-    log = Logger()
+    """
+    Routes items between ports and runs the jobs on a cooperative job queue.
 
-    def __init__(self, flowmap, eventdispatcher, cooperate=None):
-        if cooperate is None:
-            from twisted.internet.task import cooperate
+    Unless a cooperate function is given, the queue is run by a dedicated
+    :class:`twisted.internet.task.Cooperator` created when the scheduler is
+    started.
+
+    Args:
+        flowmap (dict): A map output port -> input port. Multicast output
+            ports map to a tuple of input ports. The same item is delivered
+            to every one of them, hence processors must not modify items
+            received on a multicast connection in place.
+        eventdispatcher: The event dispatcher.
+        cooperate (callable): A function compatible with
+            :func:`twisted.internet.task.cooperate`. Defaults to None (use a
+            dedicated cooperator).
+        queue (JobQueue): The job queue. Defaults to a new unbounded queue.
+        timeslice (float): The maximum number of seconds the dedicated
+            cooperator runs the queue before returning control to the reactor.
+        tick_interval (float): The number of seconds the dedicated cooperator
+            waits between two timeslices. Defaults to the interval used by the
+            global cooperator.
+        metrics (MetricsRegistry): If given, record per-port counters and
+            latency histograms (see :meth:`port_stats`).
+        journal (Journal): If given, record enqueued and completed jobs in a
+            write-ahead journal. Items of jobs which did not complete in a
+            previous run are replayed when the scheduler starts.
+        recorder (TraceRecorder): If given, record items sent through
+            selected output ports into a trace file (see
+            :mod:`spreadflow_core.trace`).
+        tracer (LineageTracer): If given, follow sampled items across hops
+            (see :mod:`spreadflow_core.lineage`).
+        check_multicast (bool): Log an error whenever a job modifies an item
+            received on a multicast connection. Expensive, intended for
+            debugging. Only modifications made before the handler returns are
+            detected.
+        lifecycle_concurrency (int): The maximum number of components
+            attached, drained or detached at the same time (per priority).
+            Defaults to None (no limit).
+        attach_timeout (float): The number of seconds a component may take to
+            attach. Defaults to None (no limit).
 
+    Attributes:
+        lifecycle_timings (dict): A map event type -> list of
+            :class:`spreadflow_core.eventdispatcher.HandlerTiming` recorded
+            the last time components were attached, drained or detached.
+
+    If listeners for :class:`IdleEvent` are registered by the time all
+    components are attached, the event is dispatched once right after startup
+    if there is nothing to do and then every time the scheduler becomes idle,
+    i.e., when the last pending job completed and no component reported
+    outstanding work elsewhere (see :meth:`set_busy`). The check is made on
+    the next reactor iteration, jobs do not pay for it.
+    """
+
+    log = Logger()
+
+    def __init__(self, flowmap, eventdispatcher, cooperate=None, queue=None,
+                 timeslice=0.01, tick_interval=task._EPSILON, metrics=None, journal=None, # pylint: disable=protected-access
+                 recorder=None, tracer=None, check_multicast=False,
+                 lifecycle_concurrency=None, attach_timeout=None):
         self.flowmap = flowmap
         self.eventdispatcher = eventdispatcher
         self.cooperate = cooperate
+        self.timeslice = timeslice
+        self.tick_interval = tick_interval
+        self._cooperator = None
         self._done = defer.Deferred()
         self._pending = {}
-        self._queue = JobQueue()
+        self._producers = []
+        self._producers_paused = False
+        self._sequencers = {}
+        self._executors = {}
+        self._handlers = {}
+        self._coalescers = {}
+        self._expiry = {}
+        self._retry = {}
+        self._timers = None
+        self._dispatch_job_events = True
+        self._metrics = metrics
+        self._journal = journal
+        self._recorder = recorder
+        self._tracer = tracer
+        self.check_multicast = check_multicast
+        self.lifecycle_concurrency = lifecycle_concurrency
+        self.attach_timeout = attach_timeout
+        self.lifecycle_timings = {}
+        self._queue = queue if queue is not None else JobQueue()
         self._queue_done = None
         self._queue_task = None
         self._stopped = False
         self._detached = False
+        self._reactor = None
+        self._drained = None
+        self._busy = set()
+        self._watch_idle = False
+        self._idle_call = None
 
     def _job_callback(self, result, completed):
         self._pending.pop(completed)
+        if not self._pending:
+            if self._drained is not None:
+                # Resume join() outside of the job completion chain.
+                drained = self._drained
+                self._drained = None
+                self._reactor.callLater(0, self._drained_callback, drained)
+            if self._watch_idle and not self._busy:
+                self._schedule_idle_check()
         return result
 
+    def _drained_callback(self, drained):
+        if drained.called:
+            return
+        if self._pending:
+            # A failed job was scheduled for retry in the meantime.
+            self._drained = drained
+        else:
+            drained.callback(None)
+
+    @property
+    def idle(self):
+        """
+        bool: True if there are no pending jobs and no component reported
+        outstanding work.
+        """
+        return not self._pending and not self._busy
+
+    def set_busy(self, key, busy=True):
+        """
+        Report outstanding work the scheduler cannot see itself, e.g. items
+        being processed by a worker process. The scheduler is not considered
+        idle as long as any key is marked busy.
+
+        Args:
+            key: A hashable value identifying the reporter.
+            busy (bool): Whether or not there is outstanding work.
+        """
+        if busy:
+            self._busy.add(key)
+        elif key in self._busy:
+            self._busy.discard(key)
+            if self._watch_idle and not self._busy and not self._pending:
+                self._schedule_idle_check()
+
+    def _schedule_idle_check(self):
+        if self._idle_call is None and not self._stopped:
+            self._idle_call = self._reactor.callLater(0, self._check_idle)
+
+    def _check_idle(self):
+        """
+        Dispatch an idle event if the scheduler is still idle.
+        """
+        self._idle_call = None
+        if self.idle and not self._stopped:
+            event = IdleEvent(scheduler=self)
+            self.eventdispatcher.dispatch(event, fail_mode=FailMode.RETURN).addCallback(self.eventdispatcher.log_failures, event)
+
     def _job_errback(self, reason, job):
         if not self._stopped:
             self.log.failure('Job failed on {job.port} while processing {job.item}', reason, job=job)
@@ -70,10 +382,14 @@ class Scheduler(object):
         subtask.cancel()
 
     def _enqueue(self, job):
+        if not self._dispatch_job_events:
+            return self._enqueue_direct(job)
+
         completed = defer.Deferred(lambda dfr: self._job_cancel(Entry(dfr, job)))
+        handler = self._job_handler(job)
 
         defered = self.eventdispatcher.dispatch(JobEvent(scheduler=self, job=job, completed=completed))
-        defered.addCallback(lambda ignored, job: self._queue.put(job.port, job.handler, job.item, job.send), job)
+        defered.addCallback(self._put, job, handler)
 
         defered.pause()
         self._pending[completed] = Entry(defered, job)
@@ -83,15 +399,590 @@ class Scheduler(object):
 
         return completed
 
-    def send(self, item, port_out):
+    def _put(self, ignored, job, handler):
+        completed = self._queue.put(job.port, handler, job.item, job.send)
+        self._set_deadline(completed, job)
+        return completed
+
+    def _enqueue_direct(self, job):
+        """
+        Fast path: Put a job straight into the queue without dispatching a
+        job event. Only one deferred is created per job.
+
+        If the queue is configured accordingly, the job may run inline when
+        sent from within another job. Jobs which completed already are not
+        tracked.
+        """
+        completed = self._queue.execute(job.port, self._job_handler(job), job.item, job.send)
+
+        if not completed.called:
+            self._pending[completed] = Entry(completed, job)
+            completed.addBoth(self._job_callback, completed)
+            self._set_deadline(completed, job)
+
+        return completed
+
+    def _set_deadline(self, completed, job):
+        """
+        Pass the deadline of an item on to the queue.
+        """
+        expiry = self._expiry.get(job.port)
+        if expiry is not None and expiry.deadline is not None:
+            deadline = expiry.deadline(job.item)
+            if deadline is not None:
+                self._queue.set_deadline(completed, deadline)
+
+    def _job_handler(self, job):
+        """
+        Returns the function run by the queue for a job.
+        """
+        if self._metrics is None and job.trace is None:
+            return job.handler
+
+        handler = job.handler
+        if self._metrics is not None:
+            metrics = self._metrics.port(job.port)
+            metrics.received += 1
+            handler = functools.partial(self._measure, handler, metrics, self._metrics.seconds())
+
+        if job.trace is not None:
+            handler = functools.partial(self._trace_run, handler, job.trace)
+
+        return handler
+
+    def _measure(self, handler, metrics, queued, item, send):
+        """
+        Run a job handler and record wait and execution time.
+        """
+        seconds = self._metrics.seconds
+        start = seconds()
+        metrics.wait.add(start - queued)
+
+        try:
+            result = handler(item, send)
+        except Exception:
+            metrics.failed += 1
+            metrics.execution.add(seconds() - start)
+            raise
+
+        if isinstance(result, defer.Deferred):
+            result.addCallbacks(self._measure_done, self._measure_failed,
+                                callbackArgs=(metrics, start),
+                                errbackArgs=(metrics, start))
+        else:
+            metrics.execution.add(seconds() - start)
+
+        return result
+
+    def _measure_done(self, result, metrics, start):
+        metrics.execution.add(self._metrics.seconds() - start)
+        return result
+
+    def _measure_failed(self, reason, metrics, start):
+        metrics.failed += 1
+        metrics.execution.add(self._metrics.seconds() - start)
+        return reason
+
+    def send(self, item, port_out, trace=None):
+        """
+        Send an item to the input port connected to the given output port.
+
+        Args:
+            item: The item.
+            port_out: The output port.
+            trace (TraceContext): The trace context of the sender if it was
+                sampled, False if it was not sampled or None if the item is
+                entering the flow (and may be sampled). Ignored unless a
+                tracer is configured. Jobs receive a send function with this
+                argument bound.
+
+        Returns:
+            None if the item was accepted without further ado. If the backlog
+            is congested, all registered producers are paused and a
+            :class:`twisted.internet.defer.Deferred` is returned. It fires
+            once the backlog drained below the low-water mark. Callers should
+            refrain from sending more items until then.
+        """
         assert not self._detached, 'Must not send() any items after ports have been detached'
         if port_out in self.flowmap:
             port_in = self.flowmap[port_out]
 
-            job = Job(port_in, item, self.send, origin=port_out)
-            completed = self._enqueue(job)
+            if self._metrics is not None:
+                self._metrics.port(port_out).sent += 1
+
+            if self._recorder is not None:
+                self._recorder.record(port_out, item)
+
+            if self._tracer is not None and trace is None:
+                trace = self._tracer.sample() or False
+
+            if isinstance(port_in, tuple):
+                return self._multicast(item, port_out, port_in, trace)
+
+            return self._deliver(item, port_out, port_in, trace)
+
+        # Items sent through unconnected ports are dropped. They count as
+        # completed, hence the scheduler reports becoming idle as if a job
+        # had run. Otherwise a worker receiving such an item would never tell
+        # its controller that it is done.
+        if self._watch_idle and self.idle:
+            self._schedule_idle_check()
+
+    def _deliver(self, item, port_out, port_in, trace, handler=None):
+        """
+        Create and submit the job for one input port.
+        """
+        coalescer = self._coalescers.get(port_in)
+        if coalescer is not None:
+            key = coalescer.key(item)
+            queued = coalescer.queued.get(key)
+            if queued is not None:
+                self._coalesce(coalescer, queued, item)
+                return
+
+        job = Job(port_in, item, self.send, origin=port_out,
+                  handler=handler or self._handlers.get(port_in))
+
+        if self._tracer is not None:
+            self._trace_job(job, trace)
+
+        if coalescer is not None:
+            coalescer.queued[key] = job
+            job.handler = functools.partial(self._coalesce_run, coalescer, key, job, job.handler)
+
+        return self._submit(job)
+
+    def _coalesce(self, coalescer, job, item):
+        """
+        Replace or merge the item of a job waiting in the backlog.
+        """
+        if coalescer.merge is not None:
+            item = coalescer.merge(job.item, item)
+        job.item = item
+
+        if job.seq is not None:
+            seq = self._journal.put(job.port, item)
+            self._journal.done(job.seq)
+            job.seq = seq
+
+        if self._metrics is not None:
+            self._metrics.port(job.port).coalesced += 1
+
+    def _coalesce_run(self, coalescer, key, job, handler, item, send):
+        """
+        Remove a job from the coalescing index and run the handler on the
+        (possibly replaced) item.
+        """
+        if coalescer.queued.get(key) is job:
+            del coalescer.queued[key]
+        return handler(job.item, send)
+
+    def _multicast(self, item, port_out, ports_in, trace):
+        """
+        Deliver the same item to every input port connected to a multicast
+        output port. Returns a deferred if any of the ports is congested.
+        """
+        snapshot = None
+        if self.check_multicast:
+            snapshot = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+
+        congested = None
+        for port_in in ports_in:
+            handler = None
+            if snapshot is not None:
+                handler = functools.partial(self._check_multicast, self._handlers.get(port_in, port_in),
+                                            port_in, snapshot)
+            congested = self._deliver(item, port_out, port_in, trace, handler) or congested
+
+        return congested
+
+    def _check_multicast(self, handler, port_in, snapshot, item, send):
+        """
+        Run a job handler and complain if it modified a multicast item.
+        """
+        try:
+            return handler(item, send)
+        finally:
+            if pickle.dumps(item, pickle.HIGHEST_PROTOCOL) != snapshot:
+                self.log.error('Multicast item modified in place on {port_in}: {item}',
+                               port_in=port_in, item=item)
+
+    def _trace_job(self, job, trace):
+        """
+        Attach the trace hop to a job and bind its send function to the
+        trace context.
+        """
+        tracer = self._tracer
+        if trace:
+            job.trace = tracer.enter(trace, job.port)
+            job.send = functools.partial(self.send, trace=job.trace.context)
+        elif tracer.sample_rate:
+            # Prevent that items sent by this job are sampled.
+            job.send = functools.partial(self.send, trace=False)
+
+    def _trace_run(self, handler, hop, item, send):
+        """
+        Run a job handler and record the start of a traced hop.
+        """
+        tracer = self._tracer
+        tracer.start(hop)
+
+        previous = tracer.current
+        tracer.current = hop.context
+        try:
+            return handler(item, send)
+        finally:
+            tracer.current = previous
+
+    def _trace_exit(self, result, hop):
+        self._tracer.exit(hop)
+        return result
+
+    def _submit(self, job, seq=None):
+        """
+        Enqueue a job and arrange for sequencing, journaling and error
+        handling. See :meth:`send` for the return value.
+        """
+        port_in = job.port
+
+        sequencer = self._sequencers.get(port_in)
+        if sequencer is not None:
+            job.send = sequencer.slot(job.send)
+
+        if self._journal is not None and seq is None:
+            seq = self._journal.put(port_in, job.item)
+        job.seq = seq
+
+        completed = self._enqueue(job)
 
-            completed.addErrback(self._job_errback, job)
+        if port_in in self._expiry:
+            completed.addErrback(self._job_expired, job)
+
+        if port_in in self._retry:
+            completed.addErrback(self._job_retry, job, completed)
+
+        if sequencer is not None:
+            completed.addBoth(self._release_slot, job.send)
+
+        if seq is not None:
+            completed.addCallback(self._journal_done, job)
+
+        if job.trace is not None:
+            completed.addBoth(self._trace_exit, job.trace)
+
+        completed.addErrback(self._job_errback, job)
+
+        if not self._queue.writable(port_in):
+            self._pause_producers()
+            return self._queue.wait_writable(port_in)
+
+    def _job_expired(self, reason, job):
+        """
+        Errback: Count an expired job and pass its item on to the expiry port
+        if there is one.
+        """
+        reason.trap(JobExpiredError)
+
+        if self._metrics is not None:
+            self._metrics.port(job.port).expired += 1
+
+        coalescer = self._coalescers.get(job.port)
+        if coalescer is not None:
+            key = coalescer.key(job.item)
+            if coalescer.queued.get(key) is job:
+                del coalescer.queued[key]
+
+        port_expired = self._expiry[job.port].port
+        if port_expired is not None:
+            job.send(job.item, port_expired)
+        else:
+            self.log.debug('Dropped expired item on {port}: {item}', port=job.port, item=job.item)
+
+    def _job_retry(self, reason, job, completed):
+        """
+        Errback: Schedule the next attempt of a failed job. The job is tracked
+        as pending until the final attempt completed.
+        """
+        policy = self._retry[job.port].policy
+        if self._stopped or not policy.retry(reason, job.retries):
+            return self._dead_letter(reason, job)
+
+        retry = PendingRetry(job)
+        self._pending[completed] = Entry(retry.deferred, job)
+        retry.deferred.addBoth(self._job_callback, completed)
+        self._schedule_retry(retry, reason)
+        return retry.deferred
+
+    def _schedule_retry(self, retry, reason):
+        job = retry.job
+        job.retries += 1
+        delay = self._retry[job.port].policy.delay(job.retries)
+
+        if self._metrics is not None:
+            self._metrics.port(job.port).retried += 1
+
+        self.log.debug('Retrying in {delay:.3f}s on {job.port} after {reason.value!r} (attempt {attempt})',
+                       delay=delay, job=job, reason=reason, attempt=job.retries + 1)
+
+        retry.attempt = None
+        retry.timer = self._timers.call_later(delay, self._run_retry, retry)
+
+    def _run_retry(self, retry):
+        """
+        Put a failed job into the queue again.
+        """
+        job = retry.job
+        retry.timer = None
+        retry.attempt = self._enqueue(job)
+
+        if job.port in self._expiry:
+            retry.attempt.addErrback(self._job_expired, job)
+
+        retry.attempt.addCallbacks(retry.deferred.callback, self._retry_failed,
+                                   errbackArgs=(retry,))
+
+    def _retry_failed(self, reason, retry):
+        job = retry.job
+        policy = self._retry[job.port].policy
+        if not self._stopped and policy.retry(reason, job.retries):
+            self._schedule_retry(retry, reason)
+            return
+
+        result = self._dead_letter(reason, job)
+        if isinstance(result, Failure):
+            retry.deferred.errback(result)
+        else:
+            retry.deferred.callback(result)
+
+    def _dead_letter(self, reason, job):
+        """
+        Pass the item of a job which failed for good on to the dead-letter
+        port if there is one.
+        """
+        port_dead = self._retry[job.port].port
+        if self._stopped or port_dead is None or reason.check(defer.CancelledError):
+            return reason
+
+        self.log.failure('Job failed on {job.port} after {attempts} attempt(s), '
+                         'sending {job.item} to dead-letter port', reason,
+                         level=LogLevel.warn, job=job, attempts=job.retries + 1)
+
+        if self._metrics is not None:
+            self._metrics.port(job.port).dead_lettered += 1
+
+        job.send(job.item, port_dead)
+
+    def _journal_done(self, result, job):
+        self._journal.done(job.seq)
+        return result
+
+    def set_concurrency(self, port, concurrency, ordered=False):
+        """
+        Set the maximum number of jobs running at the same time on an input
+        port.
+
+        Args:
+            port: The input port.
+            concurrency (int): The maximum number of jobs in flight.
+            ordered (bool): If True, items sent by the jobs are delivered
+                downstream in the order the jobs arrived at the port.
+        """
+        self._queue.set_concurrency(port, concurrency)
+        if ordered:
+            self._sequencers[port] = Sequencer(self.send)
+        else:
+            self._sequencers.pop(port, None)
+
+    def set_executor(self, port, executor):
+        """
+        Run the jobs of an input port on an executor instead of the reactor
+        thread.
+
+        The executor is attached when the scheduler starts and detached when
+        it stops.
+
+        Args:
+            port: The input port.
+            executor: An executor, e.g.
+                :class:`spreadflow_core.executor.ThreadPoolExecutor`. Pass
+                None in order to run jobs on the reactor thread again.
+        """
+        if executor is None:
+            self._executors.pop(port, None)
+            self._handlers.pop(port, None)
+        else:
+            self._executors[port] = executor
+            self._handlers[port] = functools.partial(executor.execute, port)
+
+    def _unique_executors(self):
+        executors = []
+        for executor in self._executors.values():
+            if executor not in executors:
+                executors.append(executor)
+        return executors
+
+    def set_coalesce(self, port, key, merge=None):
+        """
+        Coalesce items waiting on an input port by key.
+
+        While an item is waiting in the backlog of the port, a new item with
+        the same key does not result in a new job. Instead it replaces the
+        waiting item, or is merged with it if a merge function is given.
+        Items are looked up in an index, hence the cost does not depend on
+        the length of the backlog. Once a job started, new items are queued
+        up as usual.
+
+        Args:
+            port: The input port.
+            key (callable): A function returning the (hashable) key of an
+                item.
+            merge (callable): A function called with the waiting item and the
+                new item, returning the item which replaces the waiting one.
+                Must not modify the items in place. Defaults to None (keep the
+                new item).
+        """
+        if key is None:
+            self._coalescers.pop(port, None)
+        else:
+            self._coalescers[port] = Coalescer(key, merge)
+
+    def set_expiry(self, port, ttl=None, deadline=None, port_expired=None):
+        """
+        Drop items which waited too long in the backlog of an input port.
+
+        Expiry is checked right before a job starts. Expired items are
+        counted in the metrics of the port and sent through the expiry port
+        if one is given. Items never expire once their job started.
+
+        Args:
+            port: The input port.
+            ttl (float): The maximum number of seconds an item may wait in the
+                backlog. Defaults to None (no limit).
+            deadline (callable): A function returning the point in time (as
+                returned by the `seconds` function of the queue) before which
+                the job processing an item must start, or None if the item has
+                no deadline. Defaults to None.
+            port_expired: An output port expired items are sent to. Defaults
+                to None (drop expired items).
+        """
+        self._queue.set_ttl(port, ttl)
+        if ttl is None and deadline is None:
+            self._expiry.pop(port, None)
+        else:
+            self._expiry[port] = Expiry(ttl, deadline, port_expired)
+
+    def set_retry(self, port, policy=None, port_dead=None):
+        """
+        Retry failed jobs of an input port instead of stopping the scheduler.
+
+        A failed item is put into the backlog of the port again after the
+        delay given by the policy. Pending retries are kept in a timer heap
+        and do not occupy the queue while waiting. Items which still fail
+        after the last attempt, or fail with an exception the policy does not
+        retry, are sent through the dead-letter port. Without a dead-letter
+        port, the scheduler is stopped as usual.
+
+        Items sent by a job are passed on immediately, hence an item may be
+        sent downstream more than once if a job fails after sending it.
+
+        Args:
+            port: The input port.
+            policy (RetryPolicy): The retry policy. Defaults to None (do not
+                retry).
+            port_dead: An output port items which failed for good are sent
+                to. Defaults to None.
+        """
+        if policy is None:
+            self._retry.pop(port, None)
+        else:
+            self._retry[port] = Retry(policy, port_dead)
+
+    def set_priority(self, port, priority=0, weight=1):
+        """
+        Set the priority lane and the weight of an input port.
+
+        Args:
+            port: The input port.
+            priority (int): Ports with a lower priority value are served
+                first.
+            weight (int): The number of jobs the port may start before the
+                next port in the same lane gets its turn.
+        """
+        self._queue.set_priority(port, priority, weight)
+
+    def lane_stats(self, reset=False):
+        """
+        Returns wait time statistics for every priority lane.
+
+        See :meth:`spreadflow_core.jobqueue.JobQueue.lane_stats`.
+        """
+        return self._queue.lane_stats(reset)
+
+    @property
+    def metrics(self):
+        """
+        MetricsRegistry: The metrics registry or None if metrics are disabled.
+        """
+        return self._metrics
+
+    @property
+    def tracer(self):
+        """
+        LineageTracer: The lineage tracer or None if tracing is disabled.
+        """
+        return self._tracer
+
+    def port_stats(self, reset=False):
+        """
+        Returns counters and latency histograms for every port.
+
+        Args:
+            reset (bool): Reset the metrics after reading them.
+
+        Returns:
+            dict: A map port -> :class:`spreadflow_core.metrics.PortMetricsSnapshot`.
+            Empty if metrics are disabled.
+        """
+        if self._metrics is None:
+            return {}
+        return self._metrics.snapshot(reset)
+
+    def _release_slot(self, result, slot):
+        slot.release()
+        return result
+
+    def register_producer(self, producer):
+        """
+        Register a producer which is paused when the backlog is congested.
+
+        Args:
+            producer: An object providing
+                :class:`twisted.internet.interfaces.IPushProducer`, e.g. the
+                transport of a remote peer.
+        """
+        self._producers.append(producer)
+        if self._producers_paused:
+            producer.pauseProducing()
+
+    def unregister_producer(self, producer):
+        """
+        Remove a producer previously registered with
+        :meth:`register_producer`.
+        """
+        self._producers.remove(producer)
+
+    def _pause_producers(self):
+        if not self._producers_paused:
+            self._producers_paused = True
+            for producer in list(self._producers):
+                producer.pauseProducing()
+            self._queue.wait_writable().addCallback(self._resume_producers)
+
+    def _resume_producers(self, result):
+        self._producers_paused = False
+        for producer in list(self._producers):
+            producer.resumeProducing()
+        return result
 
     @property
     def pending(self):
@@ -104,17 +995,53 @@ class Scheduler(object):
         if reactor == None:
             from twisted.internet import reactor
 
+        self._reactor = reactor
+        self._timers = TimerHeap(reactor)
+
         self.log.info('Starting scheduler')
 
+        replay = []
+        if self._journal is not None:
+            self.log.debug('Opening journal')
+            replay = self._journal.open(reactor)
+
+        if self._recorder is not None:
+            self.log.debug('Opening trace recorder')
+            self._recorder.open(reactor)
+
+        self.log.debug('Attaching executors')
+        for executor in self._unique_executors():
+            yield defer.maybeDeferred(executor.attach, self, reactor)
+
         self.log.debug('Attaching sources and services')
-        yield self.eventdispatcher.dispatch(AttachEvent(scheduler=self, reactor=reactor))
+        yield self._dispatch_lifecycle(AttachEvent(scheduler=self, reactor=reactor),
+                                       reactor, self.attach_timeout, FailMode.RAISE)
         self.log.debug('Attached sources and services')
 
+        # Compute the dispatch plan for jobs. Job events are only dispatched
+        # if there are listeners registered by the time all components are
+        # attached.
+        self._dispatch_job_events = bool(self.eventdispatcher.get_plan(JobEvent))
+        self._watch_idle = bool(self.eventdispatcher.get_plan(IdleEvent))
+
+        if replay:
+            self.log.info('Replaying {count} items from journal', count=len(replay))
+            for seq, port_in, item in replay:
+                job = Job(port_in, item, self.send, handler=self._handlers.get(port_in))
+                self._submit(job, seq)
+
         self.log.debug('Starting queue')
-        self._queue_task = self.cooperate(self._queue)
+        cooperate = self.cooperate
+        if cooperate is None:
+            self._cooperator = self._create_cooperator(reactor)
+            cooperate = self._cooperator.cooperate
+        self._queue_task = cooperate(self._queue)
         self._queue_done = self._queue_task.whenDone()
         self.log.debug('Started queue')
 
+        if self._watch_idle and self.idle:
+            self._schedule_idle_check()
+
         self.log.info('Started scheduler')
 
         reason = yield self._done
@@ -127,6 +1054,40 @@ class Scheduler(object):
             self._done.callback(reason)
         return reason
 
+    def _dispatch_lifecycle(self, event, reactor, timeout, fail_mode=FailMode.RETURN):
+        """
+        Dispatch an attach, drain or detach event with bounded parallelism and
+        a timeout per handler. Reports how long each handler took.
+        """
+        timings = []
+        self.lifecycle_timings[type(event)] = timings
+        start = reactor.seconds()
+        deferred = self.eventdispatcher.dispatch(event, fail_mode=fail_mode,
+                                                 concurrency=self.lifecycle_concurrency,
+                                                 timeout=timeout, reactor=reactor,
+                                                 timings=timings)
+        return deferred.addBoth(self._report_lifecycle, event, timings, start, reactor)
+
+    def _report_lifecycle(self, result, event, timings, start, reactor):
+        """
+        Log the total time spent on a lifecycle event along with the slowest
+        handlers. The time taken by every handler is logged at debug level.
+        """
+        if timings:
+            name = type(event).__name__
+            timings = sorted(timings, key=lambda timing: timing.seconds, reverse=True)
+            slowest = ', '.join('{!r} {:.3f}s'.format(timing.handler.callback, timing.seconds)
+                                for timing in timings[:5])
+            self.log.info('{event_name}: {count} handlers completed in {elapsed:.3f}s, slowest: {slowest}',
+                          event_name=name, count=len(timings), elapsed=reactor.seconds() - start,
+                          slowest=slowest, timings=timings)
+            for timing in timings:
+                self.log.debug('{event_name}: {handler!r} took {seconds:.3f}s{failed}',
+                               event_name=name, handler=timing.handler.callback,
+                               seconds=timing.seconds, failed='' if timing.success else ' (failed)')
+
+        return result
+
     def _logfail(self, failure, fmt, *args, **kwds):
         """
         Errback: Logs and consumes a failure.
@@ -134,25 +1095,54 @@ class Scheduler(object):
         self.log.failure(fmt, failure, *args, **kwds)
 
     @defer.inlineCallbacks
-    def join(self, reactor=None, timeout=10.0):
+    def join(self, reactor=None, timeout=10.0, drain=None):
+        """
+        Detach all components and stop the queue.
+
+        By default, jobs which did not start yet are cancelled right away. In
+        drain mode, sources are detached first and the queue keeps running
+        until all pending jobs completed or the drain deadline passed. Only
+        the remaining jobs are cancelled and reported.
+
+        Args:
+            reactor: The reactor. Defaults to the global reactor.
+            timeout (float): Seconds each component may take to detach.
+            drain (float): If given, the maximum number of seconds to wait for
+                pending jobs to complete. Defaults to None (do not drain).
+        """
         if reactor == None:
             from twisted.internet import reactor
 
+        if drain is not None:
+            yield self._drain(reactor, timeout, drain)
+
         # Prevent that any queued items are run.
         self._stopped = True
         self._queue_task.pause()
 
+        if self._idle_call is not None:
+            if self._idle_call.active():
+                self._idle_call.cancel()
+            self._idle_call = None
+
         self.log.debug('Detaching sources and services')
         event = DetachEvent(scheduler=self)
-        deferred_detach = self.eventdispatcher.dispatch(event, fail_mode=FailMode.RETURN).addCallback(self.eventdispatcher.log_failures, event)
-        delayed_call = reactor.callLater(timeout, deferred_detach.cancel)
+        deferred_detach = self._dispatch_lifecycle(event, reactor, timeout).addCallback(self.eventdispatcher.log_failures, event)
         yield deferred_detach
-        delayed_call.cancel()
         self.log.debug('Detached sources and services')
 
+        self.log.debug('Detaching executors')
+        for executor in self._unique_executors():
+            yield defer.maybeDeferred(executor.detach).addErrback(
+                self._logfail, 'Failed to detach executor {executor}', executor=executor)
+
         # Prevent that new items are enqueued.
         self._detached = True
 
+        # Drop items held back for ordered delivery.
+        for sequencer in self._sequencers.values():
+            sequencer.discard()
+
         # Clear the backlog and wait for queue termination.
         self.log.debug('Cancel {pending_len} pending jobs', pending=self._pending, pending_len=len(self._pending))
         _trapcancel = lambda f: f.trap(defer.CancelledError)
@@ -171,4 +1161,63 @@ class Scheduler(object):
         self._queue_done = None
         self._queue_task = None
 
+        if self._journal is not None:
+            self._journal.close()
+
+        if self._recorder is not None:
+            self._recorder.close()
+
+        if self._cooperator is not None:
+            self._cooperator.stop()
+            self._cooperator = None
+
         self.log.info('Stopped scheduler')
+
+    @defer.inlineCallbacks
+    def _drain(self, reactor, timeout, deadline):
+        """
+        Detach sources and wait for pending jobs to complete within the given
+        deadline.
+        """
+        self.log.info('Draining scheduler')
+
+        self.log.debug('Detaching sources')
+        event = DrainEvent(scheduler=self)
+        deferred_drain = self._dispatch_lifecycle(event, reactor, timeout).addCallback(self.eventdispatcher.log_failures, event)
+        yield deferred_drain
+        self.log.debug('Detached sources')
+
+        if self._pending:
+            self._reactor = reactor
+            self._drained = defer.Deferred()
+            delayed_call = reactor.callLater(deadline, self._drained.cancel)
+            try:
+                yield self._drained
+            except defer.CancelledError:
+                self._drained = None
+                ports = Counter(job.port for _, job in self._pending.values())
+                self.log.warn('Drain deadline of {deadline} seconds exceeded, {pending_len} jobs remaining',
+                              deadline=deadline, pending_len=len(self._pending))
+                for port, count in ports.items():
+                    self.log.warn('Cancelling {count} jobs on {port}', count=count, port=port)
+            else:
+                delayed_call.cancel()
+
+        self.log.info('Drained scheduler')
+
+    def _create_cooperator(self, reactor):
+        """
+        Returns a new cooperator configured according to the timeslice and
+        tick_interval settings.
+        """
+        seconds = reactor.seconds
+        timeslice = self.timeslice
+
+        def termination_predicate_factory():
+            deadline = seconds() + timeslice
+            return lambda: seconds() >= deadline
+
+        return task.Cooperator(
+            terminationPredicateFactory=termination_predicate_factory,
+            scheduler=lambda work: reactor.callLater(self.tick_interval, work)
+        )
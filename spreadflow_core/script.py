@@ -9,15 +9,22 @@ from spreadflow_core.dsl.stream import AddTokenOp, SetDefaultTokenOp
 from spreadflow_core.dsl.parser import ComponentParser
 from spreadflow_core.dsl.tokens import \
     AliasToken, \
+    CoalesceToken, \
     ComponentToken, \
+    ConcurrencyToken, \
     ConnectionToken, \
     DefaultInputToken, \
     DefaultOutputToken, \
     DescriptionToken, \
+    ExecutorToken, \
+    ExpiryToken, \
+    FusableToken, \
     LabelToken, \
     ParentElementToken, \
-    PartitionToken
-from spreadflow_core.proc import Duplicator
+    PartitionToken, \
+    PriorityToken, \
+    RetryToken
+from spreadflow_core.proc import Duplicator, Tee
 
 class ProcessTemplate(object):
     def apply(self):
@@ -86,6 +93,36 @@ class DuplicatorTemplate(ProcessTemplate):
         yield AddTokenOp(ConnectionToken(process.out_duplicate, destination))
         yield SetDefaultTokenOp(LabelToken(process, 'Copy to "{:s}"'.format(destination)))
 
+class MulticastTemplate(ProcessTemplate):
+    """
+    Passes items on unchanged and additionally delivers them to the given
+    destination. Unlike :class:`DuplicatorTemplate`, items are not copied,
+    hence processors downstream must not modify them in place.
+    """
+
+    component_parser = ComponentParser()
+    destination = None
+
+    def __init__(self, destination=None):
+        if destination is not None:
+            self.destination = destination
+
+    def apply(self):
+        # Apply (sub)template if necessary.
+        destination = self.destination
+        if isinstance(destination, ProcessTemplate):
+            for operation in self.component_parser.divert(destination.apply()):
+                yield operation
+            destination = self.component_parser.get_component()
+
+        process = Tee()
+        yield AddTokenOp(ComponentToken(process))
+
+        # Connect the output to the given downstream port in addition to the
+        # successor in the chain.
+        yield AddTokenOp(ConnectionToken(process, destination))
+        yield SetDefaultTokenOp(LabelToken(process, 'Multicast to "{:s}"'.format(destination)))
+
 CONTEXT_STACK = []
 
 class NoContextError(Exception):
@@ -149,11 +186,29 @@ class Process(object):
 
     component_parser = ComponentParser()
 
-    def __init__(self, alias=None, label=None, description=None, partition=None):
+    def __init__(self, alias=None, label=None, description=None, partition=None,
+                 concurrency=None, ordered=False, priority=None, weight=None,
+                 fusable=None, blocking=False, executor=None, coalesce=None,
+                 merge=None, ttl=None, deadline=None, expired=None, retry=None,
+                 dead_letter=None):
         self.alias = alias
         self.label = label
         self.description = description
         self.partition = partition
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.priority = priority
+        self.weight = weight
+        self.fusable = fusable
+        self.blocking = blocking
+        self.executor = executor
+        self.coalesce = coalesce
+        self.merge = merge
+        self.ttl = ttl
+        self.deadline = deadline
+        self.expired = expired
+        self.retry = retry
+        self.dead_letter = dead_letter
 
     def __call__(self, template_factory):
         ctx = Context.top()
@@ -182,6 +237,23 @@ class Process(object):
             operations.append(AddTokenOp(DescriptionToken(process, self.description)))
         if self.partition is not None:
             operations.append(AddTokenOp(PartitionToken(process, self.partition)))
+        if self.concurrency is not None:
+            operations.append(AddTokenOp(ConcurrencyToken(process, self.concurrency, self.ordered)))
+        if self.priority is not None or self.weight is not None:
+            # A weight without a priority applies to the default lane.
+            priority = self.priority if self.priority is not None else 0
+            weight = self.weight if self.weight is not None else 1
+            operations.append(AddTokenOp(PriorityToken(process, priority, weight)))
+        if self.fusable is not None:
+            operations.append(AddTokenOp(FusableToken(process, self.fusable)))
+        if self.blocking or self.executor is not None:
+            operations.append(AddTokenOp(ExecutorToken(process, self.executor)))
+        if self.coalesce is not None:
+            operations.append(AddTokenOp(CoalesceToken(process, self.coalesce, self.merge)))
+        if self.ttl is not None or self.deadline is not None:
+            operations.extend(_expiry(process, self.ttl, self.deadline, self.expired))
+        if self.retry is not None:
+            operations.extend(_retry(process, self.retry, self.dead_letter))
 
         ctx.tokens.extend(operations)
 
@@ -207,19 +279,80 @@ def Chain(name, *procs, **kw): # pylint: disable=C0103
         operations.append(AddTokenOp(DescriptionToken(process, kw['description'])))
     if 'partition' in kw:
         operations.append(AddTokenOp(PartitionToken(process, kw['partition'])))
+    if 'concurrency' in kw:
+        operations.append(AddTokenOp(ConcurrencyToken(process, kw['concurrency'], kw.get('ordered', False))))
+    if 'priority' in kw or 'weight' in kw:
+        operations.append(AddTokenOp(PriorityToken(process, kw.get('priority', 0), kw.get('weight', 1))))
+    if 'fusable' in kw:
+        operations.append(AddTokenOp(FusableToken(process, kw['fusable'])))
+    if kw.get('blocking', False) or kw.get('executor') is not None:
+        operations.append(AddTokenOp(ExecutorToken(process, kw.get('executor'))))
+    if 'coalesce' in kw:
+        operations.append(AddTokenOp(CoalesceToken(process, kw['coalesce'], kw.get('merge'))))
+    if kw.get('ttl') is not None or kw.get('deadline') is not None:
+        operations.extend(_expiry(process, kw.get('ttl'), kw.get('deadline'), kw.get('expired')))
+    if kw.get('retry') is not None:
+        operations.extend(_retry(process, kw['retry'], kw.get('dead_letter')))
 
     ctx.tokens.extend(operations)
 
     return process
 
+def _expiry(process, ttl, deadline, destination):
+    """
+    Returns the operations setting up expiry for the given process. If a
+    destination is given, expired items are sent there through an additional
+    output port.
+    """
+    port, operations = _side_port(process, destination, 'Expired to "{!s}"')
+    operations.append(AddTokenOp(ExpiryToken(process, ttl, deadline, port)))
+    return operations
+
+def _retry(process, policy, destination):
+    """
+    Returns the operations setting up the retry policy for the given process.
+    If a destination is given, items which failed for good are sent there
+    through an additional output port.
+    """
+    port, operations = _side_port(process, destination, 'Dead letters to "{!s}"')
+    operations.append(AddTokenOp(RetryToken(process, policy, port)))
+    return operations
+
+def _side_port(process, destination, label):
+    """
+    Returns an additional output port of the given process connected to the
+    destination along with the operations creating it. Returns None and no
+    operations if there is no destination.
+    """
+    operations = []
+
+    port = None
+    if destination is not None:
+        port = object()
+        operations.append(AddTokenOp(ParentElementToken(port, process)))
+        operations.append(AddTokenOp(ConnectionToken(port, destination)))
+        operations.append(SetDefaultTokenOp(LabelToken(port, label.format(destination))))
+
+    return port, operations
+
 def Duplicate(port_in, **kw): # pylint: disable=C0103
     """
     Creates a message duplicator and connects its secondary output port to the
     given input port.
     """
 
+    return _junction(DuplicatorTemplate(destination=port_in), **kw)
+
+def Multicast(port_in, **kw): # pylint: disable=C0103
+    """
+    Creates a multicast junction delivering items to the given input port in
+    addition to its successor without copying them.
+    """
+
+    return _junction(MulticastTemplate(destination=port_in), **kw)
+
+def _junction(template, **kw):
     ctx = Context.top()
-    template = DuplicatorTemplate(destination=port_in)
 
     parser = ComponentParser()
     operations = list(parser.divert(template.apply()))
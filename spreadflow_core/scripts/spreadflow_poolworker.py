@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Worker process for :class:`spreadflow_core.executor.ProcessPoolExecutor`.
+
+Reads jobs from stdin and writes results to stdout, both using the pickle
+stream format. Anything written to stdout by the processors is redirected to
+stderr.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import pickle
+import traceback
+
+from spreadflow_core.format import PickleMessageBuilder, PickleMessageParser
+
+BUFFER_MAX_LEN = 2**23
+READ_SIZE = 65536
+
+def port_ref(func, port_out):
+    """
+    Returns a reference to an output port which can be resolved by the
+    controlling process: None for the processor itself, otherwise the name of
+    the attribute holding the port.
+
+    Raises:
+        ValueError: If the port cannot be referenced.
+    """
+    if port_out is func:
+        return None
+
+    for name, value in vars(func).items():
+        if value is port_out:
+            return name
+
+    raise ValueError('Processors running in a process pool may only send to '
+                     'themselves or to ports stored in an attribute')
+
+def handle_message(funcs, msg):
+    """
+    Runs the job described by a message and returns the reply.
+
+    Args:
+        funcs (dict): A map key -> processor. Updated if the message carries
+            a pickled processor.
+        msg (dict): The job message.
+    """
+    reply = {'job': msg['job']}
+    sends = []
+
+    try:
+        if 'func' in msg:
+            funcs[msg['key']] = pickle.loads(msg['func'])
+        func = funcs[msg['key']]
+
+        def send(item, port_out):
+            sends.append((item, port_ref(func, port_out)))
+
+        result = func(msg['item'], send)
+        if result is not None and hasattr(result, 'addCallbacks'):
+            raise TypeError('Processors running in a process pool must not '
+                            'return a deferred')
+    except Exception: # pylint: disable=broad-except
+        reply['error'] = traceback.format_exc()
+    else:
+        reply['sends'] = sends
+
+    return reply
+
+def main():
+    # Keep stdout for the protocol, send any output of processors to stderr.
+    out_fd = os.dup(1)
+    os.dup2(2, 1)
+
+    parser = PickleMessageParser(BUFFER_MAX_LEN)
+    builder = PickleMessageBuilder()
+    funcs = {}
+
+    while True:
+        data = os.read(0, READ_SIZE)
+        if not data:
+            break
+
+        parser.push(data)
+        for msg in parser.messages():
+            data = builder.message(handle_message(funcs, msg))
+            while data:
+                written = os.write(out_fd, data)
+                data = data[written:]
+
+if __name__ == '__main__':
+    main()
@@ -7,24 +7,45 @@ import tempfile
 
 from twisted.application import service
 from twisted.internet import error, task
-from twisted.logger import globalLogPublisher, ILogObserver
+from twisted.logger import globalLogPublisher, ILogObserver, Logger
 from twisted.python import usage
 from zope.interface import provider
 
 from spreadflow_core.config import config_eval
 from spreadflow_core.eventdispatcher import EventDispatcher
-from spreadflow_core.scheduler import Scheduler, JobEvent
+from spreadflow_core.executor import ProcessPoolExecutor, ThreadPoolExecutor
+from spreadflow_core.jobqueue import JobQueue
+from spreadflow_core.journal import Journal
+from spreadflow_core.lineage import LineageTracer
+from spreadflow_core.metrics import MetricsRegistry
+from spreadflow_core.scheduler import Scheduler, IdleEvent
+from spreadflow_core.trace import TraceRecorder
 from spreadflow_core.dsl.parser import \
     AliasResolverPass, \
+    CoalesceExpanderPass, \
+    CoalesceParser, \
     ComponentsPurgePass, \
+    ConcurrencyExpanderPass, \
+    ConcurrencyParser, \
     ConnectionParser, \
     EventHandlerParser, \
     EventHandlersPass, \
+    ExecutorExpanderPass, \
+    ExecutorParser, \
+    ExpiryExpanderPass, \
+    ExpiryParser, \
+    FusableExpanderPass, \
+    FusionPass, \
+    LabelParser, \
     PartitionBoundsPass, \
     PartitionControllersPass, \
     PartitionExpanderPass, \
     PartitionWorkerPass, \
-    PortsValidatorPass
+    PortsValidatorPass, \
+    PriorityExpanderPass, \
+    PriorityParser, \
+    RetryExpanderPass, \
+    RetryParser
 from spreadflow_core.dsl.stream import AddTokenOp
 from spreadflow_core.dsl.tokens import PartitionSelectToken
 
@@ -32,6 +53,8 @@ class Options(usage.Options):
     optFlags = [
         ['oneshot', 'o', "Exit after initial execution of the network"],
         ['multiprocess', 'p', "Launch a separate process for each chain"],
+        ['no-metrics', None, "Do not record per-port metrics"],
+        ['check-multicast', None, "Log an error whenever a processor modifies an item received on a multicast connection (slow)"],
     ]
 
     optParameters = [
@@ -39,6 +62,28 @@ class Options(usage.Options):
         ['queuestatus', None, None, 'Path where status should be written to'],
         ['partition', None, None, 'Run the given partition of the graph (internal)'],
         ['protocol', None, None, 'The IPC protocol to use when running a partition (internal)'],
+        ['queue-limit', None, None, 'Pause sources when the number of queued items reaches this limit', int],
+        ['channel-queue-limit', None, None, 'Pause sources when the number of items queued for one port reaches this limit', int],
+        ['batch-size', None, 1, 'Maximum number of jobs started in one iteration of the queue', int],
+        ['batch-duration', None, None, 'Stop starting jobs in one iteration of the queue after this many seconds', float],
+        ['inline-depth', None, 0, 'Run up to this many downstream jobs immediately when their port is idle', int],
+        ['thread-pool-size', None, 4, 'Number of threads available to blocking processors', int],
+        ['process-pool-size', None, None, 'Number of worker processes available to CPU-bound processors (default: number of CPUs)', int],
+        ['max-tasks-per-child', None, None, 'Replace worker processes after they completed this many jobs', int],
+        ['executor-report-interval', None, None, 'Log executor statistics every given number of seconds', float],
+        ['metrics-interval', None, None, 'Log per-port metrics every given number of seconds', float],
+        ['journal', None, None, 'Path to a write-ahead journal of pending jobs, replayed on startup'],
+        ['journal-commit-interval', None, 0.1, 'Maximum number of seconds journal records are buffered', float],
+        ['record', None, None, 'Record items sent by sources (or the ports given by --record-ports) to a trace file'],
+        ['record-ports', None, None, 'Comma separated list of labels of output ports to record'],
+        ['trace-sample-rate', None, None, 'Trace the given fraction of items entering the flow across all hops', float],
+        ['trace-export', None, None, 'Write finished traces to the given file in Chrome trace-event JSON format on shutdown'],
+        ['drain', None, None, 'On shutdown, detach sources first and wait up to this many seconds for pending jobs to complete', float],
+        ['lifecycle-concurrency', None, None, 'Maximum number of components attached or detached at the same time', int],
+        ['attach-timeout', None, None, 'Seconds each component may take to attach', float],
+        ['detach-timeout', None, 10.0, 'Seconds each component may take to detach', float],
+        ['timeslice', None, 0.01, 'Seconds spent running the queue before returning control to the reactor', float],
+        ['tick-interval', None, task._EPSILON, 'Seconds between two timeslices of the queue', float], # pylint: disable=protected-access
     ]
 
 
@@ -65,6 +110,13 @@ class SpreadFlowService(service.Service):
         pipeline = list()
         pipeline.append(AliasResolverPass())
         pipeline.append(PortsValidatorPass())
+        pipeline.append(ConcurrencyExpanderPass())
+        pipeline.append(PriorityExpanderPass())
+        pipeline.append(ExecutorExpanderPass())
+        pipeline.append(CoalesceExpanderPass())
+        pipeline.append(ExpiryExpanderPass())
+        pipeline.append(RetryExpanderPass())
+        pipeline.append(FusableExpanderPass())
 
         if self.options['multiprocess']:
             pipeline.append(PartitionExpanderPass())
@@ -77,6 +129,7 @@ class SpreadFlowService(service.Service):
                 pipeline.append(PartitionControllersPass())
 
         pipeline.append(ComponentsPurgePass())
+        pipeline.append(FusionPass())
         pipeline.append(EventHandlersPass())
 
         for compiler_step in pipeline:
@@ -84,28 +137,161 @@ class SpreadFlowService(service.Service):
 
         self._eventdispatcher = EventDispatcher()
 
+        # Exit as soon as the whole graph (including worker processes) is
+        # idle.
         if self.options['oneshot']:
-            self._eventdispatcher.add_listener(JobEvent, 0, self._oneshot_job_event_handler)
+            self._eventdispatcher.add_listener(IdleEvent, 0, self._oneshot_idle_handler)
 
         connection_parser = ConnectionParser()
         stream = connection_parser.extract(stream)
-        self._scheduler = Scheduler(connection_parser.get_portmap(), self._eventdispatcher)
+        queue = JobQueue(limit=self.options['queue-limit'],
+                         channel_limit=self.options['channel-queue-limit'],
+                         batch_size=self.options['batch-size'],
+                         batch_duration=self.options['batch-duration'],
+                         inline_depth=self.options['inline-depth'])
+        portmap = connection_parser.get_portmap()
+        metrics = None if self.options['no-metrics'] else MetricsRegistry()
+
+        # Input ports in (deterministic) connection order. Multicast outputs
+        # map to a tuple of input ports.
+        ports_in = []
+        for port in portmap.values():
+            for port_in in (port if isinstance(port, tuple) else (port,)):
+                if port_in not in ports_in:
+                    ports_in.append(port_in)
+
+        # Input ports are identified in the journal by their position.
+        journal = None
+        if self.options['journal']:
+            journal = Journal(self.options['journal'], ports_in,
+                              commit_interval=self.options['journal-commit-interval'])
+
+        label_parser = LabelParser()
+        stream = label_parser.extract(stream)
+        labels = label_parser.get_labelmap()
+
+        recorder = None
+        if self.options['record']:
+            recorder = self._create_recorder(portmap, ports_in, labels)
+
+        # Worker processes follow traces started by the controller.
+        tracer = None
+        if self.options['trace-sample-rate'] or self.options['partition']:
+            tracer = LineageTracer(self.options['trace-sample-rate'] or 0, labels=labels)
+
+        self._scheduler = Scheduler(portmap, self._eventdispatcher, queue=queue,
+                                    timeslice=self.options['timeslice'],
+                                    tick_interval=self.options['tick-interval'],
+                                    metrics=metrics, journal=journal,
+                                    recorder=recorder, tracer=tracer,
+                                    check_multicast=self.options['check-multicast'],
+                                    lifecycle_concurrency=self.options['lifecycle-concurrency'],
+                                    attach_timeout=self.options['attach-timeout'])
+
+        ports_in = set(ports_in)
+
+        concurrency_parser = ConcurrencyParser()
+        stream = concurrency_parser.extract(stream)
+        for port, token in concurrency_parser.get_concurrencymap().items():
+            if port in ports_in:
+                self._scheduler.set_concurrency(port, token.concurrency, token.ordered)
+
+        priority_parser = PriorityParser()
+        stream = priority_parser.extract(stream)
+        for port, token in priority_parser.get_prioritymap().items():
+            if port in ports_in:
+                self._scheduler.set_priority(port, token.priority, token.weight)
+
+        coalesce_parser = CoalesceParser()
+        stream = coalesce_parser.extract(stream)
+        for port, token in coalesce_parser.get_coalescemap().items():
+            if port in ports_in:
+                self._scheduler.set_coalesce(port, token.key, token.merge)
+
+        expiry_parser = ExpiryParser()
+        stream = expiry_parser.extract(stream)
+        for port, token in expiry_parser.get_expirymap().items():
+            if port in ports_in:
+                self._scheduler.set_expiry(port, token.ttl, token.deadline, token.port)
+
+        retry_parser = RetryParser()
+        stream = retry_parser.extract(stream)
+        for port, token in retry_parser.get_retrymap().items():
+            if port in ports_in:
+                self._scheduler.set_retry(port, token.policy, token.port)
+
+        # Processors marked as blocking without an explicit executor share a
+        # thread pool. Processors with executor='process' share a process
+        # pool.
+        default_executors = {}
+        executor_parser = ExecutorParser()
+        stream = executor_parser.extract(stream)
+        for port, token in executor_parser.get_executormap().items():
+            if port in ports_in:
+                executor = token.executor
+                if executor is None or executor in ('thread', 'process'):
+                    kind = executor or 'thread'
+                    if kind not in default_executors:
+                        default_executors[kind] = self._create_executor(kind)
+                    executor = default_executors[kind]
+                self._scheduler.set_executor(port, executor)
 
         event_handler_parser = EventHandlerParser()
         stream = event_handler_parser.extract(stream)
-        for event_type, priority, callback in event_handler_parser.get_handlers():
-            self._eventdispatcher.add_listener(event_type, priority, callback)
+        self._eventdispatcher.add_listeners(event_handler_parser.get_handlers())
 
         if self.options['queuestatus']:
             statuslog = SpreadFlowQueuestatusLogger(self.options['queuestatus'])
             statuslog.watch(1, self._scheduler)
             globalLogPublisher.addObserver(statuslog.logstatus)
 
+        if metrics is not None and self.options['metrics-interval']:
+            metricslog = SpreadFlowMetricsLogger(labels)
+            metricslog.watch(self.options['metrics-interval'], self._scheduler)
+
         self._scheduler.run().addBoth(self._stop)
 
+    def _create_recorder(self, portmap, ports_in, labels):
+        names = {labels.get(port, str(port)): port for port in portmap}
+
+        if self.options['record-ports']:
+            ports = []
+            for name in self.options['record-ports'].split(','):
+                name = name.strip()
+                if name not in names:
+                    raise usage.UsageError('No output port labeled {:s}'.format(name))
+                ports.append(names[name])
+        else:
+            # Record items emitted by sources, i.e., output ports which do not
+            # receive any items themselves.
+            ports = [port for port in portmap if port not in ports_in]
+
+        return TraceRecorder(self.options['record'], ports,
+                             names=[labels.get(port, str(port)) for port in ports])
+
+    def _create_executor(self, kind):
+        if kind == 'process':
+            return ProcessPoolExecutor(size=self.options['process-pool-size'],
+                                       max_tasks_per_child=self.options['max-tasks-per-child'],
+                                       report_interval=self.options['executor-report-interval'])
+        else:
+            return ThreadPoolExecutor(size=self.options['thread-pool-size'],
+                                      report_interval=self.options['executor-report-interval'])
+
     def stopService(self):
         super(SpreadFlowService, self).stopService()
-        return self._scheduler.join()
+        deferred = self._scheduler.join(timeout=self.options['detach-timeout'],
+                                        drain=self.options['drain'])
+        if self.options['trace-export']:
+            deferred.addCallback(self._export_traces)
+        return deferred
+
+    def _export_traces(self, result):
+        tracer = self._scheduler.tracer
+        if tracer is not None:
+            with open(self.options['trace-export'], 'w') as fileobj:
+                tracer.export_chrome(fileobj)
+        return result
 
     def _stop(self, result):
         from twisted.internet import reactor
@@ -115,16 +301,8 @@ class SpreadFlowService(service.Service):
             pass
         return result
 
-    def _oneshot_job_event_handler(self, event):
-        scheduler = event.scheduler
-        completed = event.completed
-
-        def _stop_scheduler_when_done(result):
-            if len(scheduler.pending) == 0:
-                scheduler.stop(self)
-            return result
-
-        completed.addCallback(_stop_scheduler_when_done)
+    def _oneshot_idle_handler(self, event):
+        event.scheduler.stop(self)
 
 class SpreadFlowQueuestatusLogger(object):
     def __init__(self, path):
@@ -158,3 +336,35 @@ class SpreadFlowQueuestatusLogger(object):
         temp.write(status)
         temp.close()
         os.rename(temp.name, self.path)
+
+class SpreadFlowMetricsLogger(object):
+    """
+    Periodically emits one structured log event per port carrying the
+    metrics recorded since the last event.
+
+    Args:
+        labels (dict): A map port -> label used in log messages.
+    """
+
+    log = Logger()
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.task = None
+
+    def watch(self, interval, scheduler):
+        self.task = task.LoopingCall(self.logmetrics, scheduler)
+        self.task.start(interval, now=False)
+
+    def logmetrics(self, scheduler):
+        for port, stats in scheduler.port_stats(reset=True).items():
+            self.log.info('Port {port_label}: {received} received, {sent} sent, '
+                          '{failed} failed, {coalesced} coalesced, {expired} expired, {retried} retried, '
+                          '{dead_lettered} dead-lettered, wait p99 {wait_p99}, execution p99 {execution_p99}',
+                          port_label=self.labels.get(port, str(port)),
+                          received=stats.received, sent=stats.sent, failed=stats.failed,
+                          coalesced=stats.coalesced, expired=stats.expired,
+                          retried=stats.retried, dead_lettered=stats.dead_lettered,
+                          wait_p99=stats.wait.quantile(0.99),
+                          execution_p99=stats.execution.quantile(0.99),
+                          port_metrics=stats)
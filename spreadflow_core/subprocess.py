@@ -8,13 +8,41 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+from twisted.internet import defer
+
 from spreadflow_core.remote import ClientEndpointMixin, MessageHandler, SchedulerClientFactory, SchedulerProtocol, SchedulerServerFactory, SchedulerServerProtocol, ServerEndpointMixin
 from spreadflow_core.format import PickleMessageParser, PickleMessageBuilder
+from spreadflow_core.scheduler import IdleEvent
+
+def _trace_context(scheduler):
+    """
+    Returns the trace context of the running job, False if it was not
+    sampled or None if tracing is disabled.
+    """
+    if scheduler is not None and scheduler.tracer is not None:
+        return scheduler.tracer.current or False
+
+class ControllerMessageHandler(MessageHandler):
+    """
+    Message handler of a subprocess controller.
+
+    Keeps the scheduler of the controlling process busy as long as the worker
+    process may have outstanding work.
+    """
+
+    def __init__(self, scheduler, portmap, controller):
+        super(ControllerMessageHandler, self).__init__(scheduler, portmap)
+        self.controller = controller
+
+    def quiescent(self, quiescent):
+        self.scheduler.set_busy(self.controller, not quiescent)
 
 class SubprocessWorker(ServerEndpointMixin):
     """
     Subprocess worker component.
 
+    The worker reports to the controller whenever its scheduler becomes idle.
+
     Arguments:
         ins (string[]): A list of names for the input ports.
         outs (string[]): A list of names for the output ports.
@@ -26,12 +54,16 @@ class SubprocessWorker(ServerEndpointMixin):
         self._outnames = outnames or []
         self._ins = {}
         self._outs = {}
+        self._idle_listener = None
 
         for name in innames:
-            self._ins[name] = lambda item, send, port=name: self.peer.sendMessage(port, item)
+            self._ins[name] = lambda item, send, port=name: self._send_remote(port, item)
         for name in outnames:
             self._outs[name] = object()
 
+    def _send_remote(self, port, item):
+        self.peer.sendMessage(port, item, _trace_context(self.scheduler))
+
     @property
     def ins(self):
         return [self._ins[name] for name in self._innames]
@@ -40,6 +72,26 @@ class SubprocessWorker(ServerEndpointMixin):
     def outs(self):
         return [self._outs[name] for name in self._outnames]
 
+    @defer.inlineCallbacks
+    def attach(self, scheduler, reactor):
+        yield super(SubprocessWorker, self).attach(scheduler, reactor)
+
+        # Ship finished traces to the controller.
+        if scheduler.tracer is not None:
+            scheduler.tracer.forward = self.peer.sendSpans
+
+        self._idle_listener = scheduler.eventdispatcher.add_listener(IdleEvent, 0, self._report_idle)
+
+    def detach(self):
+        if self._idle_listener is not None:
+            self.scheduler.eventdispatcher.remove_listener(IdleEvent, self._idle_listener)
+            self._idle_listener = None
+        return super(SubprocessWorker, self).detach()
+
+    def _report_idle(self, event):
+        if self.peer is not None:
+            self.peer.sendIdle()
+
     def get_server_protocol_factory(self, scheduler, reactor):
         handler = MessageHandler(scheduler, self._outs)
         return SchedulerServerFactory.forProtocol(SchedulerServerProtocol,
@@ -52,6 +104,11 @@ class SubprocessController(ClientEndpointMixin):
     """
     Subprocess controller component.
 
+    The scheduler of the controlling process is marked busy from the time the
+    worker is started (or sent an item) until the worker reported that it is
+    idle and no items are in flight. Thus the scheduler only becomes idle once
+    the worker is done as well.
+
     Arguments:
         ins (string[]): A list of names for the input ports.
         outs (string[]): A list of names for the output ports.
@@ -65,10 +122,14 @@ class SubprocessController(ClientEndpointMixin):
         self._outs = {}
 
         for name in innames:
-            self._ins[name] = lambda item, send, port=name: self.peer.sendMessage(port, item)
+            self._ins[name] = lambda item, send, port=name: self._send_remote(port, item)
         for name in outnames:
             self._outs[name] = object()
 
+    def _send_remote(self, port, item):
+        self.scheduler.set_busy(self)
+        self.peer.sendMessage(port, item, _trace_context(self.scheduler))
+
     @property
     def ins(self):
         return [self._ins[name] for name in self._innames]
@@ -77,8 +138,13 @@ class SubprocessController(ClientEndpointMixin):
     def outs(self):
         return [self._outs[name] for name in self._outnames]
 
+    def attach(self, scheduler, reactor):
+        # The worker may start processing items right away.
+        scheduler.set_busy(self)
+        return super(SubprocessController, self).attach(scheduler, reactor)
+
     def get_client_protocol_factory(self, scheduler, reactor):
-        handler = MessageHandler(scheduler, self._outs)
+        handler = ControllerMessageHandler(scheduler, self._outs, self)
         return SchedulerClientFactory.forProtocol(SchedulerProtocol,
                                                   builder_factory=PickleMessageBuilder,
                                                   handler=handler,
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=too-many-public-methods
+
+"""
+Unit tests for the compiler passes.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import unittest
+
+from mock import Mock
+
+from spreadflow_core import scheduler
+from spreadflow_core.dsl.parser import \
+    CoalesceExpanderPass, \
+    ConcurrencyExpanderPass, \
+    ConnectionParser, \
+    EventHandlerParser, \
+    EventHandlersPass, \
+    FusionPass, \
+    PartitionBoundsPass, \
+    PartitionBoundsParser, \
+    PortsValidatorPass, \
+    PriorityExpanderPass
+from spreadflow_core.dsl.stream import AddTokenOp
+from spreadflow_core.dsl.tokens import \
+    CoalesceToken, \
+    ConcurrencyToken, \
+    ConnectionToken, \
+    FusableToken, \
+    ParentElementToken, \
+    PartitionToken, \
+    PriorityToken, \
+    RetryToken
+from spreadflow_core.proc import Fused
+
+class ExpanderPassTestCase(unittest.TestCase):
+    """
+    Unit tests for passes propagating tokens down the component tree.
+    """
+
+    def test_concurrency_expander(self):
+        """
+        Concurrency settings are inherited by children unless they are
+        overridden.
+        """
+        outer = object()
+        inner = object()
+        port1 = object()
+        port2 = object()
+        port3 = object()
+        other = object()
+
+        stream = [
+            AddTokenOp(ParentElementToken(inner, outer)),
+            AddTokenOp(ParentElementToken(port1, inner)),
+            AddTokenOp(ParentElementToken(port2, inner)),
+            AddTokenOp(ParentElementToken(port3, outer)),
+            AddTokenOp(ParentElementToken(other, None)),
+            AddTokenOp(ConcurrencyToken(outer, 4, False)),
+            AddTokenOp(ConcurrencyToken(port2, 2, True)),
+        ]
+
+        result = list(ConcurrencyExpanderPass()(stream))
+
+        self.assertIn(AddTokenOp(ConcurrencyToken(outer, 4, False)), result)
+        self.assertIn(AddTokenOp(ConcurrencyToken(inner, 4, False)), result)
+        self.assertIn(AddTokenOp(ConcurrencyToken(port1, 4, False)), result)
+        self.assertIn(AddTokenOp(ConcurrencyToken(port2, 2, True)), result)
+        self.assertIn(AddTokenOp(ConcurrencyToken(port3, 4, False)), result)
+        self.assertEqual(len([op for op in result if isinstance(op.token, ConcurrencyToken)]), 5)
+
+        # Other tokens are passed through.
+        self.assertIn(AddTokenOp(ParentElementToken(port1, inner)), result)
+        self.assertIn(AddTokenOp(ParentElementToken(other, None)), result)
+
+    def test_priority_expander(self):
+        """
+        Priority settings are inherited by children.
+        """
+        outer = object()
+        port1 = object()
+        port2 = object()
+
+        stream = [
+            AddTokenOp(ParentElementToken(port1, outer)),
+            AddTokenOp(ParentElementToken(port2, outer)),
+            AddTokenOp(PriorityToken(outer, -1, 2)),
+        ]
+
+        result = list(PriorityExpanderPass()(stream))
+
+        self.assertIn(AddTokenOp(PriorityToken(port1, -1, 2)), result)
+        self.assertIn(AddTokenOp(PriorityToken(port2, -1, 2)), result)
+
+    def test_coalesce_expander(self):
+        """
+        Coalescing policies are inherited by children.
+        """
+        outer = object()
+        port1 = object()
+        key = lambda item: item['path']
+
+        stream = [
+            AddTokenOp(ParentElementToken(port1, outer)),
+            AddTokenOp(CoalesceToken(outer, key, None)),
+        ]
+
+        result = list(CoalesceExpanderPass()(stream))
+
+        self.assertIn(AddTokenOp(CoalesceToken(port1, key, None)), result)
+
+class MulticastTestCase(unittest.TestCase):
+    """
+    Unit tests for output ports connected to more than one input port.
+    """
+
+    def test_portmap(self):
+        """
+        Multicast outputs map to a tuple of inputs in connection order.
+        """
+        source = object()
+        other = object()
+        sinks = [lambda item, send: None for _ in range(3)]
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, sinks[0])),
+            AddTokenOp(ConnectionToken(other, sinks[2])),
+            AddTokenOp(ConnectionToken(source, sinks[1])),
+            AddTokenOp(ConnectionToken(source, sinks[2])),
+        ]
+
+        connection_parser = ConnectionParser()
+        list(connection_parser.extract(PortsValidatorPass()(stream)))
+        self.assertEqual(connection_parser.get_portmap(), {
+            source: tuple(sinks),
+            other: sinks[2],
+        })
+
+    def test_partition_bounds(self):
+        """
+        Multicast outputs are sent across partition boundaries only once.
+        """
+        source = object()
+        sinks = [lambda item, send: None for _ in range(2)]
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, sinks[0])),
+            AddTokenOp(ConnectionToken(source, sinks[1])),
+            AddTokenOp(PartitionToken(source, 'a')),
+            AddTokenOp(PartitionToken(sinks[0], 'b')),
+            AddTokenOp(PartitionToken(sinks[1], 'b')),
+        ]
+
+        bounds_parser = PartitionBoundsParser()
+        list(bounds_parser.extract(PartitionBoundsPass()(stream)))
+        bounds = bounds_parser.get_partition_bounds()
+        self.assertEqual(bounds['a'].outs, [source])
+        self.assertEqual(bounds['b'].ins, sinks)
+
+class FusionPassTestCase(unittest.TestCase):
+    """
+    Unit tests for the operator fusion pass.
+    """
+
+    def _fuse(self, stream):
+        result = list(FusionPass()(stream))
+        connection_parser = ConnectionParser()
+        list(connection_parser.extract(result))
+        return result, connection_parser.get_portmap()
+
+    def test_fuse_linear_run(self):
+        """
+        A linear run of fusable processors is replaced by one fused processor.
+        """
+        source = object()
+        procs = [lambda item, send: None for _ in range(4)]
+        sink = lambda item, send: None
+        parent = object()
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, procs[0])),
+            AddTokenOp(ConnectionToken(procs[0], procs[1])),
+            AddTokenOp(ConnectionToken(procs[1], procs[2])),
+            AddTokenOp(ConnectionToken(procs[2], procs[3])),
+            AddTokenOp(ConnectionToken(procs[3], sink)),
+            AddTokenOp(ParentElementToken(procs[0], parent)),
+            AddTokenOp(ConcurrencyToken(procs[1], 4, False)),
+        ] + [AddTokenOp(FusableToken(proc, True)) for proc in procs]
+
+        result, portmap = self._fuse(stream)
+
+        fused = portmap[source]
+        self.assertIsInstance(fused, Fused)
+        self.assertEqual(fused.elements, procs)
+        self.assertEqual(portmap, {source: fused, procs[3]: sink})
+
+        # Elements without a parent are attached to the fused processor.
+        self.assertIn(AddTokenOp(ParentElementToken(procs[0], parent)), result)
+        for proc in procs[1:]:
+            self.assertIn(AddTokenOp(ParentElementToken(proc, fused)), result)
+
+        # Concurrency settings of interior elements are not propagated.
+        self.assertNotIn(AddTokenOp(ConcurrencyToken(fused, 4, False)), result)
+
+    def test_fuse_settings_from_head(self):
+        """
+        The fused processor takes over the settings of the first element.
+        """
+        source = object()
+        procs = [lambda item, send: None for _ in range(2)]
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, procs[0])),
+            AddTokenOp(ConnectionToken(procs[0], procs[1])),
+            AddTokenOp(ConcurrencyToken(procs[0], 4, True)),
+            AddTokenOp(PriorityToken(procs[0], -1, 2)),
+        ] + [AddTokenOp(FusableToken(proc, True)) for proc in procs]
+
+        result, portmap = self._fuse(stream)
+
+        fused = portmap[source]
+        self.assertIn(AddTokenOp(ConcurrencyToken(fused, 4, True)), result)
+        self.assertIn(AddTokenOp(PriorityToken(fused, -1, 2)), result)
+
+    def test_fuse_boundaries(self):
+        """
+        Runs are split at non-fusable elements, partition boundaries and
+        elements with more than one upstream connection.
+        """
+        source = object()
+        other = object()
+        procs = [lambda item, send: None for _ in range(7)]
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, procs[0])),
+            AddTokenOp(ConnectionToken(procs[0], procs[1])),
+            AddTokenOp(ConnectionToken(procs[1], procs[2])),
+            AddTokenOp(ConnectionToken(procs[2], procs[3])),
+            AddTokenOp(ConnectionToken(procs[3], procs[4])),
+            AddTokenOp(ConnectionToken(procs[4], procs[5])),
+            AddTokenOp(ConnectionToken(other, procs[5])),
+            AddTokenOp(ConnectionToken(procs[5], procs[6])),
+            AddTokenOp(FusableToken(procs[0], True)),
+            AddTokenOp(FusableToken(procs[1], True)),
+            AddTokenOp(FusableToken(procs[2], False)),
+            AddTokenOp(FusableToken(procs[3], True)),
+            AddTokenOp(FusableToken(procs[4], True)),
+            AddTokenOp(FusableToken(procs[5], True)),
+            AddTokenOp(FusableToken(procs[6], True)),
+            AddTokenOp(PartitionToken(procs[3], 'a')),
+            AddTokenOp(PartitionToken(procs[4], 'b')),
+        ]
+
+        _, portmap = self._fuse(stream)
+
+        self.assertEqual(portmap[source].elements, procs[0:2])
+        self.assertIs(portmap[procs[1]], procs[2])
+        self.assertIs(portmap[procs[2]], procs[3])
+        self.assertIs(portmap[procs[3]], procs[4])
+
+        fused = portmap[procs[4]]
+        self.assertIs(portmap[other], fused)
+        self.assertEqual(fused.elements, procs[5:7])
+
+    def test_fuse_multicast(self):
+        """
+        Multicast outputs are never fused.
+        """
+        source = object()
+        procs = [lambda item, send: None for _ in range(3)]
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, procs[0])),
+            AddTokenOp(ConnectionToken(procs[0], procs[1])),
+            AddTokenOp(ConnectionToken(procs[0], procs[2])),
+        ] + [AddTokenOp(FusableToken(proc, True)) for proc in procs]
+
+        _, portmap = self._fuse(stream)
+
+        self.assertEqual(portmap, {source: procs[0], procs[0]: (procs[1], procs[2])})
+
+    def test_fuse_coalesce(self):
+        """
+        Elements with a coalescing policy only start a run, the policy is
+        taken over by the fused processor.
+        """
+        source = object()
+        procs = [lambda item, send: None for _ in range(4)]
+        key = lambda item: item['path']
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, procs[0])),
+            AddTokenOp(ConnectionToken(procs[0], procs[1])),
+            AddTokenOp(ConnectionToken(procs[1], procs[2])),
+            AddTokenOp(ConnectionToken(procs[2], procs[3])),
+            AddTokenOp(CoalesceToken(procs[0], key, None)),
+            AddTokenOp(CoalesceToken(procs[2], key, None)),
+        ] + [AddTokenOp(FusableToken(proc, True)) for proc in procs]
+
+        result, portmap = self._fuse(stream)
+
+        head = portmap[source]
+        self.assertEqual(head.elements, procs[0:2])
+        tail = portmap[procs[1]]
+        self.assertEqual(tail.elements, procs[2:4])
+        self.assertIn(AddTokenOp(CoalesceToken(head, key, None)), result)
+        self.assertIn(AddTokenOp(CoalesceToken(tail, key, None)), result)
+
+    def test_fuse_retry(self):
+        """
+        Elements with a retry policy are never fused.
+        """
+        source = object()
+        procs = [lambda item, send: None for _ in range(4)]
+        policy = object()
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, procs[0])),
+            AddTokenOp(ConnectionToken(procs[0], procs[1])),
+            AddTokenOp(ConnectionToken(procs[1], procs[2])),
+            AddTokenOp(ConnectionToken(procs[2], procs[3])),
+            AddTokenOp(RetryToken(procs[1], policy, None)),
+        ] + [AddTokenOp(FusableToken(proc, True)) for proc in procs]
+
+        result, portmap = self._fuse(stream)
+
+        self.assertIs(portmap[source], procs[0])
+        self.assertIs(portmap[procs[0]], procs[1])
+        tail = portmap[procs[1]]
+        self.assertEqual(tail.elements, procs[2:4])
+        self.assertIn(AddTokenOp(RetryToken(procs[1], policy, None)), result)
+
+class EventHandlersPassTestCase(unittest.TestCase):
+    """
+    Unit tests for the event handlers pass.
+    """
+
+    def test_drain_sources(self):
+        """
+        Sources are detached on drain and only once, other components only on
+        detach.
+        """
+        source = Mock(spec=['attach', 'detach'])
+        sink = Mock(spec=['attach', 'detach', '__call__'])
+        chain = Mock(spec=['attach', 'detach'])
+        proc = Mock(spec=['__call__'])
+
+        stream = [
+            AddTokenOp(ConnectionToken(source, proc)),
+            AddTokenOp(ConnectionToken(proc, sink)),
+            AddTokenOp(ParentElementToken(proc, chain)),
+        ]
+
+        handler_parser = EventHandlerParser()
+        list(handler_parser.extract(EventHandlersPass()(stream)))
+        handlers = handler_parser.get_handlers()
+
+        def _dispatch(event_type):
+            for handler_type, _, callback in handlers:
+                if handler_type is event_type:
+                    callback(event_type(scheduler=None))
+
+        _dispatch(scheduler.DrainEvent)
+        source.detach.assert_called_once_with()
+        self.assertEqual(sink.detach.call_count, 0)
+        self.assertEqual(chain.detach.call_count, 0)
+
+        _dispatch(scheduler.DetachEvent)
+        source.detach.assert_called_once_with()
+        sink.detach.assert_called_once_with()
+        chain.detach.assert_called_once_with()
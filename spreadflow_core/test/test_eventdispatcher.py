@@ -5,9 +5,10 @@ from __future__ import unicode_literals
 from mock import Mock
 from testtools import matchers, twistedsupport
 from testtools.assertions import assert_that
+from twisted.internet import defer, task
 from unittest import TestCase
 
-from spreadflow_core.eventdispatcher import EventDispatcher, HandlerError, FailMode
+from spreadflow_core.eventdispatcher import EventDispatcher, HandlerError, FailMode, Handler
 
 class TestEvent(object):
     pass
@@ -15,6 +16,9 @@ class TestEvent(object):
 class OtherEvent(object):
     pass
 
+class DerivedEvent(TestEvent):
+    pass
+
 class EventDispatcherTestCase(TestCase):
 
     def test_manage_listeners(self):
@@ -176,3 +180,185 @@ class EventDispatcherTestCase(TestCase):
         self.assertTrue(d.called)
 
         callback.assert_called_once_with(event, 'hello', 'world', some='kwds', also='here')
+
+    def test_dispatch_plan(self):
+        dispatcher = EventDispatcher()
+
+        callback_0 = Mock(return_value='hello')
+        callback_1 = Mock(return_value='world')
+
+        dispatcher.add_listener(TestEvent, 1, callback_1)
+        plan = dispatcher.get_plan(TestEvent)
+        self.assertIs(dispatcher.get_plan(TestEvent), plan)
+
+        # Plan is rebuilt when listeners change.
+        key = dispatcher.add_listener(TestEvent, 0, callback_0)
+        self.assertEqual(dispatcher.get_plan(TestEvent), (
+            (0, (Handler(callback_0, (), {}),)),
+            (1, (Handler(callback_1, (), {}),)),
+        ))
+
+        d = dispatcher.dispatch(TestEvent())
+        assert_that(d, twistedsupport.succeeded(matchers.Equals([
+            (0, [(True, 'hello')]),
+            (1, [(True, 'world')]),
+        ])))
+
+        dispatcher.remove_listener(TestEvent, key)
+        self.assertEqual(dispatcher.get_plan(TestEvent), (
+            (1, (Handler(callback_1, (), {}),)),
+        ))
+        self.assertEqual(dispatcher.get_plan(OtherEvent), ())
+
+    def test_dispatch_deferred(self):
+        dispatcher = EventDispatcher()
+
+        inner = defer.Deferred()
+        callback_0 = Mock(return_value='hello')
+        callback_1 = Mock(return_value=inner)
+        callback_2 = Mock(return_value='world')
+
+        dispatcher.add_listener(TestEvent, 0, callback_0)
+        dispatcher.add_listener(TestEvent, 1, callback_1)
+        dispatcher.add_listener(TestEvent, 2, callback_2)
+
+        event = TestEvent()
+        d = dispatcher.dispatch(event)
+        assert_that(d, twistedsupport.has_no_result())
+        self.assertEqual(callback_2.call_count, 0)
+
+        inner.callback('waiting')
+        assert_that(d, twistedsupport.succeeded(matchers.Equals([
+            (0, [(True, 'hello')]),
+            (1, [(True, 'waiting')]),
+            (2, [(True, 'world')]),
+        ])))
+        callback_2.assert_called_once_with(event)
+
+    def test_add_listeners(self):
+        dispatcher = EventDispatcher()
+
+        callbacks = [Mock() for _ in range(4)]
+        dispatcher.add_listener(TestEvent, 1, callbacks[0])
+        keys = dispatcher.add_listeners([
+            (TestEvent, 1, callbacks[1]),
+            (OtherEvent, 0, callbacks[2]),
+            (TestEvent, 0, callbacks[3]),
+        ])
+        self.assertEqual(len(keys), 3)
+
+        actual_handlers = [(key.priority, handler.callback) for key, handler in dispatcher.get_listeners(TestEvent)]
+        self.assertEqual(actual_handlers, [
+            (0, callbacks[3]),
+            (1, callbacks[0]),
+            (1, callbacks[1]),
+        ])
+
+        # Removal in any order keeps the remaining listeners in order.
+        self.assertEqual(dispatcher.remove_listener(TestEvent, keys[2]),
+                         Handler(callbacks[3], (), {}))
+        self.assertEqual(dispatcher.remove_listener(OtherEvent, keys[1]),
+                         Handler(callbacks[2], (), {}))
+        self.assertRaises(KeyError, dispatcher.remove_listener, TestEvent, keys[1]._replace(priority=0))
+
+        event = TestEvent()
+        dispatcher.dispatch(event)
+        callbacks[0].assert_called_once_with(event)
+        callbacks[1].assert_called_once_with(event)
+        self.assertEqual(callbacks[3].call_count, 0)
+        self.assertEqual(list(dispatcher.get_listeners(OtherEvent)), [])
+
+        # Priorities freed by removal can be used again.
+        callback_first = Mock()
+        dispatcher.add_listeners([(TestEvent, 0, callback_first), (OtherEvent, 2, callback_first)])
+        self.assertEqual([(key.priority, handler.callback) for key, handler in dispatcher.get_listeners(TestEvent)], [
+            (0, callback_first),
+            (1, callbacks[0]),
+            (1, callbacks[1]),
+        ])
+
+    def test_dispatch_concurrency_timeout(self):
+        dispatcher = EventDispatcher()
+        clock = task.Clock()
+
+        inner = [defer.Deferred() for _ in range(3)]
+        callbacks = [Mock(return_value=deferred) for deferred in inner]
+        callback_sync = Mock(return_value='sync')
+        for callback in callbacks:
+            dispatcher.add_listener(TestEvent, 0, callback)
+        dispatcher.add_listener(TestEvent, 0, callback_sync)
+
+        timings = []
+        d = dispatcher.dispatch(TestEvent(), fail_mode=FailMode.RETURN, concurrency=2,
+                                timeout=5, reactor=clock, timings=timings)
+
+        # Only two handlers run at the same time.
+        self.assertEqual([callback.call_count for callback in callbacks], [1, 1, 0])
+        self.assertEqual(callback_sync.call_count, 0)
+
+        clock.advance(1)
+        inner[0].callback('first')
+        self.assertEqual(callbacks[2].call_count, 1)
+
+        # The second handler times out.
+        clock.advance(4)
+        self.assertEqual(callback_sync.call_count, 1)
+        inner[2].callback('third')
+
+        def _result(group_results):
+            return [(success, value if success else value.value.wrapped_failure.type)
+                    for success, value in group_results[0][1]]
+        assert_that(d, twistedsupport.succeeded(matchers.AfterPreprocessing(_result, matchers.Equals([
+            (True, 'first'),
+            (False, defer.TimeoutError),
+            (True, 'third'),
+            (True, 'sync'),
+        ]))))
+
+        self.assertEqual([(timing.handler.callback, timing.seconds, timing.success) for timing in timings], [
+            (callbacks[0], 1, True),
+            (callbacks[1], 5, False),
+            (callback_sync, 0, True),
+            (callbacks[2], 4, True),
+        ])
+
+    def test_dispatch_hierarchy(self):
+        dispatcher = EventDispatcher()
+
+        callback_base = Mock()
+        callback_derived = Mock()
+        callback_object = Mock()
+
+        dispatcher.add_listener(DerivedEvent, 1, callback_derived)
+        dispatcher.add_listener(TestEvent, 1, callback_base)
+        self.assertEqual(dispatcher.get_plan(DerivedEvent), (
+            (1, (Handler(callback_derived, (), {}), Handler(callback_base, (), {}))),
+        ))
+        self.assertEqual(dispatcher.get_plan(TestEvent), (
+            (1, (Handler(callback_base, (), {}),)),
+        ))
+        plan_other = dispatcher.get_plan(OtherEvent)
+        self.assertEqual(plan_other, ())
+
+        # Listeners of base classes invalidate cached plans of subclasses
+        # only.
+        key = dispatcher.add_listener(TestEvent, 0, callback_base)
+        self.assertIs(dispatcher.get_plan(OtherEvent), plan_other)
+        self.assertEqual(dispatcher.get_plan(DerivedEvent), (
+            (0, (Handler(callback_base, (), {}),)),
+            (1, (Handler(callback_derived, (), {}), Handler(callback_base, (), {}))),
+        ))
+
+        dispatcher.remove_listener(TestEvent, key)
+        dispatcher.add_listeners([(object, 2, callback_object)])
+        self.assertEqual(dispatcher.get_plan(DerivedEvent), (
+            (1, (Handler(callback_derived, (), {}), Handler(callback_base, (), {}))),
+            (2, (Handler(callback_object, (), {}),)),
+        ))
+
+        event = DerivedEvent()
+        dispatcher.dispatch(event)
+        dispatcher.dispatch(OtherEvent())
+        callback_derived.assert_called_once_with(event)
+        callback_base.assert_called_once_with(event)
+        self.assertEqual(callback_object.call_count, 2)
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for executors.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import pickle
+import threading
+
+from mock import Mock, call
+from testtools import matchers, twistedsupport
+from testtools.assertions import assert_that
+from unittest import TestCase
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from twisted.internet import error, task
+from twisted.python.failure import Failure
+
+from spreadflow_core.executor import ProcessPoolExecutor, ThreadPoolExecutor, WorkerCrashedError
+from spreadflow_core.format import PickleMessageBuilder, PickleMessageParser
+from spreadflow_core.scheduler import Scheduler
+from spreadflow_core.scripts.spreadflow_poolworker import handle_message
+
+
+class _ThreadedReactor(object):
+    """
+    Records calls scheduled from worker threads and runs them on demand.
+    """
+
+    def __init__(self):
+        self.calls = queue.Queue()
+
+    def callFromThread(self, func, *args, **kwds): # pylint: disable=invalid-name
+        self.calls.put((func, args, kwds))
+
+    def run_until(self, deferred, timeout=5):
+        while not deferred.called:
+            func, args, kwds = self.calls.get(timeout=timeout)
+            func(*args, **kwds)
+
+
+class _ProcessTransport(object):
+    def __init__(self):
+        self.parser = PickleMessageParser(2**23)
+        self.stdin_closed = False
+
+    def write(self, data):
+        self.parser.push(data)
+
+    def closeStdin(self): # pylint: disable=invalid-name
+        self.stdin_closed = True
+
+    def messages(self):
+        return list(self.parser.messages())
+
+
+class _ProcessReactor(task.Clock):
+    """
+    Records spawned processes.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.processes = []
+
+    def spawnProcess(self, proto, executable, args, env=None, childFDs=None): # pylint: disable=invalid-name
+        proto.makeConnection(_ProcessTransport())
+        self.processes.append(proto)
+
+
+class _Square(object):
+    """
+    A picklable processor with a secondary output port.
+    """
+
+    def __init__(self):
+        self.out_odd = object()
+
+    def __call__(self, item, send):
+        if item % 2:
+            send(item, self.out_odd)
+        send(item * item, self)
+
+
+class ThreadPoolExecutorTestCase(TestCase):
+
+    def setUp(self):
+        super(ThreadPoolExecutorTestCase, self).setUp()
+        self.reactor = _ThreadedReactor()
+        self.sut = ThreadPoolExecutor(size=2)
+        self.sut.attach(Mock(spec=Scheduler), self.reactor)
+        self.addCleanup(self.sut.detach)
+
+    def test_execute(self):
+        """
+        The processor runs on a worker thread, items are delivered on the
+        calling thread.
+        """
+        threads = []
+        port = object()
+
+        def blocking(item, send):
+            threads.append(threading.current_thread())
+            send(item + '-1', port)
+            send(item + '-2', port)
+
+        send_threads = []
+        send = Mock(spec=Scheduler.send, side_effect=lambda item, port_out:
+                    send_threads.append(threading.current_thread()))
+
+        completed = self.sut.execute(blocking, 'msg', send)
+        self.assertEqual(self.sut.stats().running, 1)
+
+        self.reactor.run_until(completed)
+
+        assert_that(completed, twistedsupport.succeeded(matchers.Is(None)))
+        self.assertEqual(send.call_args_list, [call('msg-1', port), call('msg-2', port)])
+        self.assertNotEqual(threads, [threading.current_thread()])
+        self.assertEqual(send_threads, [threading.current_thread()] * 2)
+
+        stats = self.sut.stats()
+        self.assertEqual((stats.size, stats.queued, stats.running), (2, 0, 0))
+        self.assertGreaterEqual(stats.busy, 0)
+
+    def test_queue_depth(self):
+        """
+        Jobs exceeding the pool size are reported as queued.
+        """
+        release = threading.Event()
+        blocking = lambda item, send: release.wait(5)
+        send = Mock(spec=Scheduler.send)
+
+        jobs = [self.sut.execute(blocking, idx, send) for idx in range(3)]
+
+        stats = self.sut.stats()
+        self.assertEqual((stats.queued, stats.running), (1, 2))
+
+        release.set()
+        for completed in jobs:
+            self.reactor.run_until(completed)
+
+        stats = self.sut.stats()
+        self.assertEqual((stats.queued, stats.running), (0, 0))
+
+    def test_failure(self):
+        """
+        Exceptions raised by the processor are passed back to the caller.
+        """
+        def failing(item, send):
+            raise RuntimeError('boom')
+
+        completed = self.sut.execute(failing, 'msg', Mock(spec=Scheduler.send))
+        self.reactor.run_until(completed)
+
+        assert_that(completed, twistedsupport.failed(matchers.AfterPreprocessing(
+            lambda failure: failure.value, matchers.IsInstance(RuntimeError))))
+
+
+class ProcessPoolExecutorTestCase(TestCase):
+
+    def setUp(self):
+        super(ProcessPoolExecutorTestCase, self).setUp()
+        self.reactor = _ProcessReactor()
+        self.builder = PickleMessageBuilder()
+
+    def _reply(self, worker, msg):
+        worker.outReceived(self.builder.message(msg))
+
+    def test_execute(self):
+        """
+        Jobs are distributed to idle workers, the processor is sent only once
+        per worker.
+        """
+        sut = ProcessPoolExecutor(size=2)
+        sut.attach(Mock(spec=Scheduler), self.reactor)
+        self.assertEqual(len(self.reactor.processes), 2)
+        first, second = self.reactor.processes
+
+        func = _Square()
+        send = Mock(spec=Scheduler.send)
+        jobs = [sut.execute(func, idx, send) for idx in range(3)]
+
+        stats = sut.stats()
+        self.assertEqual((stats.queued, stats.running), (1, 2))
+
+        msgs = first.transport.messages()
+        self.assertEqual(len(msgs), 1)
+        self.assertIn('func', msgs[0])
+        self.assertEqual(msgs[0]['item'], 0)
+
+        self.reactor.advance(1)
+        self._reply(first, {'job': msgs[0]['job'], 'sends': [(0, None)]})
+        assert_that(jobs[0], twistedsupport.succeeded(matchers.Is(None)))
+        self.assertEqual(send.call_args_list, [call(0, func)])
+        self.assertEqual(sut.stats().busy, 1)
+
+        # Third job goes to the first worker, without the processor.
+        msgs = first.transport.messages()
+        self.assertEqual(len(msgs), 1)
+        self.assertNotIn('func', msgs[0])
+        self.assertEqual(msgs[0]['item'], 2)
+
+        msgs = second.transport.messages()
+        self._reply(second, {'job': msgs[0]['job'], 'sends': [(1, 'out_odd'), (1, None)]})
+        assert_that(jobs[1], twistedsupport.succeeded(matchers.Is(None)))
+        self.assertEqual(send.call_args_list[1:], [call(1, func.out_odd), call(1, func)])
+
+    def test_worker_crash(self):
+        """
+        Only the job running on a crashed worker fails, the worker is
+        replaced.
+        """
+        sut = ProcessPoolExecutor(size=2)
+        sut.attach(Mock(spec=Scheduler), self.reactor)
+        first, second = self.reactor.processes
+
+        send = Mock(spec=Scheduler.send)
+        jobs = [sut.execute(_Square(), idx, send) for idx in range(2)]
+
+        first.processEnded(Failure(error.ProcessTerminated(exitCode=3)))
+        assert_that(jobs[0], twistedsupport.failed(matchers.AfterPreprocessing(
+            lambda failure: failure.value, matchers.IsInstance(WorkerCrashedError))))
+        assert_that(jobs[1], twistedsupport.has_no_result())
+        self.assertEqual(len(self.reactor.processes), 3)
+
+        msgs = second.transport.messages()
+        self._reply(second, {'job': msgs[0]['job'], 'sends': []})
+        assert_that(jobs[1], twistedsupport.succeeded(matchers.Is(None)))
+
+    def test_idle_worker_crash(self):
+        """
+        Workers which die before running any job are replaced as well.
+        """
+        sut = ProcessPoolExecutor(size=2)
+        sut.attach(Mock(spec=Scheduler), self.reactor)
+        first, second = self.reactor.processes
+
+        first.processEnded(Failure(error.ProcessTerminated(exitCode=9)))
+        second.processEnded(Failure(error.ProcessTerminated(exitCode=9)))
+        self.assertEqual(len(self.reactor.processes), 4)
+
+        job = sut.execute(_Square(), 2, Mock(spec=Scheduler.send))
+        third = self.reactor.processes[2]
+        msgs = third.transport.messages()
+        self.assertEqual(len(msgs), 1)
+        self._reply(third, {'job': msgs[0]['job'], 'sends': []})
+        assert_that(job, twistedsupport.succeeded(matchers.Is(None)))
+
+    def test_worker_start_failure(self):
+        """
+        Workers are not replaced if they keep exiting prematurely, jobs fail
+        once no worker is left.
+        """
+        sut = ProcessPoolExecutor(size=1)
+        sut.attach(Mock(spec=Scheduler), self.reactor)
+
+        self.reactor.processes[0].processEnded(Failure(error.ProcessTerminated(exitCode=1)))
+        self.assertEqual(len(self.reactor.processes), 2)
+        self.reactor.processes[1].processEnded(Failure(error.ProcessTerminated(exitCode=1)))
+        self.assertEqual(len(self.reactor.processes), 2)
+
+        job = sut.execute(_Square(), 2, Mock(spec=Scheduler.send))
+        assert_that(job, twistedsupport.failed(matchers.AfterPreprocessing(
+            lambda failure: failure.value, matchers.IsInstance(WorkerCrashedError))))
+
+    def test_max_tasks_per_child(self):
+        """
+        Workers are replaced after completing the given number of jobs.
+        """
+        sut = ProcessPoolExecutor(size=1, max_tasks_per_child=1)
+        sut.attach(Mock(spec=Scheduler), self.reactor)
+        worker, = self.reactor.processes
+
+        job = sut.execute(_Square(), 2, Mock(spec=Scheduler.send))
+        msgs = worker.transport.messages()
+        self._reply(worker, {'job': msgs[0]['job'], 'sends': []})
+        assert_that(job, twistedsupport.succeeded(matchers.Is(None)))
+
+        self.assertTrue(worker.transport.stdin_closed)
+        self.assertEqual(len(self.reactor.processes), 2)
+
+        worker.processEnded(Failure(error.ProcessDone(0)))
+        self.assertEqual(len(self.reactor.processes), 2)
+
+        detached = sut.detach()
+        assert_that(detached, twistedsupport.has_no_result())
+        self.reactor.processes[1].processEnded(Failure(error.ProcessDone(0)))
+        assert_that(detached, twistedsupport.succeeded(matchers.Always()))
+
+    def test_worker_handle_message(self):
+        """
+        The worker runs the processor and collects items sent.
+        """
+        funcs = {}
+        func = _Square()
+        msg = {'job': 7, 'key': 0, 'item': 3,
+               'func': pickle.dumps(func, protocol=2)}
+
+        reply = handle_message(funcs, msg)
+        self.assertEqual(reply, {'job': 7, 'sends': [(3, 'out_odd'), (9, None)]})
+
+        reply = handle_message(funcs, {'job': 8, 'key': 0, 'item': 'x'})
+        self.assertEqual(reply['job'], 8)
+        self.assertIn('TypeError', reply['error'])
@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mock import Mock, call
+from unittest import TestCase
+
+from spreadflow_core.scheduler import Scheduler
+
+from spreadflow_core.proc import Fused
+
+class _Append(object):
+    def __init__(self, suffix):
+        self.suffix = suffix
+        self.side = object()
+
+    def __call__(self, item, send):
+        if item == 'side':
+            send(item, self.side)
+        send(item + self.suffix, self)
+
+class _Fail(object):
+    def __call__(self, item, send):
+        raise RuntimeError('boom')
+
+class FusedTestCase(TestCase):
+
+    def test_run_chain(self):
+        first = _Append('-a')
+        second = _Append('-b')
+        sut = Fused([first, second])
+
+        send = Mock(spec=Scheduler.send)
+        sut('msg', send)
+        self.assertEquals(send.call_args_list, [call('msg-a-b', second)])
+
+    def test_side_output(self):
+        first = _Append('-a')
+        second = _Append('-b')
+        sut = Fused([first, second])
+
+        send = Mock(spec=Scheduler.send)
+        sut('side', send)
+        self.assertEquals(send.call_args_list, [
+            call('side', first.side),
+            call('side-a-b', second)
+        ])
+
+    def test_failing_element(self):
+        first = _Append('-a')
+        failing = _Fail()
+        sut = Fused([first, failing, _Append('-c')])
+
+        send = Mock(spec=Scheduler.send)
+        sut.log = Mock()
+        self.assertRaises(RuntimeError, sut, 'msg', send)
+        self.assertEquals(send.call_count, 0)
+        self.assertEquals(sut.log.error.call_count, 1)
+        self.assertIs(sut.log.error.call_args[1]['element'], failing)
+        self.assertEquals(sut.log.error.call_args[1]['item'], 'msg-a')
@@ -10,7 +10,7 @@ import sys
 from twisted.internet import defer
 import unittest
 
-from spreadflow_core.jobqueue import JobQueue
+from spreadflow_core.jobqueue import JobExpiredError, JobQueue
 
 
 if sys.version_info < (3, 0):
@@ -146,3 +146,482 @@ class JobQueueTestCase(unittest.TestCase):
 
         self.assertTrue(outer.called)
         self.assertTrue(inner.called)
+
+    def test_busy_channel_does_not_block_others(self):
+        """
+        Jobs on other channels are executed while a channel waits for a job
+        returning a deferred.
+        """
+        results = []
+        inner = defer.Deferred()
+
+        channel_1 = object()
+        channel_2 = object()
+        queue = JobQueue()
+
+        queue.put(channel_1, lambda: inner)
+        queue.put(channel_1, results.append, 'one')
+        queue.put(channel_2, results.append, 'two')
+
+        self.assertIsNone(_next(queue))
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, ['two'])
+
+        # Channel one is still blocked.
+        queue_ready = _next(queue)
+        self.assertIsInstance(queue_ready, defer.Deferred)
+        self.assertFalse(queue_ready.called)
+
+        inner.callback(None)
+        self.assertTrue(queue_ready.called)
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, ['two', 'one'])
+
+    def test_serves_channels_round_robin(self):
+        """
+        Channels with jobs waiting in the backlog are served in turn.
+        """
+        results = []
+
+        channel_1 = object()
+        channel_2 = object()
+        queue = JobQueue()
+
+        queue.put(channel_1, results.append, '1a')
+        queue.put(channel_1, results.append, '1b')
+        queue.put(channel_1, results.append, '1c')
+        queue.put(channel_2, results.append, '2a')
+        queue.put(channel_2, results.append, '2b')
+
+        for _ in range(5):
+            self.assertIsNone(_next(queue))
+
+        self.assertEqual(results, ['1a', '2a', '1b', '2b', '1c'])
+        self.assertIsInstance(_next(queue), defer.Deferred)
+
+    def test_cancel_job_in_the_middle(self):
+        """
+        Cancelling a job waiting in the backlog does not affect other jobs on
+        the same channel.
+        """
+        results = []
+
+        channel = object()
+        queue = JobQueue()
+
+        queue.put(channel, results.append, 'first')
+        middle = queue.put(channel, results.append, 'middle')
+        queue.put(channel, results.append, 'last')
+
+        middle.addErrback(lambda failure: failure.trap(defer.CancelledError))
+        middle.cancel()
+        self.assertTrue(middle.called)
+
+        self.assertIsNone(_next(queue))
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, ['first', 'last'])
+
+        queue.stopempty = True
+        self.assertRaises(StopIteration, _next, queue)
+
+    def test_stopempty_after_cancel_all(self):
+        """
+        Iteration stops if all jobs in the backlog were cancelled.
+        """
+        channel = object()
+        queue = JobQueue()
+
+        jobs = [queue.put(channel, self.fail) for _ in range(3)]
+        for job in jobs:
+            job.addErrback(lambda failure: failure.trap(defer.CancelledError))
+            job.cancel()
+
+        queue.stopempty = True
+        self.assertRaises(StopIteration, _next, queue)
+
+        # The channel is reusable afterwards.
+        queue.stopempty = False
+        job_completed = queue.put(channel, lambda: 'Bazinga!')
+        self.assertIsNone(_next(queue))
+        self.assertTrue(job_completed.called)
+
+    def test_backlog_limit(self):
+        """
+        The queue becomes congested when the backlog limit is reached and
+        writable again when it drained below the low-water mark.
+        """
+        channel = object()
+        queue = JobQueue(limit=4, lowat=0.5)
+
+        for _ in range(3):
+            queue.put(channel, lambda: None)
+        self.assertTrue(queue.writable())
+        self.assertTrue(queue.wait_writable().called)
+
+        queue.put(channel, lambda: None)
+        self.assertFalse(queue.writable())
+        self.assertFalse(queue.writable(channel))
+
+        writable = queue.wait_writable()
+        self.assertFalse(writable.called)
+
+        # Three items remaining, still above the low-water mark.
+        self.assertIsNone(_next(queue))
+        self.assertFalse(writable.called)
+
+        # Two items remaining.
+        self.assertIsNone(_next(queue))
+        self.assertTrue(writable.called)
+        self.assertTrue(queue.writable())
+
+    def test_channel_backlog_limit(self):
+        """
+        A congested channel does not affect other channels.
+        """
+        channel_1 = object()
+        channel_2 = object()
+        queue = JobQueue(channel_limit=2, lowat=0)
+
+        queue.put(channel_1, lambda: None)
+        cancelled = queue.put(channel_1, lambda: None)
+        queue.put(channel_2, lambda: None)
+
+        self.assertFalse(queue.writable())
+        self.assertFalse(queue.writable(channel_1))
+        self.assertTrue(queue.writable(channel_2))
+
+        writable_1 = queue.wait_writable(channel_1)
+        writable_2 = queue.wait_writable(channel_2)
+        self.assertFalse(writable_1.called)
+        self.assertTrue(writable_2.called)
+
+        cancelled.addErrback(lambda failure: failure.trap(defer.CancelledError))
+        cancelled.cancel()
+        self.assertFalse(writable_1.called)
+
+        self.assertIsNone(_next(queue))
+        self.assertTrue(writable_1.called)
+        self.assertTrue(queue.writable())
+
+    def test_channel_concurrency(self):
+        """
+        Up to the configured number of jobs execute at the same time on a
+        channel.
+        """
+        inner = [defer.Deferred() for _ in range(3)]
+        started = []
+
+        def job(idx):
+            started.append(idx)
+            return inner[idx]
+
+        channel = object()
+        queue = JobQueue()
+        queue.set_concurrency(channel, 2)
+
+        completed = [queue.put(channel, job, idx) for idx in range(3)]
+
+        self.assertIsNone(_next(queue))
+        self.assertIsNone(_next(queue))
+        self.assertEqual(started, [0, 1])
+
+        # Concurrency limit reached.
+        queue_ready = _next(queue)
+        self.assertIsInstance(queue_ready, defer.Deferred)
+
+        inner[1].callback('second')
+        self.assertTrue(queue_ready.called)
+        self.assertTrue(completed[1].called)
+        self.assertFalse(completed[0].called)
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(started, [0, 1, 2])
+
+        inner[0].callback('first')
+        inner[2].callback('third')
+        self.assertTrue(completed[0].called)
+        self.assertTrue(completed[2].called)
+
+        queue.stopempty = True
+        self.assertRaises(StopIteration, _next, queue)
+
+    def test_batch_size(self):
+        """
+        Up to batch_size jobs are started within one iteration.
+        """
+        results = []
+
+        channel_1 = object()
+        channel_2 = object()
+        queue = JobQueue(batch_size=3)
+
+        for idx in range(4):
+            queue.put(channel_1, results.append, idx)
+        queue.put(channel_2, results.append, 'other')
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, [0, 'other', 1])
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, [0, 'other', 1, 2, 3])
+
+        queue_ready = _next(queue)
+        self.assertIsInstance(queue_ready, defer.Deferred)
+        self.assertFalse(queue_ready.called)
+
+    def test_batch_duration(self):
+        """
+        No more jobs are started within one iteration when the time budget is
+        exhausted.
+        """
+        now = [0]
+        def job():
+            now[0] += 1
+
+        channel = object()
+        queue = JobQueue(batch_size=10, batch_duration=2, seconds=lambda: now[0])
+
+        for _ in range(5):
+            queue.put(channel, job)
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(now[0], 2)
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(now[0], 4)
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(now[0], 5)
+
+    def test_execute_inline(self):
+        """
+        Jobs executed from within a running job are run immediately if the
+        channel is idle.
+        """
+        results = []
+        inner = []
+
+        upstream = object()
+        downstream = object()
+        queue = JobQueue(inline_depth=1)
+
+        def job(item):
+            inner.append(queue.execute(downstream, results.append, item))
+
+        # Not run inline unless called from a running job.
+        queue.execute(upstream, job, 'a')
+        self.assertEqual(results, [])
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, ['a'])
+        self.assertTrue(inner[0].called)
+
+        # Queued if the channel is busy.
+        blocker = defer.Deferred()
+        queue.put(downstream, lambda: blocker)
+        queue.put(upstream, job, 'b')
+
+        self.assertIsNone(_next(queue))
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, ['a'])
+        self.assertFalse(inner[1].called)
+
+        blocker.callback(None)
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, ['a', 'b'])
+        self.assertTrue(inner[1].called)
+
+        self.assertIsInstance(_next(queue), defer.Deferred)
+
+    def test_execute_inline_depth(self):
+        """
+        No more than inline_depth jobs are run nested inside each other.
+        """
+        results = []
+        channels = [object() for _ in range(4)]
+        queue = JobQueue(inline_depth=2)
+
+        def job(idx):
+            results.append(idx)
+            if idx + 1 < len(channels):
+                queue.execute(channels[idx + 1], job, idx + 1)
+
+        queue.put(channels[0], job, 0)
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, [0, 1, 2])
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, [0, 1, 2, 3])
+
+        self.assertIsInstance(_next(queue), defer.Deferred)
+
+    def test_execute_inline_duration(self):
+        """
+        Jobs are queued when the time budget of the iteration is exhausted.
+        """
+        now = [0]
+        results = []
+        upstream = object()
+        downstream = object()
+        queue = JobQueue(batch_duration=2, inline_depth=10, seconds=lambda: now[0])
+
+        def job(item):
+            now[0] += 2
+            queue.execute(downstream, results.append, item)
+
+        queue.put(upstream, job, 'a')
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, [])
+
+        self.assertIsNone(_next(queue))
+        self.assertEqual(results, ['a'])
+
+    def test_priority_lanes(self):
+        """
+        Channels in the lane with the lowest priority value are served first.
+        """
+        results = []
+
+        bulk = object()
+        urgent = object()
+        queue = JobQueue()
+        queue.set_priority(urgent, -1)
+
+        for idx in range(3):
+            queue.put(bulk, results.append, 'bulk {:d}'.format(idx))
+        queue.put(urgent, results.append, 'urgent 0')
+
+        self.assertIsNone(_next(queue))
+        queue.put(urgent, results.append, 'urgent 1')
+
+        for _ in range(4):
+            self.assertIsNone(_next(queue))
+
+        self.assertEqual(results, ['urgent 0', 'urgent 1', 'bulk 0', 'bulk 1', 'bulk 2'])
+
+    def test_weighted_round_robin(self):
+        """
+        A channel may start as many jobs as its weight before other channels
+        in the same lane get their turn.
+        """
+        results = []
+
+        heavy = object()
+        light = object()
+        queue = JobQueue()
+        queue.set_priority(heavy, weight=3)
+
+        for idx in range(5):
+            queue.put(heavy, results.append, 'h{:d}'.format(idx))
+            queue.put(light, results.append, 'l{:d}'.format(idx))
+
+        for _ in range(10):
+            self.assertIsNone(_next(queue))
+
+        self.assertEqual(results, ['h0', 'h1', 'h2', 'l0', 'h3', 'h4', 'l1', 'l2', 'l3', 'l4'])
+
+    def test_lane_stats(self):
+        """
+        The time jobs spent in the backlog is recorded per lane.
+        """
+        now = [0]
+
+        channel_1 = object()
+        channel_2 = object()
+        queue = JobQueue(seconds=lambda: now[0])
+        queue.set_priority(channel_2, 5)
+
+        queue.put(channel_1, lambda: None)
+        queue.put(channel_1, lambda: None)
+        queue.put(channel_2, lambda: None)
+
+        now[0] = 2
+        self.assertIsNone(_next(queue))
+        now[0] = 3
+        self.assertIsNone(_next(queue))
+        now[0] = 7
+        self.assertIsNone(_next(queue))
+
+        stats = queue.lane_stats(reset=True)
+        self.assertEqual(stats[0], (2, 5, 3))
+        self.assertEqual(stats[5], (1, 7, 7))
+
+        stats = queue.lane_stats()
+        self.assertEqual(stats[0], (0, 0, 0))
+
+    def test_ttl(self):
+        """
+        Jobs which waited longer than the time to live of their channel are
+        dropped when they are about to start.
+        """
+        now = [0]
+        calls = []
+
+        channel = object()
+        queue = JobQueue(limit=2, lowat=0.5, seconds=lambda: now[0])
+        queue.set_ttl(channel, 5)
+
+        expired = queue.put(channel, calls.append, 'old')
+        now[0] = 3
+        fresh = queue.put(channel, calls.append, 'fresh')
+        self.assertFalse(queue.writable())
+
+        now[0] = 6
+        self.assertIsNone(_next(queue))
+        self.assertEqual(calls, ['fresh'])
+        self.assertTrue(queue.writable())
+        self.assertTrue(fresh.called)
+
+        failures = []
+        expired.addErrback(failures.append)
+        self.assertEqual(len(failures), 1)
+        failures[0].trap(JobExpiredError)
+
+        # Expired jobs are not accounted for in the lane statistics.
+        self.assertEqual(queue.lane_stats()[0].count, 1)
+
+        queue.stopempty = True
+        self.assertRaises(StopIteration, _next, queue)
+
+    def test_deadline(self):
+        """
+        Jobs which did not start before their deadline are dropped. The
+        earlier of the deadline and the time to live applies.
+        """
+        now = [0]
+        calls = []
+
+        channel = object()
+        queue = JobQueue(seconds=lambda: now[0])
+
+        failures = []
+
+        late = queue.put(channel, calls.append, 'late')
+        queue.set_deadline(late, 1)
+        timely = queue.put(channel, calls.append, 'timely')
+        queue.set_deadline(timely, 2)
+        now[0] = 1
+        self.assertIsNone(_next(queue))
+        self.assertEqual(calls, ['timely'])
+        self.assertTrue(timely.called)
+
+        late.addErrback(failures.append)
+        self.assertEqual(len(failures), 1)
+        failures[0].trap(JobExpiredError)
+
+        queue.set_ttl(channel, 10)
+        deadline = queue.put(channel, calls.append, 'deadline')
+        queue.set_deadline(deadline, 5)
+        ttl = queue.put(channel, calls.append, 'ttl')
+        now[0] = 11
+        self.assertIsInstance(_next(queue), defer.Deferred)
+        self.assertEqual(calls, ['timely'])
+
+        deadline.addErrback(failures.append)
+        ttl.addErrback(failures.append)
+        self.assertEqual(len(failures), 3)
+        failures[1].trap(JobExpiredError)
+        failures[2].trap(JobExpiredError)
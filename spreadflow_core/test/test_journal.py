@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the write-ahead journal.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+from spreadflow_core.journal import Journal
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        self.clock = task.Clock()
+        self.ports = ['a', 'b']
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'journal')
+
+    def _journal(self, **kwds):
+        kwds.setdefault('fsync', False)
+        return Journal(self.path, self.ports, **kwds)
+
+    def test_replay_pending(self):
+        """
+        Items of jobs which never completed are replayed in order.
+        """
+        journal = self._journal()
+        self.assertEqual(journal.open(self.clock), [])
+
+        seqs = [journal.put('a', 'one'), journal.put('b', 'two'), journal.put('a', 'three')]
+        self.assertIsNone(journal.put('unknown', 'ignored'))
+        self.clock.advance(journal.commit_interval)
+        journal.done(seqs[1])
+        journal.close()
+
+        journal = self._journal()
+        replay = journal.open(self.clock)
+        self.assertEqual(replay, [(seqs[0], 'a', 'one'), (seqs[2], 'a', 'three')])
+
+        # Replayed items remain in the journal until done.
+        journal.done(seqs[0])
+        seq = journal.put('b', 'four')
+        self.assertGreater(seq, seqs[2])
+        journal.close()
+
+        journal = self._journal()
+        replay = journal.open(self.clock)
+        self.assertEqual(replay, [(seqs[2], 'a', 'three'), (seq, 'b', 'four')])
+        journal.close()
+
+    def test_group_commit(self):
+        """
+        Records are written in batches, jobs completing within a batch never
+        hit the disk.
+        """
+        journal = self._journal(commit_interval=1)
+        journal.open(self.clock)
+
+        first = journal.put('a', 'one')
+        journal.done(first)
+        second = journal.put('a', 'two')
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+        self.clock.advance(1)
+        size = os.path.getsize(self.path)
+        self.assertGreater(size, 0)
+
+        journal.done(second)
+        self.assertEqual(os.path.getsize(self.path), size)
+        journal.close()
+
+        journal = self._journal()
+        self.assertEqual(journal.open(self.clock), [])
+        journal.close()
+
+    def test_commit_size(self):
+        """
+        Records are written as soon as the buffer is full.
+        """
+        journal = self._journal(commit_size=1)
+        journal.open(self.clock)
+
+        journal.put('a', 'one')
+        self.assertGreater(os.path.getsize(self.path), 0)
+        journal.close()
+
+    def test_compaction(self):
+        """
+        The file is rewritten once most of the records are dead.
+        """
+        journal = self._journal(commit_size=1, compact_min=10, compact_ratio=0.5)
+        journal.open(self.clock)
+
+        keep = journal.put('a', 'keep')
+        for idx in range(10):
+            journal.done(journal.put('b', idx))
+
+        size = os.path.getsize(self.path)
+        journal.close()
+
+        journal = self._journal()
+        self.assertEqual(journal.open(self.clock), [(keep, 'a', 'keep')])
+        self.assertLessEqual(os.path.getsize(self.path), size)
+        journal.close()
+
+    def test_truncated(self):
+        """
+        A partially written record at the end of the file is ignored.
+        """
+        journal = self._journal()
+        journal.open(self.clock)
+        seq = journal.put('a', 'one')
+        journal.put('b', 'two')
+        journal.close()
+
+        with open(self.path, 'rb+') as journal_file:
+            journal_file.truncate(os.path.getsize(self.path) - 3)
+
+        journal = self._journal()
+        self.assertEqual(journal.open(self.clock), [(seq, 'a', 'one')])
+        journal.close()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for sampled lineage tracing.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import io
+import json
+import unittest
+
+from spreadflow_core.lineage import LineageTracer, TraceContext, TraceSpan
+
+
+class LineageTracerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(LineageTracerTestCase, self).setUp()
+        self.now = [0]
+        self.rand = [0]
+
+    def _tracer(self, sample_rate=0.5, **kwds):
+        tracer = LineageTracer(sample_rate, seconds=lambda: self.now[0],
+                               random=lambda: self.rand[0], **kwds)
+        tracer.pid = 42
+        return tracer
+
+    def test_sample(self):
+        """
+        Items are sampled according to the sample rate.
+        """
+        tracer = self._tracer()
+        self.assertEqual(tracer.sample(), TraceContext(1, 0))
+        self.rand[0] = 0.5
+        self.assertIsNone(tracer.sample())
+        self.rand[0] = 0
+        self.assertEqual(tracer.sample(), TraceContext(2, 0))
+
+        self.assertIsNone(self._tracer(0).sample())
+
+    def test_finish(self):
+        """
+        A trace is finished when no hop is in progress anymore.
+        """
+        tracer = self._tracer(labels={'a': 'first'})
+        root = tracer.sample()
+
+        first = tracer.enter(root, 'a')
+        self.assertEqual(first.context, TraceContext(1, 1))
+        self.now[0] = 1
+        tracer.start(first)
+        second = tracer.enter(first.context, 'b')
+        self.now[0] = 2
+        tracer.exit(first)
+        self.assertEqual(tracer.traces(), {})
+
+        self.now[0] = 3
+        tracer.start(second)
+        self.now[0] = 4
+        tracer.exit(second)
+
+        self.assertEqual(tracer.traces(), {1: [
+            TraceSpan(1, 1, 'first', 0, 1, 2, 42),
+            TraceSpan(1, 2, 'b', 1, 3, 4, 42),
+        ]})
+
+    def test_max_traces(self):
+        """
+        Only the most recent traces are kept.
+        """
+        tracer = self._tracer(max_traces=2)
+        for _ in range(3):
+            tracer.exit(tracer.enter(tracer.sample(), 'a'))
+
+        self.assertEqual(list(tracer.traces().keys()), [2, 3])
+
+    def test_forward(self):
+        """
+        Finished traces are forwarded if requested.
+        """
+        forwarded = []
+        tracer = self._tracer(0)
+        tracer.forward = forwarded.append
+
+        tracer.exit(tracer.enter(TraceContext(5, 3), 'a'))
+        self.assertEqual(forwarded, [[TraceSpan(5, 4, 'a', 0, None, 0, 42)]])
+        self.assertEqual(tracer.traces(), {})
+
+    def test_add_spans(self):
+        """
+        Spans recorded by other processes are merged into their trace.
+        """
+        tracer = self._tracer()
+        remote = TraceSpan(1, 2, 'remote', 1, 2, 3, 7)
+
+        hop = tracer.enter(tracer.sample(), 'a')
+        tracer.add_spans([tuple(remote)])
+        tracer.exit(hop)
+        late = TraceSpan(1, 3, 'late', 3, 4, 5, 7)
+        tracer.add_spans([late])
+
+        self.assertEqual(tracer.traces(), {1: [
+            remote, TraceSpan(1, 1, 'a', 0, None, 0, 42), late,
+        ]})
+
+    def test_export_chrome(self):
+        """
+        Hops are exported as queue and run slices, one thread per trace.
+        """
+        tracer = self._tracer()
+        hop = tracer.enter(tracer.sample(), 'a')
+        self.now[0] = 0.5
+        tracer.start(hop)
+        self.now[0] = 2
+        tracer.exit(hop)
+
+        fileobj = io.StringIO()
+        tracer.export_chrome(fileobj)
+        events = json.loads(fileobj.getvalue())['traceEvents']
+
+        args = {'trace': 1, 'hop': 1}
+        self.assertEqual(events, [
+            {'name': 'queued: a', 'cat': 'queue', 'ph': 'X', 'ts': 0,
+             'dur': 500000, 'pid': 42, 'tid': 1, 'args': args},
+            {'name': 'a', 'cat': 'run', 'ph': 'X', 'ts': 500000,
+             'dur': 1500000, 'pid': 42, 'tid': 1, 'args': args},
+        ])
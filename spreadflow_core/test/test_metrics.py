@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for runtime metrics.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import unittest
+
+from spreadflow_core.metrics import Histogram, MetricsRegistry
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_buckets(self):
+        """
+        Values are counted in the first bucket with a bound not less than the
+        value. Larger values end up in the overflow bucket.
+        """
+        histogram = Histogram(bounds=(1, 2, 4))
+        for value in (0.5, 1, 1.5, 3, 5, 8):
+            histogram.add(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot.counts, (2, 1, 1, 2))
+        self.assertEqual(snapshot.count, 6)
+        self.assertEqual(snapshot.total, 19)
+        self.assertEqual(snapshot.maximum, 8)
+        self.assertEqual(snapshot.mean(), 19 / 6)
+
+    def test_quantile(self):
+        """
+        Quantiles are approximated by the upper bound of the bucket.
+        """
+        histogram = Histogram(bounds=(1, 2, 4))
+        self.assertIsNone(histogram.snapshot().quantile(0.5))
+
+        for value in [0.5] * 98 + [3, 9]:
+            histogram.add(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot.quantile(0.5), 1)
+        self.assertEqual(snapshot.quantile(0.99), 4)
+        self.assertEqual(snapshot.quantile(1), 9)
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+
+    def test_snapshot_reset(self):
+        """
+        Metrics are kept per port and can be reset.
+        """
+        port = object()
+        registry = MetricsRegistry(bounds=(1,))
+
+        metrics = registry.port(port)
+        self.assertIs(registry.port(port), metrics)
+        metrics.received += 1
+        metrics.wait.add(2)
+
+        snapshot = registry.snapshot(reset=True)
+        self.assertEqual(list(snapshot), [port])
+        self.assertEqual(snapshot[port].received, 1)
+        self.assertEqual(snapshot[port].wait.counts, (0, 1))
+
+        self.assertEqual(registry.snapshot(), {})
+
+    def test_reset_in_place(self):
+        """
+        Metrics recorded through a reference obtained before a reset show up
+        in the next snapshot.
+        """
+        port = object()
+        registry = MetricsRegistry(bounds=(1,))
+
+        metrics = registry.port(port)
+        metrics.received += 1
+        metrics.wait.add(0.5)
+        registry.snapshot(reset=True)
+
+        # A job started before the reset completes afterwards.
+        metrics.execution.add(2)
+
+        self.assertIs(registry.port(port), metrics)
+        snapshot = registry.snapshot(reset=True)
+        self.assertEqual(snapshot[port].received, 0)
+        self.assertEqual(snapshot[port].wait.count, 0)
+        self.assertEqual(snapshot[port].execution.counts, (0, 1))
+        self.assertEqual(snapshot[port].execution.maximum, 2)
@@ -11,7 +11,7 @@ from __future__ import unicode_literals
 
 import unittest
 
-from spreadflow_core.format import PickleMessageParser
+from spreadflow_core.format import PickleMessageBuilder, PickleMessageParser
 
 class PickleParserTestCase(unittest.TestCase):
     """
@@ -64,3 +64,44 @@ class PickleParserTestCase(unittest.TestCase):
         msg = b"I35\n.(dp0\nS'msg'\np1\nS'hello world'\np2\ns."
 
         self.assertRaises(RuntimeError, parser.push, msg)
+
+    def test_large_message_in_chunks(self):
+        """
+        Tests that a message larger than the chunks it arrives in is decoded
+        once complete and the buffer is reused afterwards.
+        """
+        builder = PickleMessageBuilder()
+        parser = PickleMessageParser(2**20)
+
+        large = {'data': b'x' * 100000}
+        msg = builder.message(large) + builder.message('tail')
+
+        chunk_size = 4096
+
+        actual_messages = []
+        for pos in range(0, len(msg), chunk_size):
+            parser.push(bytearray(msg[pos:pos+chunk_size]))
+            actual_messages.extend(parser.messages())
+
+        self.assertEquals([large, 'tail'], actual_messages)
+
+        # Consumed frames do not count against the buffer limit.
+        for _ in range(20):
+            parser.push(builder.message(large))
+            self.assertEquals([large], list(parser.messages()))
+
+    def test_resume_messages(self):
+        """
+        Tests that messages are not yielded twice if iteration is interrupted
+        and resumed after pushing more data.
+        """
+        builder = PickleMessageBuilder()
+        parser = PickleMessageParser()
+
+        parser.push(builder.message(1) + builder.message(2))
+        messages = parser.messages()
+        self.assertEquals(next(messages), 1)
+
+        parser.push(builder.message(3))
+        self.assertEquals(next(messages), 2)
+        self.assertEquals(list(parser.messages()), [3])
@@ -4,7 +4,12 @@ from __future__ import unicode_literals
 
 import unittest
 
+from mock import Mock, call
+from twisted.test.proto_helpers import StringTransport
+
 from spreadflow_core import remote
+from spreadflow_core.format import PickleMessageBuilder, PickleMessageParser
+from spreadflow_core.lineage import LineageTracer, TraceContext, TraceSpan
 
 
 class StrportGeneratorTestCase(unittest.TestCase):
@@ -29,3 +34,70 @@ class StrportGeneratorTestCase(unittest.TestCase):
         gen = remote.StrportGeneratorMixin()
         result = gen.strport_generate('custom', url='http://example.com/?some=param')
         self.assertEqual(result, r'custom:url=http\://example.com/?some\=param')
+
+
+class SchedulerProtocolTestCase(unittest.TestCase):
+
+    def _protocol(self, scheduler):
+        proto = remote.SchedulerProtocol()
+        proto.builder = PickleMessageBuilder()
+        proto.parser = PickleMessageParser()
+        proto.handler = remote.MessageHandler(scheduler, {'out': 'port'})
+        proto.makeConnection(StringTransport())
+        return proto
+
+    def test_trace_context(self):
+        """
+        Trace contexts and spans are passed along with messages.
+        """
+        tracer = LineageTracer(0)
+        scheduler = Mock(spec=['send', 'tracer'])
+        scheduler.tracer = tracer
+        proto = self._protocol(scheduler)
+
+        proto.sendMessage('out', 'plain')
+        proto.sendMessage('out', 'unsampled', False)
+        proto.sendMessage('out', 'sampled', TraceContext(7, 2))
+        span = TraceSpan(7, 3, 'proc', 1.0, 1.5, 2.0, 42)
+        proto.sendSpans([span])
+
+        proto.dataReceived(proto.transport.value())
+
+        self.assertEqual(scheduler.send.call_args_list, [
+            call('plain', 'port', trace=None),
+            call('unsampled', 'port', trace=False),
+            call('sampled', 'port', trace=TraceContext(7, 2)),
+        ])
+        self.assertEqual(tracer.traces(), {7: [span]})
+
+    def test_idle(self):
+        """
+        An idle report is quiescent only if no items were in flight.
+        """
+        scheduler = Mock(spec=['send'])
+        local = self._protocol(scheduler)
+        local.handler = Mock(spec=remote.MessageHandler)
+        peer = self._protocol(scheduler)
+
+        local.sendMessage('out', 'first')
+        peer.dataReceived(local.transport.value())
+        local.transport.clear()
+
+        peer.sendIdle()
+        local.dataReceived(peer.transport.value())
+        peer.transport.clear()
+        local.handler.quiescent.assert_called_once_with(True)
+
+        # The peer reports before the second item arrived.
+        local.sendMessage('out', 'second')
+        peer.sendIdle()
+        local.dataReceived(peer.transport.value())
+        peer.transport.clear()
+        local.handler.quiescent.assert_called_with(False)
+
+        peer.dataReceived(local.transport.value())
+        peer.sendMessage('out', 'reply')
+        peer.sendIdle()
+        local.dataReceived(peer.transport.value())
+        local.handler.quiescent.assert_called_with(True)
+        self.assertEqual((local.sent, local.received), (2, 1))
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for retry policies and the timer heap.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import unittest
+
+from twisted.internet import task
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+
+from spreadflow_core.retry import RetryPolicy, TimerHeap
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+
+    def test_delay(self):
+        """
+        Delays grow exponentially up to the maximum and are reduced by a
+        random fraction.
+        """
+        rand = [0]
+        policy = RetryPolicy(backoff=1, factor=3, max_delay=20, jitter=0.5,
+                             random=lambda: rand[0])
+        self.assertEqual([policy.delay(retry) for retry in range(1, 5)], [1, 3, 9, 20])
+
+        rand[0] = 0.5
+        self.assertEqual(policy.delay(2), 2.25)
+
+    def test_retry(self):
+        """
+        Only the given exceptions are retried and only until the number of
+        attempts is exhausted.
+        """
+        policy = RetryPolicy(attempts=3, exceptions=(IOError,))
+        reason = Failure(IOError('flaky'))
+        self.assertTrue(policy.retry(reason, 0))
+        self.assertTrue(policy.retry(reason, 1))
+        self.assertFalse(policy.retry(reason, 2))
+        self.assertFalse(policy.retry(Failure(ValueError('broken')), 0))
+
+
+class TimerHeapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(TimerHeapTestCase, self).setUp()
+        self.clock = task.Clock()
+        self.timers = TimerHeap(self.clock)
+        self.calls = []
+
+    def test_order(self):
+        """
+        Calls are made in the order of their due time with a single delayed
+        call scheduled on the reactor.
+        """
+        for delay in (3, 1, 2, 1):
+            self.timers.call_later(delay, self.calls.append, delay)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(len(self.timers), 4)
+
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [1, 1])
+        self.clock.advance(1.5)
+        self.assertEqual(self.calls, [1, 1, 2])
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, [1, 1, 2, 3])
+
+        self.assertEqual(len(self.timers), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_cancel(self):
+        """
+        Cancelled calls are not made, the delayed call is removed once no
+        timer is active anymore.
+        """
+        first = self.timers.call_later(1, self.calls.append, 'first')
+        second = self.timers.call_later(2, self.calls.append, 'second')
+
+        first.cancel()
+        self.assertFalse(first.active)
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [])
+
+        second.cancel()
+        self.assertEqual(len(self.timers), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_earlier(self):
+        """
+        A timer due before all others reschedules the delayed call.
+        """
+        self.timers.call_later(5, self.calls.append, 'late')
+        self.timers.call_later(1, self.calls.append, 'early')
+
+        self.clock.advance(1)
+        self.assertEqual(self.calls, ['early'])
+        self.clock.advance(4)
+        self.assertEqual(self.calls, ['early', 'late'])
+
+    def test_failing_call(self):
+        """
+        A call which raises is logged, due calls after it still run and later
+        calls are still scheduled.
+        """
+        events = []
+        self.timers.log = Logger(observer=events.append)
+
+        def _fail():
+            raise ValueError('broken')
+
+        self.timers.call_later(1, _fail)
+        self.timers.call_later(1, self.calls.append, 'same time')
+        self.timers.call_later(2, self.calls.append, 'later')
+
+        self.clock.advance(1)
+        self.assertEqual(self.calls, ['same time'])
+        self.assertEqual(len(events), 1)
+        events[0]['log_failure'].trap(ValueError)
+
+        self.clock.advance(1)
+        self.assertEqual(self.calls, ['same time', 'later'])
+        self.assertEqual(len(self.timers), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -5,13 +5,16 @@ from __future__ import unicode_literals
 from mock import Mock
 from testtools import matchers, twistedsupport #, TestCase, run_test_with
 from testtools.assertions import assert_that
-from unittest import TestCase
-#from twisted.trial.unittest import TestCase
+from twisted.trial.unittest import TestCase
 
 from twisted.internet import defer, task
 
-from spreadflow_core.eventdispatcher import EventDispatcher
-from spreadflow_core.scheduler import Scheduler, Job, JobEvent, AttachEvent, DetachEvent
+from spreadflow_core.eventdispatcher import EventDispatcher, HandlerError
+from spreadflow_core.jobqueue import JobQueue
+from spreadflow_core.lineage import LineageTracer, TraceContext
+from spreadflow_core.metrics import MetricsRegistry
+from spreadflow_core.retry import RetryPolicy
+from spreadflow_core.scheduler import Scheduler, Job, SchedulerEvent, LifecycleEvent, JobEvent, AttachEvent, DetachEvent, DrainEvent, IdleEvent
 from spreadflow_core.test.matchers import MatchesInvocation
 
 defer.setDebugging(True)
@@ -156,6 +159,59 @@ class SchedulerTestCase(TestCase):
 
         self.assertEquals(len(list(self.scheduler.pending)), 0)
 
+    def test_run_job_without_listeners(self):
+        """
+        Tests that jobs are queued directly if no job listeners are present.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+
+        # Listeners added after attach are not taken into account.
+        self.scheduler.run(self.clock)
+        job_handler = Mock()
+        self.dispatcher.add_listener(JobEvent, 0, job_handler)
+
+        self.scheduler.send('some item', port_out)
+        self.assertEquals(job_handler.call_count, 0)
+
+        pending = list(self.scheduler.pending)
+        self.assertEquals(len(pending), 1)
+        completed, entry = pending[0]
+        self.assertEquals(entry.job, Job(port_in, 'some item', self.scheduler.send, port_out))
+        assert_that(completed, twistedsupport.has_no_result())
+
+        # Trigger queue run.
+        self.clock.advance(self.epsilon)
+
+        port_in.assert_called_once_with('some item', self.scheduler.send)
+        assert_that(completed, twistedsupport.succeeded(matchers.Always()))
+        self.assertEquals(len(list(self.scheduler.pending)), 0)
+
+    def test_run_job_inline(self):
+        """
+        Tests that downstream jobs are run immediately if the queue allows it.
+        """
+        port_out_1 = object()
+        port_out_2 = object()
+        port_in_2 = Mock(spec=_port_callback)
+        port_in_1 = Mock(spec=_port_callback, side_effect=lambda item, send: send(item, port_out_2))
+        self.flowmap[port_out_1] = port_in_1
+        self.flowmap[port_out_2] = port_in_2
+
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              queue=JobQueue(inline_depth=1))
+        scheduler.run(self.clock)
+        scheduler.send('some item', port_out_1)
+        self.assertEquals(len(list(scheduler.pending)), 1)
+
+        # Trigger queue run.
+        self.clock.advance(self.epsilon)
+
+        port_in_1.assert_called_once_with('some item', scheduler.send)
+        port_in_2.assert_called_once_with('some item', scheduler.send)
+        self.assertEquals(len(list(scheduler.pending)), 0)
+
     def test_fail_job(self):
         """
         Tests that scheduler is stopped whenever a port is failing.
@@ -210,3 +266,798 @@ class SchedulerTestCase(TestCase):
         self.assertEquals(len(list(self.scheduler.pending)), 0)
 
         self.assertEquals(port_in.call_count, 0)
+
+    def test_lifecycle(self):
+        """
+        Tests that components are detached one after another if requested,
+        that every component is given its own timeout and that the time taken
+        by each one is recorded.
+        """
+        slow = Mock(return_value=defer.Deferred())
+        fast = Mock(return_value=None)
+        stuck = Mock(return_value=defer.Deferred())
+        self.dispatcher.add_listener(DetachEvent, 0, slow)
+        self.dispatcher.add_listener(DetachEvent, 0, stuck)
+        self.dispatcher.add_listener(DetachEvent, 1, fast)
+
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              lifecycle_concurrency=1)
+        scheduler.run(self.clock)
+        scheduler.stop(None)
+
+        join_deferred = scheduler.join(self.clock, timeout=3)
+        self.assertEquals(stuck.call_count, 0)
+
+        self.clock.advance(1)
+        slow.return_value.callback(None)
+        self.assertEquals(stuck.call_count, 1)
+
+        self.clock.advance(3)
+        self.assertEquals(fast.call_count, 1)
+        self.clock.advance(self.epsilon)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+
+        timings = scheduler.lifecycle_timings[DetachEvent]
+        self.assertEquals([(timing.handler.callback, timing.seconds, timing.success) for timing in timings],
+                          [(slow, 1, True), (stuck, 3, False), (fast, 0, True)])
+
+        logged = self.flushLoggedErrors(HandlerError)
+        self.assertEquals(len(logged), 1)
+        self.assertIs(logged[0].value.handler.callback, stuck)
+        logged[0].value.wrapped_failure.trap(defer.TimeoutError)
+
+    def test_drain(self):
+        """
+        Tests that join() in drain mode detaches sources first and waits for
+        pending jobs to complete.
+        """
+        port_out = object()
+        inner = defer.Deferred()
+        port_in = Mock(spec=_port_callback, return_value=inner)
+        self.flowmap[port_out] = port_in
+
+        events = []
+        self.dispatcher.add_listener(DrainEvent, 0, events.append)
+        self.dispatcher.add_listener(DetachEvent, 0, events.append)
+
+        run_deferred = self.scheduler.run(self.clock)
+        self.scheduler.send('some item', port_out)
+        self.scheduler.stop('bye!')
+
+        join_deferred = self.scheduler.join(self.clock, drain=5)
+        self.assertEquals(events, [DrainEvent(scheduler=self.scheduler)])
+
+        # The queue keeps running.
+        self.clock.advance(self.epsilon)
+        port_in.assert_called_once_with('some item', self.scheduler.send)
+        assert_that(join_deferred, twistedsupport.has_no_result())
+
+        inner.callback(None)
+        self.clock.advance(0)
+        self.clock.advance(self.epsilon)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+        assert_that(run_deferred, twistedsupport.succeeded(matchers.Equals('bye!')))
+
+        self.assertEquals(events, [DrainEvent(scheduler=self.scheduler),
+                                   DetachEvent(scheduler=self.scheduler)])
+        self.assertEquals(len(list(self.scheduler.pending)), 0)
+
+    def test_event_hierarchy(self):
+        """
+        Tests that listeners registered for a base class observe all the
+        scheduler events deriving from it.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback, return_value=None)
+        self.flowmap[port_out] = port_in
+
+        events = []
+        lifecycle_events = []
+        self.dispatcher.add_listener(SchedulerEvent, 0, lambda event: events.append(type(event)))
+        self.dispatcher.add_listener(LifecycleEvent, 0, lifecycle_events.append)
+
+        self.scheduler.run(self.clock)
+        self.scheduler.send('some item', port_out)
+        self.clock.advance(self.epsilon)
+        self.scheduler.stop(None)
+        join_deferred = self.scheduler.join(self.clock, drain=5)
+        self.clock.advance(self.epsilon)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+
+        self.assertEquals(events, [AttachEvent, JobEvent, IdleEvent, DrainEvent, DetachEvent])
+        self.assertEquals(lifecycle_events, [AttachEvent(scheduler=self.scheduler, reactor=self.clock),
+                                             DrainEvent(scheduler=self.scheduler),
+                                             DetachEvent(scheduler=self.scheduler)])
+
+    def test_drain_deadline(self):
+        """
+        Tests that jobs still pending when the drain deadline passed are
+        cancelled.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback, return_value=defer.Deferred())
+        self.flowmap[port_out] = port_in
+
+        run_deferred = self.scheduler.run(self.clock)
+        self.scheduler.send('first', port_out)
+        self.scheduler.send('second', port_out)
+        self.scheduler.stop('bye!')
+
+        join_deferred = self.scheduler.join(self.clock, drain=5)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(len(list(self.scheduler.pending)), 2)
+
+        self.clock.advance(5)
+        self.clock.advance(self.epsilon)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+        assert_that(run_deferred, twistedsupport.succeeded(matchers.Equals('bye!')))
+        self.assertEquals(len(list(self.scheduler.pending)), 0)
+
+    def test_idle(self):
+        """
+        Tests that an idle event is dispatched at startup, whenever the last
+        pending job completed and when the last busy component reported that
+        it is done.
+        """
+        port_out = object()
+        inner = defer.Deferred()
+        port_in = Mock(spec=_port_callback, return_value=inner)
+        self.flowmap[port_out] = port_in
+
+        events = []
+        self.dispatcher.add_listener(IdleEvent, 0, events.append)
+
+        self.scheduler.run(self.clock)
+        self.clock.advance(0)
+        self.assertEquals(events, [IdleEvent(scheduler=self.scheduler)])
+
+        self.scheduler.send('some item', port_out)
+        self.clock.advance(self.epsilon)
+        self.assertFalse(self.scheduler.idle)
+
+        self.scheduler.set_busy('worker')
+        inner.callback(None)
+        self.clock.advance(0)
+        self.assertEquals(len(events), 1)
+
+        self.scheduler.set_busy('worker', False)
+        self.assertTrue(self.scheduler.idle)
+        self.clock.advance(0)
+        self.assertEquals(events, [IdleEvent(scheduler=self.scheduler)] * 2)
+
+        self.scheduler.stop(None)
+        self.scheduler.join()
+        self.scheduler.set_busy('worker')
+        self.scheduler.set_busy('worker', False)
+        self.clock.advance(0)
+        self.assertEquals(len(events), 2)
+
+    def test_idle_unconnected(self):
+        """
+        Tests that an idle event is dispatched after an item was dropped
+        because it was sent through an unconnected port.
+        """
+        events = []
+        self.dispatcher.add_listener(IdleEvent, 0, events.append)
+
+        self.scheduler.run(self.clock)
+        self.clock.advance(0)
+        self.assertEquals(events, [IdleEvent(scheduler=self.scheduler)])
+
+        self.scheduler.send('some item', object())
+        self.assertTrue(self.scheduler.idle)
+        self.clock.advance(0)
+        self.assertEquals(events, [IdleEvent(scheduler=self.scheduler)] * 2)
+
+        # Not while other jobs are pending.
+        port_out = object()
+        inner = defer.Deferred()
+        self.flowmap[port_out] = Mock(spec=_port_callback, return_value=inner)
+        self.scheduler.send('other item', port_out)
+        self.scheduler.send('some item', object())
+        self.clock.advance(0)
+        self.assertEquals(len(events), 2)
+
+        self.clock.advance(self.epsilon)
+        inner.callback(None)
+        self.clock.advance(0)
+        self.assertEquals(len(events), 3)
+
+        self.scheduler.stop(None)
+        self.scheduler.join()
+
+    def test_recorder(self):
+        """
+        Tests that items sent through output ports are passed to the trace
+        recorder and that it is opened and closed with the scheduler.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+
+        recorder = Mock(spec=['open', 'record', 'close'])
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              recorder=recorder)
+
+        scheduler.run(self.clock)
+        recorder.open.assert_called_once_with(self.clock)
+
+        scheduler.send('some item', port_out)
+        scheduler.send('unrouted item', object())
+        recorder.record.assert_called_once_with(port_out, 'some item')
+
+        self.clock.advance(self.epsilon)
+        scheduler.stop('bye!')
+        join_deferred = scheduler.join(self.clock)
+        self.clock.advance(self.epsilon)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+        recorder.close.assert_called_once_with()
+
+    def test_lineage(self):
+        """
+        Tests that sampled items are followed across hops and that items
+        sent by jobs which were not sampled are never sampled.
+        """
+        now = [0]
+        samples = [0, 1, 0]
+
+        port_out = object()
+        port_in_out = object()
+        sink = Mock(spec=_port_callback)
+        port_in = Mock(spec=_port_callback)
+
+        def _forward(item, send):
+            now[0] += 1
+            send(item, port_in_out)
+        port_in.side_effect = _forward
+
+        self.flowmap[port_out] = port_in
+        self.flowmap[port_in_out] = sink
+
+        tracer = LineageTracer(0.5, labels={port_in: 'in', sink: 'sink'},
+                               seconds=lambda: now[0], random=lambda: samples.pop(0))
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              tracer=tracer)
+        self.assertIs(scheduler.tracer, tracer)
+
+        scheduler.run(self.clock)
+        scheduler.send('sampled', port_out)
+        scheduler.send('not sampled', port_out)
+        for _ in range(4):
+            self.clock.advance(self.epsilon)
+
+        self.assertEqual(sink.call_count, 2)
+        self.assertEqual(samples, [0])
+        self.assertIsNone(tracer.current)
+
+        traces = tracer.traces()
+        self.assertEqual(list(traces.keys()), [1])
+        self.assertEqual([(span.hop, span.port, span.enter, span.start, span.exit) for span in traces[1]],
+                         [(1, 'in', 0, 0, 1), (2, 'sink', 1, 1, 1)])
+
+        # Items arriving from a remote peer carry the context.
+        scheduler.send('remote', port_out, trace=TraceContext(7, 3))
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+        self.assertEqual([span.hop for span in tracer.traces()[7]], [4, 5])
+
+    def test_multicast(self):
+        """
+        Tests that items sent through a multicast output port are delivered
+        to every connected input port without copying them.
+        """
+        port_out = object()
+        sinks = [Mock(spec=_port_callback) for _ in range(2)]
+        self.flowmap[port_out] = tuple(sinks)
+
+        self.scheduler.run(self.clock)
+        item = {'key': 'value'}
+        self.scheduler.send(item, port_out)
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+
+        for sink in sinks:
+            sink.assert_called_once_with(item, self.scheduler.send)
+            self.assertIs(sink.call_args[0][0], item)
+
+    def test_multicast_check(self):
+        """
+        Tests that modifications of multicast items are reported if
+        requested.
+        """
+        port_out = object()
+        sink = Mock(spec=_port_callback)
+        mutator = Mock(spec=_port_callback, side_effect=lambda item, send: item.update(key='changed'))
+        self.flowmap[port_out] = (sink, mutator)
+
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              check_multicast=True)
+        scheduler.log = Mock()
+
+        scheduler.run(self.clock)
+        scheduler.send({'key': 'value'}, port_out)
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+
+        self.assertEqual(sink.call_count, 1)
+        self.assertEqual(mutator.call_count, 1)
+        scheduler.log.error.assert_called_once_with(
+            'Multicast item modified in place on {port_in}: {item}',
+            port_in=mutator, item={'key': 'changed'})
+
+    def test_coalesce(self):
+        """
+        Tests that items waiting in the backlog are replaced by items with the
+        same key.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        blocked = defer.Deferred()
+        port_in.side_effect = [blocked, None, None]
+        self.flowmap[port_out] = port_in
+
+        self.scheduler.set_coalesce(port_in, lambda item: item['path'])
+        self.scheduler.run(self.clock)
+
+        self.scheduler.send({'path': 'a', 'rev': 1}, port_out)
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(port_in.call_count, 1)
+
+        # The job processing the first item started already.
+        self.assertIsNone(self.scheduler.send({'path': 'a', 'rev': 2}, port_out))
+        self.assertIsNone(self.scheduler.send({'path': 'b', 'rev': 1}, port_out))
+        self.assertIsNone(self.scheduler.send({'path': 'a', 'rev': 3}, port_out))
+        self.assertEquals(len(self.scheduler.pending), 3)
+
+        blocked.callback(None)
+        for _ in range(3):
+            self.clock.advance(self.epsilon)
+
+        self.assertEquals([args[0] for args, _ in port_in.call_args_list], [
+            {'path': 'a', 'rev': 1},
+            {'path': 'a', 'rev': 3},
+            {'path': 'b', 'rev': 1},
+        ])
+
+    def test_coalesce_merge(self):
+        """
+        Tests that items are merged with waiting items if requested and that
+        the journal and the metrics follow.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+
+        journal = Mock(spec=['open', 'put', 'done', 'close'])
+        journal.open.return_value = []
+        journal.put.side_effect = [6, 7]
+
+        merge = lambda old, new: {'path': old['path'], 'revs': old['revs'] + new['revs']}
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              metrics=MetricsRegistry(), journal=journal)
+        scheduler.set_coalesce(port_in, lambda item: item['path'], merge)
+        scheduler.run(self.clock)
+
+        scheduler.send({'path': 'a', 'revs': [1]}, port_out)
+        scheduler.send({'path': 'a', 'revs': [2]}, port_out)
+        self.assertEquals(journal.put.call_args_list, [
+            ((port_in, {'path': 'a', 'revs': [1]}),),
+            ((port_in, {'path': 'a', 'revs': [1, 2]}),),
+        ])
+        journal.done.assert_called_once_with(6)
+
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+
+        port_in.assert_called_once_with({'path': 'a', 'revs': [1, 2]}, scheduler.send)
+        self.assertEquals(journal.done.call_args_list, [((6,),), ((7,),)])
+
+        stats = scheduler.port_stats()
+        self.assertEquals(stats[port_out].sent, 2)
+        self.assertEquals(stats[port_in].received, 1)
+        self.assertEquals(stats[port_in].coalesced, 1)
+
+    def test_expiry(self):
+        """
+        Tests that items which waited too long are sent to the expiry port.
+        """
+        port_out = object()
+        port_expired = object()
+        port_in = Mock(spec=_port_callback)
+        dead_letters = Mock(spec=_port_callback)
+        blocked = defer.Deferred()
+        port_in.side_effect = [blocked, None]
+        self.flowmap[port_out] = port_in
+        self.flowmap[port_expired] = dead_letters
+
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              queue=JobQueue(seconds=self.clock.seconds),
+                              metrics=MetricsRegistry())
+        scheduler.set_expiry(port_in, ttl=5, deadline=lambda item: item.get('deadline'),
+                             port_expired=port_expired)
+        scheduler.run(self.clock)
+
+        scheduler.send({'id': 1}, port_out)
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(port_in.call_count, 1)
+
+        scheduler.send({'id': 2}, port_out)
+        scheduler.send({'id': 3, 'deadline': 1}, port_out)
+        self.clock.advance(2)
+        scheduler.send({'id': 4}, port_out)
+        self.clock.advance(4)
+
+        blocked.callback(None)
+        for _ in range(4):
+            self.clock.advance(self.epsilon)
+
+        self.assertEquals([args[0] for args, _ in port_in.call_args_list],
+                          [{'id': 1}, {'id': 4}])
+        self.assertEquals([args[0] for args, _ in dead_letters.call_args_list],
+                          [{'id': 2}, {'id': 3, 'deadline': 1}])
+        self.assertEquals(len(scheduler.pending), 0)
+
+        stats = scheduler.port_stats()
+        self.assertEquals(stats[port_in].expired, 2)
+        self.assertEquals(stats[port_in].failed, 0)
+
+    def test_retry(self):
+        """
+        Tests that failed jobs are retried after an exponentially growing
+        delay and that the job stays pending in the meantime.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        port_in.side_effect = [ValueError('flaky'), ValueError('flaky'), None]
+        self.flowmap[port_out] = port_in
+
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              metrics=MetricsRegistry())
+        scheduler.set_retry(port_in, RetryPolicy(attempts=3, backoff=1, jitter=0))
+        run_deferred = scheduler.run(self.clock)
+
+        scheduler.send('some item', port_out)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(port_in.call_count, 1)
+        self.assertEquals(len(scheduler.pending), 1)
+
+        self.clock.advance(1)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(port_in.call_count, 2)
+
+        self.clock.advance(1)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(port_in.call_count, 2)
+        self.clock.advance(1)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(port_in.call_count, 3)
+
+        self.assertEquals(len(scheduler.pending), 0)
+        assert_that(run_deferred, twistedsupport.has_no_result())
+
+        stats = scheduler.port_stats()
+        self.assertEquals(stats[port_in].retried, 2)
+        self.assertEquals(stats[port_in].failed, 2)
+
+    def test_retry_dead_letter(self):
+        """
+        Tests that items which still fail after the last attempt or fail with
+        an exception which is not retried are sent to the dead-letter port.
+        """
+        port_out = object()
+        port_dead = object()
+        port_in = Mock(spec=_port_callback)
+        port_in.side_effect = [ValueError('flaky'), TypeError('broken'), ValueError('flaky')]
+        dead_letters = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+        self.flowmap[port_dead] = dead_letters
+
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              metrics=MetricsRegistry())
+        policy = RetryPolicy(attempts=2, backoff=1, jitter=0, exceptions=(ValueError,))
+        scheduler.set_retry(port_in, policy, port_dead)
+        run_deferred = scheduler.run(self.clock)
+
+        scheduler.send('first', port_out)
+        scheduler.send('second', port_out)
+        for _ in range(3):
+            self.clock.advance(self.epsilon)
+        self.assertEquals([args[0] for args, _ in dead_letters.call_args_list], ['second'])
+
+        self.clock.advance(1)
+        for _ in range(3):
+            self.clock.advance(self.epsilon)
+        self.assertEquals([args[0] for args, _ in port_in.call_args_list],
+                          ['first', 'second', 'first'])
+        self.assertEquals([args[0] for args, _ in dead_letters.call_args_list],
+                          ['second', 'first'])
+        self.assertEquals(len(scheduler.pending), 0)
+        assert_that(run_deferred, twistedsupport.has_no_result())
+
+        logged = self.flushLoggedErrors(ValueError, TypeError)
+        self.assertEquals([failure.type for failure in logged], [TypeError, ValueError])
+
+        stats = scheduler.port_stats()
+        self.assertEquals(stats[port_in].retried, 1)
+        self.assertEquals(stats[port_in].dead_lettered, 2)
+
+    def test_retry_cancel(self):
+        """
+        Tests that jobs waiting for a retry are cancelled when the scheduler
+        is stopped.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback, side_effect=ValueError('flaky'))
+        self.flowmap[port_out] = port_in
+
+        self.scheduler.set_retry(port_in, RetryPolicy(backoff=10))
+        run_deferred = self.scheduler.run(self.clock)
+        self.scheduler.send('some item', port_out)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(len(self.scheduler.pending), 1)
+
+        self.scheduler.stop('bye!')
+        join_deferred = self.scheduler.join(self.clock)
+        self.clock.advance(self.epsilon)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+        assert_that(run_deferred, twistedsupport.succeeded(matchers.Equals('bye!')))
+        self.assertEquals(len(self.scheduler.pending), 0)
+
+        self.clock.advance(10)
+        self.assertEquals(port_in.call_count, 1)
+
+    def test_backpressure(self):
+        """
+        Tests that producers are paused when the backlog is congested.
+        """
+        producer = Mock()
+
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+
+        self.scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                                   queue=JobQueue(limit=2, lowat=0.5))
+        self.scheduler.register_producer(producer)
+        self.scheduler.run(self.clock)
+
+        self.assertIsNone(self.scheduler.send('first item', port_out))
+        self.assertEquals(producer.pauseProducing.call_count, 0)
+
+        writable = self.scheduler.send('second item', port_out)
+        assert_that(writable, twistedsupport.has_no_result())
+        self.assertEquals(producer.pauseProducing.call_count, 1)
+        self.assertEquals(producer.resumeProducing.call_count, 0)
+
+        # Trigger queue run.
+        self.clock.advance(self.epsilon)
+
+        assert_that(writable, twistedsupport.succeeded(matchers.Always()))
+        self.assertEquals(producer.resumeProducing.call_count, 1)
+
+        self.scheduler.unregister_producer(producer)
+
+    def test_ordered_concurrency(self):
+        """
+        Tests that items sent by concurrent jobs are delivered in arrival order
+        if requested.
+        """
+        port_out = object()
+        inner = {}
+
+        def port_in(item, send):
+            inner[item] = defer.Deferred()
+            inner[item].addCallback(send, port_in)
+            return inner[item]
+
+        port_final = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+        self.flowmap[port_in] = port_final
+
+        self.scheduler.set_concurrency(port_in, 3, ordered=True)
+        self.scheduler.run(self.clock)
+
+        for item in ('first', 'second', 'third'):
+            self.scheduler.send(item, port_out)
+
+        # Trigger queue run, start all three jobs.
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(sorted(inner.keys()), ['first', 'second', 'third'])
+
+        # Complete jobs in reverse order.
+        inner['third'].callback('third')
+        inner['second'].callback('second')
+        self.clock.advance(self.epsilon)
+        self.assertEquals(port_final.call_count, 0)
+
+        inner['first'].callback('first')
+        for _ in range(3):
+            self.clock.advance(self.epsilon)
+
+        self.assertEquals([args[0] for args, _ in port_final.call_args_list],
+                          ['first', 'second', 'third'])
+        self.assertEquals(len(list(self.scheduler.pending)), 0)
+
+    def test_ordered_join(self):
+        """
+        Tests that items held back for ordered delivery are dropped when the
+        scheduler is stopped while an older job is still pending.
+        """
+        port_out = object()
+        inner = {}
+
+        def port_in(item, send):
+            inner[item] = defer.Deferred()
+            inner[item].addCallback(send, port_in)
+            return inner[item]
+
+        port_final = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+        self.flowmap[port_in] = port_final
+
+        self.scheduler.set_concurrency(port_in, 2, ordered=True)
+        run_deferred = self.scheduler.run(self.clock)
+
+        for item in ('first', 'second'):
+            self.scheduler.send(item, port_out)
+
+        # Trigger queue run, start both jobs.
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+        self.assertEquals(sorted(inner.keys()), ['first', 'second'])
+
+        # Complete the younger job, its item is held back.
+        inner['second'].callback('second')
+        self.clock.advance(self.epsilon)
+
+        self.scheduler.stop('bye!')
+        join_deferred = self.scheduler.join(self.clock)
+        self.clock.advance(self.epsilon)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+        assert_that(run_deferred, twistedsupport.succeeded(matchers.Equals('bye!')))
+
+        self.assertEquals(port_final.call_count, 0)
+        self.assertEquals(len(list(self.scheduler.pending)), 0)
+        self.assertEquals(self.flushLoggedErrors(), [])
+
+    def test_dedicated_cooperator(self):
+        """
+        Tests that the scheduler runs its own cooperator unless a cooperate
+        function is given.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+
+        scheduler = Scheduler(self.flowmap, self.dispatcher, tick_interval=1)
+        run_deferred = scheduler.run(self.clock)
+        scheduler.send('some item', port_out)
+
+        self.assertEquals(port_in.call_count, 0)
+        self.clock.advance(1)
+        port_in.assert_called_once_with('some item', scheduler.send)
+
+        scheduler.stop('bye!')
+        join_deferred = scheduler.join(self.clock)
+        self.clock.advance(1)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+        assert_that(run_deferred, twistedsupport.succeeded(matchers.Equals('bye!')))
+
+    def test_executor(self):
+        """
+        Tests that jobs are handed to the executor configured for the port
+        and that the executor is attached and detached with the scheduler.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+
+        executor = Mock(spec=['attach', 'detach', 'execute'])
+        executor.execute.return_value = defer.succeed(None)
+        self.scheduler.set_executor(port_in, executor)
+
+        run_deferred = self.scheduler.run(self.clock)
+        executor.attach.assert_called_once_with(self.scheduler, self.clock)
+
+        self.scheduler.send('some item', port_out)
+        self.clock.advance(self.epsilon)
+
+        executor.execute.assert_called_once_with(port_in, 'some item', self.scheduler.send)
+        self.assertEquals(port_in.call_count, 0)
+        self.assertEquals(len(list(self.scheduler.pending)), 0)
+
+        self.scheduler.stop('bye!')
+        join_deferred = self.scheduler.join(self.clock)
+        self.clock.advance(self.epsilon)
+        assert_that(join_deferred, twistedsupport.succeeded(matchers.Always()))
+        assert_that(run_deferred, twistedsupport.succeeded(matchers.Equals('bye!')))
+        executor.detach.assert_called_once_with()
+
+    def test_metrics(self):
+        """
+        Tests that counters and latencies are recorded per port.
+        """
+        now = [0]
+        port_out = object()
+        port_in_out = object()
+        sink = Mock(spec=_port_callback, side_effect=RuntimeError('boom'))
+        port_in = Mock(spec=_port_callback)
+
+        def _slow_forward(item, send):
+            now[0] += 2
+            send(item, port_in_out)
+        port_in.side_effect = _slow_forward
+
+        self.flowmap[port_out] = port_in
+        self.flowmap[port_in_out] = sink
+
+        metrics = MetricsRegistry(bounds=(1, 3), seconds=lambda: now[0])
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              metrics=metrics)
+        self.assertIs(scheduler.metrics, metrics)
+
+        run_deferred = scheduler.run(self.clock)
+        scheduler.send('some item', port_out)
+        now[0] += 5
+
+        from testtools.twistedsupport._runtest import _NoTwistedLogObservers
+        with _NoTwistedLogObservers():
+            with twistedsupport.CaptureTwistedLogs():
+                self.clock.advance(self.epsilon)
+                self.clock.advance(self.epsilon)
+
+        matcher = matchers.AfterPreprocessing(lambda f: f.value, matchers.IsInstance(RuntimeError))
+        assert_that(run_deferred, twistedsupport.failed(matcher))
+
+        stats = scheduler.port_stats()
+        self.assertEquals(stats[port_out].sent, 1)
+        self.assertEquals(stats[port_in].received, 1)
+        self.assertEquals(stats[port_in].failed, 0)
+        self.assertEquals(stats[port_in].wait.counts, (0, 0, 1))
+        self.assertEquals(stats[port_in].execution.counts, (0, 1, 0))
+        self.assertEquals(stats[port_in_out].sent, 1)
+        self.assertEquals(stats[sink].received, 1)
+        self.assertEquals(stats[sink].failed, 1)
+        self.assertEquals(stats[sink].wait.counts, (1, 0, 0))
+
+        scheduler.port_stats(reset=True)
+        self.assertEquals(scheduler.port_stats(), {})
+
+    def test_journal(self):
+        """
+        Tests that jobs are journaled and unfinished jobs are replayed.
+        """
+        port_out = object()
+        port_in = Mock(spec=_port_callback)
+        self.flowmap[port_out] = port_in
+
+        journal = Mock(spec=['open', 'put', 'done', 'close'])
+        journal.open.return_value = [(5, port_in, 'old item')]
+        journal.put.return_value = 6
+
+        scheduler = Scheduler(self.flowmap, self.dispatcher, self.cooperate,
+                              journal=journal)
+        scheduler.run(self.clock)
+        journal.open.assert_called_once_with(self.clock)
+        self.assertEquals(journal.put.call_count, 0)
+
+        scheduler.send('new item', port_out)
+        journal.put.assert_called_once_with(port_in, 'new item')
+
+        self.clock.advance(self.epsilon)
+        self.clock.advance(self.epsilon)
+
+        self.assertEquals(port_in.call_args_list, [
+            (('old item', scheduler.send),),
+            (('new item', scheduler.send),),
+        ])
+        self.assertEquals(journal.done.call_args_list, [((5,),), ((6,),)])
+
+        scheduler.stop('bye!')
+        scheduler.join(self.clock)
+        self.clock.advance(self.epsilon)
+        journal.close.assert_called_once_with()
@@ -16,11 +16,18 @@ from spreadflow_core.dsl.stream import SetDefaultTokenOp, AddTokenOp
 from spreadflow_core.dsl.tokens import \
     AliasToken, \
     ComponentToken, \
+    ConcurrencyToken, \
     ConnectionToken, \
     DescriptionToken, \
+    ExecutorToken, \
+    ExpiryToken, \
+    FusableToken, \
     LabelToken, \
     ParentElementToken, \
-    PartitionToken
+    PartitionToken, \
+    PriorityToken, \
+    RetryToken
+from spreadflow_core.retry import RetryPolicy
 from spreadflow_core.script import Chain, Context, Duplicate, Process, ProcessTemplate
 
 class ProcessDecoratorTestCase(unittest.TestCase):
@@ -118,6 +125,126 @@ class ProcessDecoratorTestCase(unittest.TestCase):
         self.assertIn(AddTokenOp(DescriptionToken(process, '...')), tokens)
         self.assertIn(AddTokenOp(PartitionToken(process, 'trivia')), tokens)
 
+    def test_process_concurrency(self):
+        """
+        Process decorator parameters for concurrency.
+        """
+        process = object()
+
+        with Context(self) as ctx:
+            @Process(concurrency=8, ordered=True)
+            class TrivialProcess(ProcessTemplate):
+                def apply(self):
+                    yield AddTokenOp(ComponentToken(process))
+
+        self.assertIn(AddTokenOp(ConcurrencyToken(process, 8, True)), ctx.tokens)
+
+    def test_process_priority(self):
+        """
+        Process decorator parameters for priority lanes. A weight without a
+        priority applies to the default lane.
+        """
+        process = object()
+
+        with Context(self) as ctx:
+            @Process(priority=-1, weight=2)
+            class TrivialProcess(ProcessTemplate):
+                def apply(self):
+                    yield AddTokenOp(ComponentToken(process))
+
+        self.assertIn(AddTokenOp(PriorityToken(process, -1, 2)), ctx.tokens)
+
+        with Context(self) as ctx:
+            @Process(weight=3)
+            class WeightedProcess(ProcessTemplate):
+                def apply(self):
+                    yield AddTokenOp(ComponentToken(process))
+
+        self.assertIn(AddTokenOp(PriorityToken(process, 0, 3)), ctx.tokens)
+
+        with Context(self) as ctx:
+            weighted = Chain('weighted_chain', lambda item, send: send(item), weight=4)
+
+        self.assertIn(AddTokenOp(PriorityToken(weighted, 0, 4)), ctx.tokens)
+
+    def test_process_fusable(self):
+        """
+        Process decorator parameter for operator fusion.
+        """
+        process = object()
+
+        with Context(self) as ctx:
+            @Process(fusable=True)
+            class TrivialProcess(ProcessTemplate):
+                def apply(self):
+                    yield AddTokenOp(ComponentToken(process))
+
+        self.assertIn(AddTokenOp(FusableToken(process, True)), ctx.tokens)
+
+    def test_process_blocking(self):
+        """
+        Process decorator parameters for blocking processes.
+        """
+        process = object()
+        executor = object()
+
+        with Context(self) as ctx:
+            @Process(blocking=True)
+            class BlockingProcess(ProcessTemplate):
+                def apply(self):
+                    yield AddTokenOp(ComponentToken(process))
+
+        self.assertIn(AddTokenOp(ExecutorToken(process, None)), ctx.tokens)
+
+        with Context(self) as ctx:
+            @Process(executor=executor)
+            class ExecutorProcess(ProcessTemplate):
+                def apply(self):
+                    yield AddTokenOp(ComponentToken(process))
+
+        self.assertIn(AddTokenOp(ExecutorToken(process, executor)), ctx.tokens)
+
+    def test_process_expiry(self):
+        """
+        Process decorator parameters for expiry add an output port connected
+        to the given destination.
+        """
+        process = object()
+
+        with Context(self) as ctx:
+            @Process(ttl=30, expired='dead letters')
+            class TrivialProcess(ProcessTemplate):
+                def apply(self):
+                    yield AddTokenOp(ComponentToken(process))
+
+        tokens = [op.token for op in ctx.tokens if isinstance(op.token, ExpiryToken)]
+        self.assertEqual(len(tokens), 1)
+        port = tokens[0].port
+        self.assertEqual(tokens[0], ExpiryToken(process, 30, None, port))
+        self.assertIn(AddTokenOp(ConnectionToken(port, 'dead letters')), ctx.tokens)
+        self.assertIn(AddTokenOp(ParentElementToken(port, process)), ctx.tokens)
+
+    def test_process_retry(self):
+        """
+        Process decorator parameters for retries add an output port for dead
+        letters connected to the given destination.
+        """
+        process = object()
+        policy = RetryPolicy(attempts=5)
+
+        with Context(self) as ctx:
+            @Process(retry=policy, dead_letter='dead letters')
+            class TrivialProcess(ProcessTemplate):
+                def apply(self):
+                    yield AddTokenOp(ComponentToken(process))
+
+        tokens = [op.token for op in ctx.tokens if isinstance(op.token, RetryToken)]
+        self.assertEqual(len(tokens), 1)
+        port = tokens[0].port
+        self.assertEqual(tokens[0], RetryToken(process, policy, port))
+        self.assertIn(AddTokenOp(ConnectionToken(port, 'dead letters')), ctx.tokens)
+        self.assertIn(AddTokenOp(ParentElementToken(port, process)), ctx.tokens)
+
     def test_process_tokens_from_template(self):
         """
         Template can provide additional tokens.
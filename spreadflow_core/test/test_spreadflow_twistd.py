@@ -45,6 +45,23 @@ class SpreadflowTwistdIntegrationTestCase(unittest.TestCase):
             stdout_value, stderr_value = proc.communicate()
             self.assertEqual(proc.returncode, 0, self._format_stream(stdout_value, stderr_value))
 
+    def test_oneshot_delayed(self):
+        """
+        Process should wait for delayed items of sources in oneshot mode.
+        """
+
+        config = os.path.join(FIXTURE_DIRECTORY, 'spreadflow-delayed.conf')
+        with fixtures.TempDir() as fix:
+            rundir = fix.path
+            argv = ['-n', '-d', rundir, '-c', config, '-o']
+            proc = subprocess.Popen(['spreadflow-twistd'] + argv,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            stdout_value, stderr_value = proc.communicate()
+            self.assertEqual(proc.returncode, 0, self._format_stream(stdout_value, stderr_value))
+            self.assertIn(b'Delayed item received: late item', stdout_value,
+                          self._format_stream(stdout_value, stderr_value))
+
     def test_exit_on_failure(self):
         """
         Process should exit with a non-zero result as soon as a process fails.
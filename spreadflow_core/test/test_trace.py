@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for trace recording and replay.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+from twisted.internet import task
+
+from spreadflow_core.trace import \
+    TraceFormatError, \
+    TraceReader, \
+    TraceRecord, \
+    TraceRecorder, \
+    TraceReplaySource
+
+
+class TraceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(TraceTestCase, self).setUp()
+        self.clock = task.Clock()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'trace')
+
+    def _record(self, records):
+        recorder = TraceRecorder(self.path, ['a', 'b'], names=['first', 'second'])
+        recorder.open(self.clock)
+        for delay, port, item in records:
+            self.clock.advance(delay)
+            recorder.record(port, item)
+        recorder.close()
+        return recorder
+
+    def _read(self):
+        reader = TraceReader(self.path)
+        reader.open()
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_record(self):
+        """
+        Items sent through selected ports are recorded with a timestamp.
+        """
+        item = {'key': 'value'}
+        recorder = TraceRecorder(self.path, ['a', 'b'], names=['first', 'second'], buffer_size=0)
+        recorder.open(self.clock)
+        self.clock.advance(1)
+        recorder.record('a', item)
+        item['key'] = 'changed'
+        self.clock.advance(0.5)
+        recorder.record('unknown', 'ignored')
+        recorder.record('b', 'two')
+        recorder.close()
+
+        self.assertEqual(recorder.count, 2)
+
+        reader = self._read()
+        self.assertEqual(reader.ports, ['first', 'second'])
+        self.assertEqual(list(reader.records()), [
+            TraceRecord(1, 0, {'key': 'value'}),
+            TraceRecord(1.5, 1, 'two'),
+        ])
+
+    def test_truncated(self):
+        """
+        A truncated record at the end of the file is ignored.
+        """
+        self._record([(0, 'a', 'one'), (1, 'a', 'two')])
+        with open(self.path, 'rb+') as trace:
+            trace.truncate(os.path.getsize(self.path) - 1)
+
+        self.assertEqual(list(self._read().records()), [TraceRecord(0, 0, 'one')])
+
+    def test_invalid(self):
+        """
+        Opening a file which is not a trace fails.
+        """
+        with open(self.path, 'wb') as trace:
+            trace.write(b'garbage')
+
+        reader = TraceReader(self.path)
+        self.assertRaises(TraceFormatError, reader.open)
+
+    def test_port_id(self):
+        """
+        Ports are selected by name or by id.
+        """
+        self._record([])
+        reader = self._read()
+        self.assertEqual(reader.port_id('second'), 1)
+        self.assertEqual(reader.port_id(1), 1)
+        self.assertRaises(KeyError, reader.port_id, 'third')
+        self.assertRaises(KeyError, reader.port_id, 2)
+
+    def test_replay_original_speed(self):
+        """
+        Items are replayed with the recorded delays.
+        """
+        self._record([(1, 'a', 'one'), (2, 'b', 'two'), (3, 'a', 'three')])
+        scheduler = Mock(spec=['send', 'register_producer', 'unregister_producer', 'set_busy'])
+
+        source = TraceReplaySource(self.path)
+        source.attach(scheduler, self.clock)
+        scheduler.register_producer.assert_called_once_with(source)
+        scheduler.set_busy.assert_called_once_with(source)
+
+        self.clock.advance(1)
+        self.assertEqual(scheduler.send.call_count, 1)
+        self.clock.advance(2)
+        self.assertEqual(scheduler.send.call_count, 2)
+        self.assertEqual(scheduler.set_busy.call_count, 1)
+        self.clock.advance(3)
+        self.assertEqual([args for args, _ in scheduler.send.call_args_list],
+                         [('one', source), ('two', source), ('three', source)])
+        scheduler.set_busy.assert_called_with(source, False)
+
+        source.detach()
+        scheduler.unregister_producer.assert_called_once_with(source)
+
+    def test_replay_port_scaled(self):
+        """
+        Only items of the selected port are replayed, delays are scaled.
+        """
+        self._record([(1, 'a', 'one'), (2, 'b', 'two'), (3, 'a', 'three')])
+        scheduler = Mock(spec=['send', 'register_producer', 'unregister_producer', 'set_busy'])
+
+        source = TraceReplaySource(self.path, port='first', speed=2)
+        source.attach(scheduler, self.clock)
+
+        self.clock.advance(0.5)
+        scheduler.send.assert_called_once_with('one', source)
+        self.clock.advance(2.5)
+        self.assertEqual([args for args, _ in scheduler.send.call_args_list],
+                         [('one', source), ('three', source)])
+
+        source.detach()
+
+    def test_replay_max_speed(self):
+        """
+        Items are replayed as fast as possible, pausing the source holds back
+        items.
+        """
+        self._record([(1, 'a', item) for item in range(5)])
+        scheduler = Mock(spec=['send', 'register_producer', 'unregister_producer', 'set_busy'])
+
+        source = TraceReplaySource(self.path, speed=None, batch_size=2)
+        scheduler.send.side_effect = lambda item, port: item == 1 and source.pauseProducing()
+        source.attach(scheduler, self.clock)
+
+        self.clock.advance(0)
+        self.assertEqual(scheduler.send.call_count, 2)
+
+        source.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual([args[0] for args, _ in scheduler.send.call_args_list], list(range(5)))
+        self.assertEqual(source.count, 5)
+
+        source.detach()
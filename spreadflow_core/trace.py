@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+"""
+Record and replay of port traffic.
+
+A :class:`TraceRecorder` hooked into the scheduler captures items sent
+through selected output ports into a compact binary trace file. A
+:class:`TraceReplaySource` feeds the trace back into a flow, either at the
+original speed, at a scaled speed or as fast as possible.
+
+The trace file starts with a magic string followed by a header listing the
+names of the recorded ports. Every record consists of a fixed-size header
+(timestamp, port id, length) followed by the pickled item. Timestamps are
+seconds since the recorder was opened.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import pickle
+import struct
+from collections import namedtuple
+
+from twisted.logger import Logger
+
+TRACE_MAGIC = b'SFTRACE1'
+TRACE_HEADER = struct.Struct('!I')
+TRACE_RECORD = struct.Struct('!dHI')
+
+TraceRecord = namedtuple('TraceRecord', ['timestamp', 'port_id', 'item'])
+
+class TraceFormatError(Exception):
+    """
+    Raised when a file is not a valid trace.
+    """
+
+class TraceRecorder(object):
+    """
+    Records items sent through the given output ports.
+
+    Items are pickled immediately, such that later modifications do not
+    affect the trace. Records are buffered and written in chunks of roughly
+    `buffer_size` bytes.
+
+    Args:
+        path (str): Path to the trace file. Overwritten if it exists.
+        ports (list): The output ports to record.
+        names (list): Names of the ports stored in the trace header, used to
+            select a port on replay. Defaults to the string representation of
+            the ports.
+        buffer_size (int): Number of bytes buffered before writing to the
+            file. Defaults to 64 KiB.
+        protocol (int): The pickle protocol. Defaults to 2.
+    """
+
+    log = Logger()
+
+    def __init__(self, path, ports, names=None, buffer_size=2**16, protocol=2):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.protocol = protocol
+
+        self._ports = list(ports)
+        self._port_ids = {port: idx for idx, port in enumerate(self._ports)}
+        self._names = list(names) if names is not None else [str(port) for port in self._ports]
+        assert len(self._names) == len(self._ports), 'Need exactly one name per port'
+
+        self._file = None
+        self._seconds = None
+        self._start = None
+        self._chunks = []
+        self._size = 0
+        self.count = 0
+
+    def open(self, reactor):
+        """
+        Create the trace file and start the clock.
+        """
+        header = pickle.dumps({'ports': self._names}, protocol=self.protocol)
+
+        self._file = open(self.path, 'wb')
+        self._file.write(TRACE_MAGIC + TRACE_HEADER.pack(len(header)) + header)
+        self._seconds = reactor.seconds
+        self._start = reactor.seconds()
+
+        self.log.info('Recording {count} ports to {path}', count=len(self._ports), path=self.path)
+
+    def record(self, port, item):
+        """
+        Record an item if it was sent through one of the selected ports.
+        """
+        port_id = self._port_ids.get(port)
+        if port_id is None or self._file is None:
+            return
+
+        data = pickle.dumps(item, protocol=self.protocol)
+        self._chunks.append(TRACE_RECORD.pack(self._seconds() - self._start, port_id, len(data)))
+        self._chunks.append(data)
+        self._size += TRACE_RECORD.size + len(data)
+        self.count += 1
+
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered records to the file.
+        """
+        if self._chunks:
+            self._file.write(b''.join(self._chunks))
+            self._chunks = []
+            self._size = 0
+
+    def close(self):
+        """
+        Write buffered records and close the file.
+        """
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+            self.log.info('Recorded {count} items to {path}', count=self.count, path=self.path)
+
+class TraceReader(object):
+    """
+    Reads records from a trace file.
+
+    Args:
+        path (str): Path to the trace file.
+
+    Attributes:
+        ports (list): The names of the recorded ports, indexed by port id.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ports = None
+        self._file = None
+
+    def open(self):
+        """
+        Open the file and read the header.
+
+        Raises:
+            TraceFormatError: If the file is not a trace.
+        """
+        self._file = open(self.path, 'rb')
+
+        magic = self._file.read(len(TRACE_MAGIC))
+        if magic != TRACE_MAGIC:
+            self.close()
+            raise TraceFormatError('{:s} is not a trace file'.format(self.path))
+
+        header_len, = TRACE_HEADER.unpack(self._read(TRACE_HEADER.size))
+        header = pickle.loads(self._read(header_len))
+        self.ports = header['ports']
+
+    def port_id(self, port):
+        """
+        Returns the id of a port given its name or id.
+
+        Raises:
+            KeyError: If the port was not recorded.
+        """
+        if isinstance(port, int):
+            if 0 <= port < len(self.ports):
+                return port
+        elif port in self.ports:
+            return self.ports.index(port)
+
+        raise KeyError('Port {!s} not found in trace {:s}'.format(port, self.path))
+
+    def records(self):
+        """
+        Iterate over all records.
+
+        Yields:
+            TraceRecord: The next record. A truncated record at the end of the
+            file (e.g., if the recording process was killed) is ignored.
+        """
+        while True:
+            header = self._file.read(TRACE_RECORD.size)
+            if len(header) < TRACE_RECORD.size:
+                break
+
+            timestamp, port_id, length = TRACE_RECORD.unpack(header)
+            data = self._file.read(length)
+            if len(data) < length:
+                break
+
+            yield TraceRecord(timestamp, port_id, pickle.loads(data))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read(self, length):
+        data = self._file.read(length)
+        if len(data) < length:
+            raise TraceFormatError('{:s}: Unexpected end of file'.format(self.path))
+        return data
+
+class TraceReplaySource(object):
+    """
+    A source replaying items from a trace file.
+
+    The source registers itself as a producer with the scheduler. Items due
+    while the scheduler is congested are held back until it resumes the
+    source. The scheduler is marked busy until the last record was replayed.
+
+    Args:
+        path (str): Path to the trace file.
+        port: Name or id of the recorded port to replay. Defaults to None
+            (replay all ports).
+        speed (float): Replay speed relative to the recording, e.g. 2 for
+            twice as fast. Pass None or 0 to replay as fast as possible.
+            Defaults to 1 (original speed).
+        batch_size (int): The maximum number of items sent in one reactor
+            iteration when replaying as fast as possible. Defaults to 100.
+    """
+
+    log = Logger()
+
+    def __init__(self, path, port=None, speed=1, batch_size=100):
+        self.path = path
+        self.port = port
+        self.speed = speed
+        self.batch_size = batch_size
+        self._scheduler = None
+        self._reactor = None
+        self._reader = None
+        self._records = None
+        self._next = None
+        self._call = None
+        self._start = None
+        self._paused = False
+        self.count = 0
+
+    def attach(self, scheduler, reactor):
+        self._reader = TraceReader(self.path)
+        self._reader.open()
+
+        records = self._reader.records()
+        if self.port is not None:
+            port_id = self._reader.port_id(self.port)
+            records = (record for record in records if record.port_id == port_id)
+
+        self._scheduler = scheduler
+        self._reactor = reactor
+        self._records = records
+        self._next = next(self._records, None)
+        self._start = reactor.seconds()
+
+        scheduler.register_producer(self)
+        if self._next is not None:
+            # Keep oneshot runs going until the last record was replayed.
+            scheduler.set_busy(self)
+        self._schedule()
+
+    def detach(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._next = None
+        self._records = None
+
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+        if self._scheduler:
+            self._scheduler.unregister_producer(self)
+            self._scheduler.set_busy(self, False)
+            self._scheduler = None
+
+    def pauseProducing(self): # pylint: disable=invalid-name
+        self._paused = True
+
+    def resumeProducing(self): # pylint: disable=invalid-name
+        self._paused = False
+        self._schedule()
+
+    def stopProducing(self): # pylint: disable=invalid-name
+        self.detach()
+
+    def _due(self, record):
+        if self.speed:
+            return self._start + record.timestamp / self.speed
+        return self._start
+
+    def _schedule(self):
+        if self._paused or self._call is not None or self._scheduler is None:
+            return
+
+        if self._next is None:
+            return
+
+        delay = max(0, self._due(self._next) - self._reactor.seconds())
+        self._call = self._reactor.callLater(delay, self._emit)
+
+    def _emit(self):
+        self._call = None
+
+        sent = 0
+        while self._next is not None and not self._paused and sent < self.batch_size:
+            if self._due(self._next) > self._reactor.seconds():
+                break
+
+            item = self._next.item
+            self._next = next(self._records, None)
+            self.count += 1
+            sent += 1
+            self._scheduler.send(item, self)
+
+        if self._next is None:
+            self.log.info('Replayed {count} items from {path}', count=self.count, path=self.path)
+            self._scheduler.set_busy(self, False)
+
+        self._schedule()
+
+    def __call__(self, item, send):
+        send(item, self)